@@ -4,33 +4,94 @@ import sys
 import glob
 import time
 import numpy as np
-from utils import follow_bond
+from utils import parse_options
+from lattice import Lattice
+from potts import PottsMRTSim, methods
+from parallel import SlabMRTSim
+from rng import RNG, generators
+from checkpoint import *
+from series import output_formats
+from driver import Driver
 # ------------------------------------------------------------------
 # Check zero-density Potts model with Metropolis--Rosenbluth--Teller algorithm
-# With weight exp[-S] = exp[gamma sum_<ij> \delta_{s_i, s_j}]
-#   the acceptance probability is exp[gamma * (new# - cur#)]
 
 # Parse arguments: 3d lattice volume,
 # Potts coupling gamma, number of sweeps to do, RNG seed
 # and directory for output data
-if len(sys.argv) < 8:
-  print "Usage:", str(sys.argv[0]), "<nx> <ny> <nz>"
+# Optionally '--sweep checkerboard' updates all sites of each sublattice
+# at once, rather than choosing random sites one by one ('--sweep random')
+# while '--sweep sw' and '--sweep wolff' use Swendsen--Wang
+# and single-cluster Wolff updates instead of the MRT algorithm
+# with '--wolff-flips N' Wolff cluster updates per sweep
+# Optionally '--workers N' shares checkerboard sweeps between N processes,
+# each updating a slab of the lattice (see parallel.py)
+# Optionally '--rng' chooses the random number generator (see rng.py)
+# Optionally '--validate-every N' recounts the observables every N sweeps
+# Optionally '--output' writes the observables measured after each sweep
+# to csv files ('csv'), to the single binary file observables.npy
+# ('binary', see series.py and export.py) or to both ('both'),
+# with the binary records appended to the file every '--flush-every N'
+# sweeps
+# Optionally '--therm N' leaves the first N sweeps out of the averages,
+# errors and autocorrelation times accumulated during the run
+# (see analysis.py), which are written to summary.csv at each checkpoint
+# and at the end, while '--target-error X' stops the run as soon as
+# the relative error of each of these observables is below X
+# Optionally '--checkpoint-every N' saves the full state every N sweeps
+# (as well as at the end of the run, or on SIGTERM), while '--resume'
+# continues from the checkpoint in out_dir (see checkpoint.py)
+args, options = parse_options(sys.argv, {'sweep': 'random',
+                                         'wolff_flips': 10,
+                                         'workers': 1,
+                                         'validate_every': 0,
+                                         'rng': 'legacy',
+                                         'output': 'csv',
+                                         'flush_every': 1000,
+                                         'therm': 0,
+                                         'target_error': 0.0,
+                                         'checkpoint_every': 0,
+                                         'resume': False})
+if len(args) < 8 or not options['sweep'] in methods \
+                 or not options['rng'] in generators \
+                 or not options['output'] in output_formats:
+  print "Usage:", str(args[0]), "<nx> <ny> <nz>"
   print "                     <gamma> <sweeps> <RNG seed> <out_dir>"
+  print "                     [--sweep random|checkerboard|sw|wolff]"
+  print "                     [--wolff-flips N] [--workers N]"
+  print "                     [--rng legacy|pcg64|philox]"
+  print "                     [--validate-every N]"
+  print "                     [--output csv|binary|both] [--flush-every N]"
+  print "                     [--therm N] [--target-error X]"
+  print "                     [--checkpoint-every N] [--resume]"
   sys.exit(1)
-nx = np.uint(sys.argv[1])
-ny = np.uint(sys.argv[2])
-nz = np.uint(sys.argv[3])
-vol = nx * ny * nz
-Ndim = 3                      # Number of dimension
-Ndir = 2 * Ndim               # Number of directions (forward and backward)
-Nstate = 3                    # Hard-code three-state Potts model
-gamma = float(sys.argv[4])
-Nsweep = int(sys.argv[5])
-seed = int(sys.argv[6])
-outdir = sys.argv[7]
+dims = (int(args[1]), int(args[2]), int(args[3]))
+gamma = float(args[4])
+Nsweep = int(args[5])
+seed = int(args[6])
+outdir = args[7]
 runtime = -time.time()
 
-# TODO: Utilities for loading configuration...
+# Checkerboard sweeps need each site's neighbors to be on the other sublattice
+if options['sweep'] == 'checkerboard':
+  if not (dims[0] % 2 == 0 and dims[1] % 2 == 0 and dims[2] % 2 == 0):
+    print "ERROR: Checkerboard sweeps need even nx, ny and nz... aborting"
+    sys.exit(1)
+
+# Each worker needs at least one layer in z
+workers = options['workers']
+if workers > 1:
+  if not options['sweep'] == 'checkerboard':
+    print "ERROR: Multiple workers need checkerboard sweeps... aborting"
+    sys.exit(1)
+  if workers > dims[2]:
+    print "ERROR: More workers than nz =", dims[2], "... aborting"
+    sys.exit(1)
+
+# Cluster updates add bonds between neighbors in the same state
+# with probability 1 - exp(-gamma), which needs gamma >= 0
+if options['sweep'] in ['sw', 'wolff'] and gamma < 0:
+  print "ERROR: Cluster updates need non-negative gamma... aborting"
+  sys.exit(1)
 
 # Create output directory if it doesn't exist already
 if not os.path.isdir(outdir):
@@ -38,131 +99,75 @@ if not os.path.isdir(outdir):
   os.makedirs(outdir)
 
 # Save run parameters for posterity
-PARAMS = open(outdir + '/params.txt', 'w')
+# (appending to them if we are resuming an earlier run)
+if options['resume']:
+  PARAMS = open(outdir + '/params.txt', 'a')
+else:
+  PARAMS = open(outdir + '/params.txt', 'w')
 print >> PARAMS, "python", ' '.join(sys.argv)
 
-# Seed (Mersenne Twister) random number generator
-# Use RandomState instead of (global) seed
-# in case multiple independent streams may be needed in the future
-prng = np.random.RandomState(seed)
+# Seed random number generator, by default NumPy's legacy RandomState
+# See rng.py for the guarantees on reproducibility
+prng = RNG(seed, options['rng'])
+print >> PARAMS, "Random number generator:", prng.generator
+
+# Save a checkpoint and stop cleanly if the batch queue sends SIGTERM
+catch_sigterm()
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
-# Set up lattice
-# First define arrays to store (x, y, z) indices of each site
-x = np.empty(vol, dtype=np.uint)
-y = np.empty(vol, dtype=np.uint)
-z = np.empty(vol, dtype=np.uint)
-for i, j, k in np.ndindex((nx, ny, nz)):
-  index = np.uint(i + nx * (j + ny * k))
-  x[index] = i
-  y[index] = j
-  z[index] = k
-
-# Pack constant information into single variable for passing to subroutines
-lattice = dict({'nx': nx, 'ny': ny, 'nz': nz, 'Ndim': Ndim, 'Ndir': Ndir,
-                'vol': vol, 'prng': prng, 'x': x, 'y': y, 'z': z})
-
-# Now for each site we need the following:
-#   The state of the Potts 'spin'
-# We start with randomly assigned values
-config = np.empty(vol, dtype=np.uint)
-for i in range(vol):
-  config[i] = prng.randint(0, Nstate)
+# Set up lattice, tabulating the neighbors of each site
+lattice = Lattice(dims)
+
+# Set up the simulation, starting with randomly assigned states
+# (see potts.py), with the workers' own random numbers spawned from seed
+if workers > 1:
+  sim = SlabMRTSim(lattice, gamma, seed, prng.generator, workers)
+else:
+  sim = PottsMRTSim(lattice, gamma, prng, options['sweep'],
+                    options['wolff_flips'])
+
+# With '--resume', replace this by the configuration and PRNG state
+# saved in the checkpoint, after making sure it comes from a run
+# with the same parameters
+# The output files are truncated to their sizes when it was saved
+# Runs with several workers can only be resumed with as many workers
+state = None
+setup = dims + (gamma, seed, prng.generator)
+if workers > 1:
+  setup += (workers,)
+if options['resume']:
+  saved, state = load_checkpoint(outdir)
+  check_resume(state, setup)
+  sim.set_state(saved, state)
+  print >> PARAMS, "Resuming after sweep", state['sweep']
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
-# Open files for output
-ACCEPT = open(outdir + '/accept.csv', 'w')
-print >> ACCEPT, "sweep,accept"
-MAGNET = open(outdir + '/magnet.csv', 'w')
-print >> MAGNET, "sweep,state1,state2,state3"
-ACTION = open(outdir + '/action.csv', 'w')
-print >> ACTION, "sweep,action_tot,action_rel"
-
-# Print starting state
-# Note S = -gamma sum_<ij> delta_{s_i, s_j}    # TODO: Check sign...
-magnet = [0, 0, 0]
-tot_act = 0.0
-for i in range(vol):
-  magnet[config[i]] += 1    # Count how many sites have each value
-  for mu in range(Ndim):    # Only the forward neighbors
-    if config[i] == config[follow_bond(i, mu, lattice)]:
-      tot_act -= gamma
-
-# Print 'magnetization' and action,
-# for each including both total and average over lattice volume
-m1 = float(magnet[0]) / float(vol)
-m2 = float(magnet[1]) / float(vol)
-m3 = float(magnet[2]) / float(vol)
-print >> MAGNET, "0,%.8g,%.8g,%.8g" % (m1, m2, m3)
-print >> ACTION, "0,%.8g,%.8g" % (tot_act, tot_act / float(vol))
-
-# Loop over sweeps, printing some basic data after each one
-for sweep in range(1, Nsweep + 1):
-  # Each sweep loops (randomly) over the lattice volume
-  accept = 0.0                    # Initialize acceptance rate
-  for i in range(vol):
-    # Update: Try to change the state at the current site
-    # The new state is allowed to be the current state
-    ran = prng.randint(0, vol)
-    cur = config[ran]
-    new = prng.randint(0, Nstate)   # Proposed new state at site ran
-
-    # Compute change in energy, if non-zero
-    # With weight exp[-S] = exp[gamma sum_<ij> delta_{s_i, s_j}]
-    #   accept with probability exp[diff] = exp[oldE - newE]
-    if new == cur:
-      accept += 1.0
-    else:         # We know new != cur
-      diff = 0.0
-      for mu in range(Ndir):
-        neigh = config[follow_bond(ran, mu, lattice)]
-        if new == neigh:
-          diff += gamma
-        elif cur == neigh:
-          diff -= gamma
-
-      if diff > 0:
-        config[ran] = new
-        accept += 1.0
-      elif prng.uniform(0, 1) < np.exp(diff):
-        config[ran] = new
-        accept += 1.0
-
-  # Print some basic data after each sweep
-  # (Can also run after each update if speed is not an issue)
-  magnet = [0, 0, 0]
-  tot_act = 0.0
-  for i in range(vol):
-    magnet[config[i]] += 1    # Count how many sites have each value
-    for mu in range(Ndim):    # Only the forward neighbors
-      if config[i] == config[follow_bond(i, mu, lattice)]:
-        tot_act -= gamma
-
-  # Print acceptance, 'magnetization' and action,
-  # for each including both total and average over lattice volume
-  print >> ACCEPT, "%d,%.4g" % (sweep, accept / float(vol))
-  m1 = float(magnet[0]) / float(vol)
-  m2 = float(magnet[1]) / float(vol)
-  m3 = float(magnet[2]) / float(vol)
-  print >> MAGNET, "%d,%.8g,%.8g,%.8g" % (sweep, m1, m2, m3)
-  print >> ACTION, "%d,%.8g,%.8g" % (sweep, tot_act, tot_act / float(vol))
+# Open files for output, with one column for each observable
+# returned by sim.measure(), in csv files and/or observables.npy,
+# and analyze the tracked observables as we go (see driver.py)
+driver = Driver(sim, outdir, options, setup, PARAMS, state)
+
+# Loop over sweeps, printing acceptance, 'magnetization' and action
+# after each one, for each including both total and average over
+# lattice volume
+# The running totals of the default random sweeps
+# are optionally checked against a recount from scratch
+driver.run(Nsweep)
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
 # Clean up and close down
-ACCEPT.close()
-MAGNET.close()
-ACTION.close()
-
-# TODO: Utilities for saving configuration...
+driver.close()
+if workers > 1:
+  sim.close()
 
 runtime += time.time()
 print "Runtime: %0.1f seconds" % runtime
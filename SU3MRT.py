@@ -4,7 +4,10 @@ import sys
 import glob
 import time
 import numpy as np
-from utils import follow_bond
+from utils import neighbor_table, site_coords, parse_options
+from utils import potts_counts, check_potts
+from rng import RNG, generators
+from checkpoint import *
 # ------------------------------------------------------------------
 # Check zero-density SU(3) with Metropolis--Rosenbluth--Teller algorithm
 # Likely duplicates MILC pure-gauge over-relaxation algorithm,
@@ -13,141 +16,175 @@ from utils import follow_bond
 # Parse arguments: 4d lattice volume,
 # gauge coupling beta, number of sweeps to do, RNG seed
 # and directory for output data
-if len(sys.argv) < 9:
-  print "Usage:", str(sys.argv[0]), "<nx> <ny> <nz> <nt>"
+# Optionally '--rng' chooses the random number generator (see rng.py)
+# Optionally '--validate-every N' recounts the observables every N sweeps
+# Optionally '--checkpoint-every N' saves the full state every N sweeps
+# (as well as at the end of the run, or on SIGTERM), while '--resume'
+# continues from the checkpoint in out_dir (see checkpoint.py)
+args, options = parse_options(sys.argv, {'validate_every': 0,
+                                         'rng': 'legacy',
+                                         'checkpoint_every': 0,
+                                         'resume': False})
+if len(args) < 9 or not options['rng'] in generators:
+  print "Usage:", str(args[0]), "<nx> <ny> <nz> <nt>"
   print "                   <beta> <sweeps> <RNG seed> <out_dir>"
+  print "                   [--rng legacy|pcg64|philox]"
+  print "                   [--validate-every N]"
+  print "                   [--checkpoint-every N] [--resume]"
   sys.exit(1)
-nx = np.uint(sys.argv[1])
-ny = np.uint(sys.argv[2])
-nz = np.uint(sys.argv[3])
-nt = np.uint(sys.argv[4])
+nx = np.uint(args[1])
+ny = np.uint(args[2])
+nz = np.uint(args[3])
+nt = np.uint(args[4])
 vol = nx * ny * nz * nt
 Ndim = 4                      # Number of dimension
 Ndir = 2 * Ndim               # Number of directions (forward and backward)
 Nc = 3                        # Hard-code SU(3) gauge theory
-beta = float(sys.argv[5])
-Nsweep = int(sys.argv[6])
-seed = int(sys.argv[7])
-outdir = sys.argv[8]
+beta = float(args[5])
+Nsweep = int(args[6])
+seed = int(args[7])
+outdir = args[8]
 runtime = -time.time()
 
-# TODO: Utilities for loading configuration...
-
 # Create output directory if it doesn't exist already
 if not os.path.isdir(outdir):
   print "Creating directory", outdir, "for output"
   os.makedirs(outdir)
 
 # Save run parameters for posterity
-PARAMS = open(outdir + '/params.txt', 'w')
+# (appending to them if we are resuming an earlier run)
+if options['resume']:
+  PARAMS = open(outdir + '/params.txt', 'a')
+else:
+  PARAMS = open(outdir + '/params.txt', 'w')
 print >> PARAMS, "python", ' '.join(sys.argv)
 
-# Seed (Mersenne Twister) random number generator
-# Use RandomState instead of (global) seed
-# in case multiple independent streams may be needed in the future
-prng = np.random.RandomState(seed)
+# Seed random number generator, by default NumPy's legacy RandomState
+# See rng.py for the guarantees on reproducibility
+prng = RNG(seed, options['rng'])
+print >> PARAMS, "Random number generator:", prng.generator
+
+# Save a checkpoint and stop cleanly if the batch queue sends SIGTERM
+catch_sigterm()
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
 # Set up lattice
-# First define arrays to store (x, y, z) indices of each site
-x = np.empty(vol, dtype=np.uint)
-y = np.empty(vol, dtype=np.uint)
-z = np.empty(vol, dtype=np.uint)
-t = np.empty(vol, dtype=np.uint)
-for i, j, k, l in np.ndindex((nx, ny, nz, nt)):
-  index = np.uint(i + nx * (j + ny * (k + nt * l)))
-  x[index] = i
-  y[index] = j
-  z[index] = k
-  t[index] = l
+dims = (nx, ny, nz, nt)         # Lattice extents, x running fastest
+# First define arrays to store (x, y, z, t) indices of each site
+x, y, z, t = site_coords(dims)
+
+# Tabulate the neighbors of each site in all Ndir directions
+neighbor = neighbor_table(dims)
 
 # Pack constant information into single variable for passing to subroutines
 lattice = dict({'nx': nx, 'ny': ny, 'nz': nz, 'nt': nt,
                 'Ndim': Ndim, 'Ndir': Ndir, 'vol': vol, 'prng': prng,
-                'x': x, 'y': y, 'z': z, 't': t})
+                'x': x, 'y': y, 'z': z, 't': t, 'neighbor': neighbor})
+
+# TODO: TO BE UPDATED...
+# The SU(3) link variables are still to be set up,
+# so for now each site carries a three-state Potts 'spin' (one per color)
+Nstate = Nc
 
-TODO: TO BE UPDATED...
 # Now for each site we need the following:
 #   The state of the Potts 'spin'
 # We start with randomly assigned values
-config = np.empty(vol, dtype=np.uint)
-for i in range(vol):
-  config[i] = prng.randint(0, Nstate)
+config = prng.integers(0, Nstate, size=vol).astype(np.uint)
+
+# With '--resume', replace this by the configuration and PRNG state
+# saved in the checkpoint, after making sure it comes from a run
+# with the same parameters
+# The output files are truncated to their sizes when it was saved
+start = 1
+sizes = None
+setup = (nx, ny, nz, nt, beta, seed, prng.generator)
+if options['resume']:
+  saved, state = load_checkpoint(outdir)
+  check_resume(state, setup)
+  config = copy_arrays(saved)['config']
+  prng.set_state(state['rng'])
+  start = state['sweep'] + 1
+  sizes = state['outputs']
+  print >> PARAMS, "Resuming after sweep", state['sweep']
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
 # Open files for output
-ACCEPT = open(outdir + '/accept.csv', 'w')
-print >> ACCEPT, "sweep,accept"
-MAGNET = open(outdir + '/magnet.csv', 'w')
-print >> MAGNET, "sweep,state1,state2,state3"
-ACTION = open(outdir + '/action.csv', 'w')
-print >> ACTION, "sweep,action_tot,action_rel"
+ACCEPT = open_output(outdir + '/accept.csv', "sweep,accept", sizes)
+MAGNET = open_output(outdir + '/magnet.csv',
+                     "sweep,state1,state2,state3", sizes)
+ACTION = open_output(outdir + '/action.csv',
+                     "sweep,action_tot,action_rel", sizes)
 
 # Print starting state
 # Note S = -beta sum_<ij> delta_{s_i, s_j}    # TODO: Check sign...
-magnet = [0, 0, 0]
-tot_act = 0.0
-for i in range(vol):
-  magnet[config[i]] += 1    # Count how many sites have each value
-  for mu in range(Ndim):    # Only the forward neighbors
-    if config[i] == config[follow_bond(i, mu, lattice)]:
-      tot_act -= beta
-
-# Print 'magnetization' and action,
+# Count how many sites have each value, and how many pairs
+# of nearest neighbors are aligned (in the same state)
+# These are then kept as running totals in the default random sweeps
+magnet, aligned = potts_counts(config, dims, Nstate)
+tot_act = -beta * aligned
+
+# Print 'magnetization' and action (unless resuming),
 # for each including both total and average over lattice volume
-m1 = float(magnet[0]) / float(vol)
-m2 = float(magnet[1]) / float(vol)
-m3 = float(magnet[2]) / float(vol)
-print >> MAGNET, "0,%.8g,%.8g,%.8g" % (m1, m2, m3)
-print >> ACTION, "0,%.8g,%.8g" % (tot_act, tot_act / float(vol))
+if not options['resume']:
+  m1 = float(magnet[0]) / float(vol)
+  m2 = float(magnet[1]) / float(vol)
+  m3 = float(magnet[2]) / float(vol)
+  print >> MAGNET, "0,%.8g,%.8g,%.8g" % (m1, m2, m3)
+  print >> ACTION, "0,%.8g,%.8g" % (tot_act, tot_act / float(vol))
 
 # Loop over sweeps, printing some basic data after each one
-for sweep in range(1, Nsweep + 1):
+for sweep in range(start, Nsweep + 1):
   # Each sweep loops (randomly) over the lattice volume
+  # Draw a random site, new state and uniform number for each update
   accept = 0.0                    # Initialize acceptance rate
+  ran_sites = prng.integers(0, vol, size=vol).tolist()
+  ran_states = prng.integers(0, Nstate, size=vol).tolist()
+  ran_unif = prng.uniform(size=vol).tolist()
   for i in range(vol):
     # Update: Try to change the state at the current site
     # The new state is allowed to be the current state
-    ran = prng.randint(0, vol)
+    ran = ran_sites[i]
     cur = config[ran]
-    new = prng.randint(0, Nstate)   # Proposed new state at site ran
+    new = ran_states[i]             # Proposed new state at site ran
 
     # Compute change in energy, if non-zero
     # With weight exp[-S] = exp[beta sum_<ij> delta_{s_i, s_j}]
     #   accept with probability exp[diff] = exp[oldE - newE]
+    # The change in the number of aligned neighbors, dn,
+    # also updates the running totals if the change is accepted
     if new == cur:
       accept += 1.0
     else:         # We know new != cur
-      diff = 0.0
+      dn = 0
       for mu in range(Ndir):
-        neigh = config[follow_bond(ran, mu, lattice)]
+        neigh = config[neighbor[ran][mu]]
         if new == neigh:
-          diff += beta
+          dn += 1
         elif cur == neigh:
-          diff -= beta
+          dn -= 1
 
-      if diff > 0:
-        config[ran] = new
-        accept += 1.0
-      elif prng.uniform(0, 1) < np.exp(diff):
+      diff = beta * dn
+      if diff > 0 or ran_unif[i] < np.exp(diff):
         config[ran] = new
+        magnet[cur] -= 1
+        magnet[new] += 1
+        aligned += dn
         accept += 1.0
 
+  # Optionally recount the observables from scratch, to check the totals
+  validate = options['validate_every']
+  if validate > 0 and sweep % validate == 0:
+    check_potts(config, dims, Nstate, magnet, aligned)
+
   # Print some basic data after each sweep
   # (Can also run after each update if speed is not an issue)
-  magnet = [0, 0, 0]
-  tot_act = 0.0
-  for i in range(vol):
-    magnet[config[i]] += 1    # Count how many sites have each value
-    for mu in range(Ndim):    # Only the forward neighbors
-      if config[i] == config[follow_bond(i, mu, lattice)]:
-        tot_act -= beta
+  tot_act = -beta * aligned
 
   # Print acceptance, 'magnetization' and action,
   # for each including both total and average over lattice volume
@@ -157,6 +194,19 @@ for sweep in range(1, Nsweep + 1):
   m3 = float(magnet[2]) / float(vol)
   print >> MAGNET, "%d,%.8g,%.8g,%.8g" % (sweep, m1, m2, m3)
   print >> ACTION, "%d,%.8g,%.8g" % (sweep, tot_act, tot_act / float(vol))
+
+  # Save the full state every options['checkpoint_every'] sweeps,
+  # after the last sweep, and before stopping on SIGTERM
+  every = options['checkpoint_every']
+  if (every > 0 and sweep % every == 0) or sweep == Nsweep or terminated():
+    outputs = output_sizes([ACCEPT, MAGNET, ACTION])
+    save_checkpoint(outdir, {'config': config},
+                    {'setup': setup, 'sweep': sweep,
+                     'rng': prng.get_state(), 'outputs': outputs})
+  if terminated():
+    print "Stopping after sweep", sweep, "on SIGTERM"
+    print >> PARAMS, "Stopped after sweep", sweep, "on SIGTERM"
+    break
 # ------------------------------------------------------------------
 
 
@@ -167,8 +217,6 @@ ACCEPT.close()
 MAGNET.close()
 ACTION.close()
 
-# TODO: Utilities for saving configuration...
-
 runtime += time.time()
 print "Runtime: %0.1f seconds" % runtime
 print >> PARAMS, "Runtime: %0.1f seconds" % runtime
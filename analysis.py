@@ -0,0 +1,273 @@
+#!/usr/bin/python
+import numpy as np
+# Online analysis of the observables measured after each sweep,
+# giving their averages, statistical errors and integrated autocorrelation
+# times without keeping the time series in memory
+#
+# Binning keeps the averages of blocks of 2^l consecutive measurements
+# for every level l, giving the error from the variance of the block
+# averages once they are long compared to the autocorrelation time
+# Correlator estimates the autocorrelation function at logarithmically
+# spaced lags, from the same block averages (a 'multiple-tau' correlator),
+# which is summed up to a self-consistent window (Sokal)
+#   tau_int = 1/2 + sum_{t=1}^{W} rho(t)   with   W >= c tau_int(W)
+# to give the error sqrt[2 tau_int var / N]
+# Both need O(log N) memory for N measurements
+#
+# OnlineAnalysis tracks several observables, with record(sweep, obs)
+# like the outputs in series.py, and writes them to summary.csv
+# Its state can be saved in checkpoints, so that resuming a run
+# gives the same results as an uninterrupted run
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Each level holds the number of blocks, the sums of their averages
+# and of their squares, and the first half of the next block (if any)
+# Everything is shifted by the first measurement, to avoid round-off
+# in the sums of squares
+class Binning(object):
+  def __init__(self):
+    self.shift = None
+    self.count = []
+    self.tot = []
+    self.tot2 = []
+    self.pending = []
+
+  def add(self, x):
+    if self.shift is None:
+      self.shift = x
+    x -= self.shift
+    l = 0
+    while True:
+      if l == len(self.count):
+        self.count.append(0)
+        self.tot.append(0.0)
+        self.tot2.append(0.0)
+        self.pending.append(None)
+      self.count[l] += 1
+      self.tot[l] += x
+      self.tot2[l] += x * x
+      if self.pending[l] is None:
+        self.pending[l] = x
+        return
+      x = 0.5 * (self.pending[l] + x)
+      self.pending[l] = None
+      l += 1
+
+  def mean(self):
+    return self.shift + self.tot[0] / self.count[0]
+
+  # Variance of the block averages at level l
+  def variance(self, l):
+    n = self.count[l]
+    if n < 2:
+      return 0.0
+    ave = self.tot[l] / n
+    return max(self.tot2[l] / n - ave * ave, 0.0) * n / (n - 1.0)
+
+  # Error from the highest level with at least min_blocks blocks
+  # tau_int follows from how much the error has grown from level 0
+  def error(self, min_blocks=32):
+    l = 0
+    while l + 1 < len(self.count) and self.count[l + 1] >= min_blocks:
+      l += 1
+    err = np.sqrt(self.variance(l) / max(self.count[l], 1))
+    var = self.variance(0)
+    if var == 0:
+      return err, 0.5
+    return err, 0.5 * err * err * self.count[0] / var
+
+  def get_state(self):
+    return {'shift': self.shift, 'count': list(self.count),
+            'tot': list(self.tot), 'tot2': list(self.tot2),
+            'pending': list(self.pending)}
+
+  def set_state(self, state):
+    self.shift = state['shift']
+    self.count = list(state['count'])
+    self.tot = list(state['tot'])
+    self.tot2 = list(state['tot2'])
+    self.pending = list(state['pending'])
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Level l holds the last p block averages of 2^l measurements
+# (newest first), the sums of their products at each lag j < p
+# and the number of blocks
+# Level 0 gives the autocorrelations at lags 0, 1, ..., p - 1,
+# and each level l > 0 at lags j 2^l for p / 2 <= j < p
+# Measurements are shifted by the first one, as for Binning
+class Correlator(object):
+  def __init__(self, p=16):
+    self.p = p
+    self.shift = None
+    self.tot = 0.0
+    self.buf = []
+    self.acc = []
+    self.count = []
+    self.pending = []
+
+  def add(self, x):
+    if self.shift is None:
+      self.shift = x
+    x -= self.shift
+    self.tot += x
+    l = 0
+    while True:
+      if l == len(self.buf):
+        self.buf.append(np.zeros(self.p))
+        self.acc.append(np.zeros(self.p))
+        self.count.append(0)
+        self.pending.append(None)
+      buf = self.buf[l]
+      buf[1:] = buf[:-1]
+      buf[0] = x
+      self.acc[l] += x * buf
+      self.count[l] += 1
+      if self.pending[l] is None:
+        self.pending[l] = x
+        return
+      x = 0.5 * (self.pending[l] + x)
+      self.pending[l] = None
+      l += 1
+
+  # Lags t, the number of lags each represents,
+  # and the normalized autocorrelation rho(t) at each,
+  # for as long as there are pairs of blocks to average
+  def autocorrelation(self):
+    if len(self.count) == 0:
+      return [], [], []
+    mean = self.tot / self.count[0]
+    var = self.acc[0][0] / self.count[0] - mean * mean
+    lags = []
+    widths = []
+    rho = []
+    for l in range(len(self.count)):
+      for j in range(1 if l == 0 else self.p / 2, self.p):
+        pairs = self.count[l] - j
+        if pairs <= 0:
+          return lags, widths, rho
+        lags.append(j * 2**l)
+        widths.append(2**l)
+        if var > 0:
+          rho.append((self.acc[l][j] / pairs - mean * mean) / var)
+        else:
+          rho.append(0.0)
+    return lags, widths, rho
+
+  # tau_int summed up to the first lag W with W >= c tau_int(W),
+  # returning 0 for W if there are not yet enough measurements
+  def tau_int(self, c=6.0):
+    tau = 0.5
+    for t, width, r in zip(*self.autocorrelation()):
+      tau += r * width
+      if t >= c * tau:
+        return max(tau, 0.5), t
+    return max(tau, 0.5), 0
+
+  def variance(self):
+    n = self.count[0]
+    if n < 2:
+      return 0.0
+    mean = self.tot / n
+    return max(self.acc[0][0] / n - mean * mean, 0.0) * n / (n - 1.0)
+
+  def get_state(self):
+    return {'shift': self.shift, 'tot': self.tot,
+            'buf': [b.copy() for b in self.buf],
+            'acc': [a.copy() for a in self.acc],
+            'count': list(self.count), 'pending': list(self.pending)}
+
+  def set_state(self, state):
+    self.shift = state['shift']
+    self.tot = state['tot']
+    self.buf = [np.array(b) for b in state['buf']]
+    self.acc = [np.array(a) for a in state['acc']]
+    self.count = list(state['count'])
+    self.pending = list(state['pending'])
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Analysis of the given observables, skipping the first therm sweeps
+class OnlineAnalysis(object):
+  columns = ['observable', 'count', 'mean', 'error', 'tau_int', 'window',
+             'error_bin', 'tau_bin']
+
+  def __init__(self, names, therm=0):
+    self.names = list(names)
+    self.therm = therm
+    self.n = 0
+    self.binning = dict((name, Binning()) for name in self.names)
+    self.correlator = dict((name, Correlator()) for name in self.names)
+
+  def record(self, sweep, obs):
+    if sweep <= self.therm:
+      return
+    self.n += 1
+    for name in self.names:
+      x = float(obs[name])
+      self.binning[name].add(x)
+      self.correlator[name].add(x)
+
+  # Dictionary of the columns of summary.csv for each observable
+  def summary(self):
+    results = []
+    for name in self.names:
+      binning = self.binning[name]
+      corr = self.correlator[name]
+      row = {'observable': name, 'count': self.n}
+      if row['count'] > 0:
+        tau, window = corr.tau_int()
+        err_bin, tau_bin = binning.error()
+        row.update({'mean': binning.mean(),
+                    'error': np.sqrt(2.0 * tau * corr.variance()
+                                     / row['count']),
+                    'tau_int': tau, 'window': window,
+                    'error_bin': err_bin, 'tau_bin': tau_bin})
+      results.append(row)
+    return results
+
+  # Whether every observable has reached the target relative error,
+  # with the autocorrelation window found, at least min_count measurements
+  # and at least 50 tau_int for the estimates to be trusted
+  # Observables that never change (e.g. the action at gamma = 0) count
+  def converged(self, target, min_count=100):
+    if self.n < min_count:
+      return False
+    for row in self.summary():
+      if row['error'] == 0 and row['mean'] == 0:
+        continue
+      if row['window'] == 0 or self.n < 50 * row['tau_int'] \
+                            or row['error'] > target * abs(row['mean']):
+        return False
+    return True
+
+  def write(self, filename):
+    with open(filename, 'w') as f:
+      print >> f, ','.join(self.columns)
+      for row in self.summary():
+        if not 'mean' in row:
+          print >> f, "%s,0,,,,,," % row['observable']
+          continue
+        print >> f, "%s,%d,%.8g,%.4g,%.4g,%d,%.4g,%.4g" \
+                    % tuple(row[c] for c in self.columns)
+
+  def get_state(self):
+    return {'names': self.names, 'therm': self.therm, 'n': self.n,
+            'binning': dict((name, self.binning[name].get_state())
+                            for name in self.names),
+            'correlator': dict((name, self.correlator[name].get_state())
+                               for name in self.names)}
+
+  def set_state(self, state):
+    self.n = state['n']
+    for name in self.names:
+      self.binning[name].set_state(state['binning'][name])
+      self.correlator[name].set_state(state['correlator'][name])
+# ------------------------------------------------------------------
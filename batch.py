@@ -0,0 +1,131 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import numpy as np
+from utils import parse_options
+from lattice import Lattice
+from potts import PottsMRTBatch, batch_methods
+from rng import RNG, generators, spawn_seeds
+from checkpoint import *
+from series import output_formats
+from driver import Driver
+# ------------------------------------------------------------------
+# Run many independent chains of PottsMRT.py simulations at once,
+# for small lattices where the interpreter overhead dominates each sweep
+# (see PottsMRTBatch in potts.py)
+
+# Parse arguments: 3d lattice volume, Potts coupling gamma,
+# number of chains, number of sweeps to do, RNG seed
+# and directory for output data
+# Each chain gets its own stream of random numbers spawned from
+# random_seed (see spawn_seeds in rng.py) and writes the same output
+# files as PottsMRT.py in its own subdirectory chain<k> of out_dir
+# The options are the same as for PottsMRT.py, except that
+# Wolff updates and '--target-error' are not available
+args, options = parse_options(sys.argv, {'sweep': 'random',
+                                         'validate_every': 0,
+                                         'rng': 'legacy',
+                                         'output': 'csv',
+                                         'flush_every': 1000,
+                                         'therm': 0,
+                                         'checkpoint_every': 0,
+                                         'resume': False})
+if len(args) < 9 or not options['sweep'] in batch_methods \
+                 or not options['rng'] in generators \
+                 or not options['output'] in output_formats:
+  print "Usage:", str(args[0]), "<nx> <ny> <nz> <gamma> <chains>"
+  print "                <sweeps> <random_seed> <out_dir>"
+  print "                [--sweep random|checkerboard|sw]"
+  print "                [--rng legacy|pcg64|philox] [--validate-every N]"
+  print "                [--output csv|binary|both] [--flush-every N]"
+  print "                [--therm N]"
+  print "                [--checkpoint-every N] [--resume]"
+  sys.exit(1)
+dims = (int(args[1]), int(args[2]), int(args[3]))
+gamma = float(args[4])
+K = int(args[5])
+Nsweep = int(args[6])
+seed = int(args[7])
+outdir = args[8]
+runtime = -time.time()
+
+# Checkerboard sweeps need each site's neighbors to be on the other sublattice
+if options['sweep'] == 'checkerboard':
+  if not (dims[0] % 2 == 0 and dims[1] % 2 == 0 and dims[2] % 2 == 0):
+    print "ERROR: Checkerboard sweeps need even nx, ny and nz... aborting"
+    sys.exit(1)
+
+# Cluster updates add bonds between neighbors in the same state
+# with probability 1 - exp(-gamma), which needs gamma >= 0
+if options['sweep'] == 'sw' and gamma < 0:
+  print "ERROR: Cluster updates need non-negative gamma... aborting"
+  sys.exit(1)
+
+# Create output directory if it doesn't exist already
+if not os.path.isdir(outdir):
+  print "Creating directory", outdir, "for output"
+  os.makedirs(outdir)
+
+# Save run parameters for posterity
+# (appending to them if we are resuming an earlier run)
+if options['resume']:
+  PARAMS = open(outdir + '/params.txt', 'a')
+else:
+  PARAMS = open(outdir + '/params.txt', 'w')
+print >> PARAMS, "python", ' '.join(sys.argv)
+
+# Independent random numbers for each chain
+prngs = [RNG(s, options['rng'])
+         for s in spawn_seeds(seed, options['rng'], K)]
+print >> PARAMS, "Random number generator:", prngs[0].generator
+
+# Save a checkpoint and stop cleanly if the batch queue sends SIGTERM
+catch_sigterm()
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Set up lattice and all the chains, starting with randomly assigned states
+lattice = Lattice(dims)
+sim = PottsMRTBatch(lattice, gamma, prngs, options['sweep'])
+
+# With '--resume', replace this by the configurations and PRNG states
+# saved in the checkpoint, as in PottsMRT.py
+# The output files of each chain are truncated to their sizes then,
+# which the checkpoint records separately for each chain
+state = None
+setup = dims + (gamma, K, seed, prngs[0].generator)
+if options['resume']:
+  saved, state = load_checkpoint(outdir)
+  check_resume(state, setup)
+  sim.set_state(saved, state)
+  print >> PARAMS, "Resuming after sweep", state['sweep']
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Open files for output and set up the analysis for each chain,
+# in its own directory (see driver.py)
+driver = Driver(sim, outdir, options, setup, PARAMS, state,
+                ['chain%d' % k for k in range(K)])
+
+# Loop over sweeps, printing some basic data after each one,
+# with the observables optionally checked against a recount
+# for each chain separately
+driver.run(Nsweep)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Clean up and close down
+driver.close()
+
+runtime += time.time()
+print "Runtime: %0.1f seconds" % runtime
+print >> PARAMS, "Runtime: %0.1f seconds" % runtime
+PARAMS.close()
+# ------------------------------------------------------------------
@@ -0,0 +1,351 @@
+#!/usr/bin/python
+import os
+import sys
+import csv
+import time
+import shutil
+import pstats
+import timeit
+import cProfile
+import tempfile
+import subprocess
+from utils import parse_options
+from lattice import Lattice
+from potts import PottsClusterSim, PottsMRTSim
+from rng import RNG
+# ------------------------------------------------------------------
+# Time the drivers over a grid of lattice sizes, couplings and densities,
+# or compare two sets of results to look for regressions
+
+# Parse arguments: 'run' followed by the file for the results,
+# or 'compare' followed by two such files (old then new)
+# Each case runs the driver in a separate process, timing the whole run
+# and recording its peak memory
+# The site updates per second come from timing the sweeps alone,
+# using the simulation classes of potts.py in this process,
+# and the same sweeps run again under cProfile give the time per sweep
+# spent in the cluster traversals of utils.py
+# (so SU3MRT.py, which has no such class, only gets the first two)
+# For the cluster drivers a third run with '--timing' gives the average time
+# for each of the three update steps (see StepTimer in potts.py)
+# Optionally '--sizes', '--gammas', '--densities' (baryons per site)
+# and '--betas' set the grid as comma-separated lists,
+# with '--nt' the temporal extent for the SU(3) drivers
+# Optionally '--sweeps N' sets the number of sweeps for each driver run,
+# and the smallest number of sweeps to time, with more on smaller
+# lattices to reach '--site-updates N', keeping the fastest
+# of '--repeats N' runs of these sweeps
+# '--connect' the comma-separated connectivity methods for PottsCluster.py
+# and '--mrt-sweep' the sweep methods for PottsMRT.py
+# Optionally '--drivers' chooses which drivers to run
+# Optionally '--no-profile' skips the profiled sweeps and '--timing' runs
+# With 'compare', '--tolerance' sets the fractional change in speed
+# or peak memory to be flagged as a regression (default 0.1)
+drivers = ['PottsCluster', 'PottsMRT', 'SU3Cluster', 'SU3MRT']
+
+# The deconfinement transition of the three-state Potts model
+# is near gamma = 0.55, so by default we time one coupling on each side
+# as well as one close to the transition
+args, options = parse_options(sys.argv, {'sizes': '8,16,32,64',
+                                         'gammas': '0.4,0.55,0.8',
+                                         'densities': '0.01,0.1',
+                                         'betas': '5.5,5.7,5.9',
+                                         'nt': 4,
+                                         'sweeps': 3,
+                                         'site_updates': 100000,
+                                         'repeats': 3,
+                                         'seed': 1,
+                                         'connect': 'search',
+                                         'mrt_sweep': 'random,checkerboard',
+                                         'drivers': ','.join(drivers),
+                                         'no_profile': False,
+                                         'tolerance': 0.1})
+if len(args) < 3 or not args[1] in ['run', 'compare'] \
+                 or (args[1] == 'compare' and len(args) < 4):
+  print "Usage:", str(args[0]), "run <results.csv>"
+  print "                     [--sizes 8,16,32,64] [--gammas 0.4,0.55,0.8]"
+  print "                     [--densities 0.01,0.1] [--betas 5.5,5.7,5.9]"
+  print "                     [--nt N] [--sweeps N] [--site-updates N]"
+  print "                     [--repeats N] [--seed N]"
+  print "                     [--connect search,dynamic]"
+  print "                     [--mrt-sweep random,checkerboard,sw,wolff]"
+  print "                     [--drivers PottsCluster,PottsMRT,...]"
+  print "                     [--no-profile]"
+  print "      ", str(args[0]), "compare <old.csv> <new.csv> [--tolerance X]"
+  sys.exit(1)
+
+# Columns of the results file
+# Each case is identified by the first five, which compare uses to match
+# Cases that fail (e.g. the SU(3) drivers, not yet implemented)
+# are recorded with status 'error' and no timings
+key = ['driver', 'dims', 'param', 'baryons', 'method']
+columns = key + ['sweeps', 'status', 'runtime', 'sweep_time',
+                 'site_updates_per_sec',
+                 'peak_mem_MB', 'connect_ms_per_sweep', 'build_ms_per_sweep',
+                 'mvB_usec', 'mvQ_usec', 'bond_usec']
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Split comma-separated option into list of the given type
+def option_list(name, kind):
+  return [kind(s) for s in str(options[name]).split(',') if not s == '']
+
+# All the cases in the grid, each a dictionary with the key columns
+# along with the command-line arguments for the driver
+def grid():
+  sizes = option_list('sizes', int)
+  cases = []
+  for driver in option_list('drivers', str):
+    if not driver in drivers:
+      print "ERROR: Unknown driver", driver, "... aborting"
+      sys.exit(1)
+    for n in sizes:
+      if driver.startswith('SU3'):
+        dims = (n, n, n, int(options['nt']))
+        params = option_list('betas', float)
+      else:
+        dims = (n, n, n)
+        params = option_list('gammas', float)
+      vol = reduce(lambda a, b: a * b, dims)
+
+      # Only the cluster drivers work with non-zero density
+      if driver.endswith('Cluster'):
+        baryons = [int(round(rho * vol)) for rho in
+                   option_list('densities', float)]
+        methods = [('--connect', m) for m in option_list('connect', str)]
+      else:
+        baryons = [0]
+        if driver == 'PottsMRT':
+          methods = [('--sweep', m) for m in option_list('mrt_sweep', str)]
+        else:
+          methods = [('', 'default')]
+
+      for param in params:
+        for NB in baryons:
+          for flag, method in methods:
+            case = {'driver': driver, 'vol': vol, 'param': param,
+                    'shape': dims,
+                    'dims': 'x'.join(str(d) for d in dims),
+                    'baryons': NB, 'method': method}
+            argv = [str(d) for d in dims]
+            if driver.endswith('Cluster'):
+              argv.append(str(NB))
+            argv += [str(param), str(options['sweeps']), str(options['seed'])]
+            case['argv'] = argv
+            case['flags'] = [flag, method] if not flag == '' else []
+
+            # The recounts would otherwise run after every sweep
+            if driver.endswith('Cluster'):
+              case['flags'] += ['--validate', 'off']
+            cases.append(case)
+  return cases
+
+# Run the driver for the given case with output in outdir
+# Return the wall-clock time, exit status and peak memory (in MB)
+# os.wait4 gives the resource usage of this process alone
+def launch(case, outdir):
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        case['driver'] + '.py')
+  command = [sys.executable, script] + case['argv'] + [outdir] \
+            + case['flags']
+  with open(os.devnull, 'w') as null:
+    runtime = -time.time()
+    proc = subprocess.Popen(command, stdout=null, stderr=null)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    runtime += time.time()
+  return runtime, status, usage.ru_maxrss / 1024.0
+
+# Set up the simulation for the given case in this process,
+# and do a first sweep to warm up
+def warm_sim(case):
+  lattice = Lattice(case['shape'])
+  prng = RNG(int(options['seed']))
+  if case['driver'].endswith('Cluster'):
+    sim = PottsClusterSim(lattice, case['baryons'], case['param'], prng,
+                          case['method'])
+  else:
+    sim = PottsMRTSim(lattice, case['param'], prng, case['method'])
+  sim.sweep()
+  return sim
+
+# Number of sweeps to time for the given case: at least
+# '--site-updates N' updates, and at least '--sweeps N' sweeps,
+# so the work is the same every time
+def sweep_count(case):
+  return max(int(options['sweeps']),
+             -(-int(options['site_updates']) // case['vol']))
+
+# Time count sweeps of the simulation for the given case,
+# leaving out the setup and the first sweep
+# This is repeated '--repeats N' times from the same starting point,
+# keeping the fastest (as with timeit), which is the least affected
+# by anything else running at the same time
+def time_sweeps(case, count):
+  best = None
+  for i in range(int(options['repeats'])):
+    sim = warm_sim(case)
+    start = timeit.default_timer()
+    for j in range(count):
+      sim.sweep()
+    elapsed = timeit.default_timer() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+# Run the same count sweeps as time_sweeps once more under cProfile,
+# returning the cumulative time in each list of functions
+# as a fraction of the total time in the sweeps
+def profile_sweeps(case, count, groups):
+  sim = warm_sim(case)
+  profiler = cProfile.Profile()
+  profiler.enable()
+  for j in range(count):
+    sim.sweep()
+  profiler.disable()
+  stats = pstats.Stats(profiler)
+  return [profile_fraction(stats, names) for names in groups]
+
+# Average time in microseconds for each of the three update steps
+# from timing.csv, combining the four kinds of bond updates
+def step_times(filename):
+  count = [0, 0, 0]
+  tot = [0.0, 0.0, 0.0]
+  with open(filename) as f:
+    for row in csv.DictReader(f):
+      for step, names in enumerate([['mvB'], ['mvQ'],
+                                    ['cycle', 'split', 'add', 'merge']]):
+        for name in names:
+          count[step] += int(row['n_' + name])
+          tot[step] += float(row['t_' + name])
+  return ["%.4g" % (1e6 * t / max(n, 1)) for t, n in zip(tot, count)]
+
+# Cumulative time in the given functions from cProfile statistics,
+# as a fraction of the total
+def profile_fraction(stats, names):
+  tot = 0.0
+  for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+    if func[2] in names:
+      tot += ct
+  return tot / stats.total_tt
+
+# Time one case, returning a dictionary with all the columns
+# The time per sweep in the traversals is their fraction of the
+# profiled sweeps times the fastest unprofiled time per sweep,
+# since cProfile slows everything down
+def time_case(case, tmpdir):
+  result = dict((c, case[c]) for c in key)
+  outdir = os.path.join(tmpdir, 'out')
+  runtime, status, mem = launch(case, outdir)
+  if not status == 0:
+    result['status'] = 'error'
+    return result
+
+  result['status'] = 'ok'
+  result['runtime'] = "%.4g" % runtime
+  result['peak_mem_MB'] = "%.4g" % mem
+  if not case['driver'] == 'SU3MRT':
+    count = sweep_count(case)
+    elapsed = time_sweeps(case, count)
+    result['sweeps'] = count
+    result['sweep_time'] = "%.4g" % elapsed
+    result['site_updates_per_sec'] = "%.4g" % (case['vol'] * count
+                                               / elapsed)
+    if not options['no_profile']:
+      fracs = profile_sweeps(case, count,
+                             [['check_connect', 'check_connect_both'],
+                              ['build_cluster']])
+      ms = 1e3 * elapsed / count
+      result['connect_ms_per_sweep'] = "%.4g" % (fracs[0] * ms)
+      result['build_ms_per_sweep'] = "%.4g" % (fracs[1] * ms)
+  if not options['no_profile']:
+    if case['driver'].endswith('Cluster'):
+      timed = dict(case, flags=case['flags'] + ['--timing'])
+      launch(timed, outdir)
+      times = step_times(os.path.join(outdir, 'timing.csv'))
+      for name, t in zip(['mvB_usec', 'mvQ_usec', 'bond_usec'], times):
+        result[name] = t
+  return result
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Read results file into dictionary of rows, indexed by the key columns
+def read_results(filename):
+  if not os.path.isfile(filename):
+    print "ERROR: Results file", filename, "not found... aborting"
+    sys.exit(1)
+  results = {}
+  with open(filename) as f:
+    for row in csv.DictReader(f):
+      results[tuple(row[c] for c in key)] = row
+  return results
+
+# Flag cases that have become slower, or need more memory,
+# by more than the given fraction
+# Return the number of regressions found
+def compare(old, new, tolerance):
+  regressions = 0
+  for case in sorted(new):
+    if not case in old:
+      continue
+    before = old[case]
+    after = new[case]
+    if not (before['status'] == 'ok' and after['status'] == 'ok'):
+      if before['status'] == 'ok':
+        print "REGRESSION:", ' '.join(case), "now fails"
+        regressions += 1
+      continue
+
+    # Drivers without timed sweeps are only compared for memory
+    if before['site_updates_per_sec'] and after['site_updates_per_sec']:
+      speed = float(after['site_updates_per_sec']) \
+              / float(before['site_updates_per_sec'])
+    else:
+      speed = 1.0
+    mem = float(after['peak_mem_MB']) / float(before['peak_mem_MB'])
+    flag = "ok"
+    if speed < 1.0 - tolerance or mem > 1.0 + tolerance:
+      flag = "REGRESSION"
+      regressions += 1
+    print "%-10s %-40s speed x%.3f memory x%.3f" \
+          % (flag, ' '.join(case), speed, mem)
+
+  missing = [case for case in old if not case in new]
+  if len(missing) > 0:
+    print len(missing), "cases only in old results"
+  return regressions
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+if args[1] == 'compare':
+  regressions = compare(read_results(args[2]), read_results(args[3]),
+                        float(options['tolerance']))
+  print regressions, "regressions with tolerance", options['tolerance']
+  if regressions > 0:
+    sys.exit(1)
+  sys.exit(0)
+
+# Run all cases, writing each result as soon as it is available
+cases = grid()
+tmpdir = tempfile.mkdtemp()
+RESULTS = open(args[2], 'w')
+writer = csv.DictWriter(RESULTS, columns, restval='',
+                        lineterminator='\n')
+writer.writeheader()
+try:
+  for i, case in enumerate(cases):
+    result = time_case(case, tmpdir)
+    writer.writerow(result)
+    RESULTS.flush()
+    print "%d/%d" % (i + 1, len(cases)), case['driver'], case['dims'],
+    print case['param'], case['baryons'], case['method'], result['status'],
+    print result.get('site_updates_per_sec', '')
+finally:
+  RESULTS.close()
+  shutil.rmtree(tmpdir)
+# ------------------------------------------------------------------
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+import os
+import sys
+import shutil
+import signal
+import cPickle as pickle
+import numpy as np
+# Saving and loading the full state of a simulation, so that it can resume
+#
+# Each checkpoint is a directory 'checkpoint' in the output directory,
+# holding one .npy file for each array (loaded back through memory mapping)
+# and state.pkl for everything else: the sweep number, counters,
+# PRNG state and the sizes of the output files when it was written
+# It is written atomically, first to 'checkpoint.new',
+# which then replaces the previous checkpoint (moved to 'checkpoint.old')
+# Since the drivers only save at the end of a sweep and draw the same
+# random numbers in every sweep (see rng.py), resuming from a checkpoint
+# reproduces the output of an uninterrupted run exactly
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Write the arrays (a dictionary of NumPy arrays) and the dictionary state
+# to outdir/checkpoint, making sure everything reaches the disk
+# before replacing the previous checkpoint
+def save_checkpoint(outdir, arrays, state):
+  final = os.path.join(outdir, 'checkpoint')
+  new = final + '.new'
+  old = final + '.old'
+  if os.path.isdir(new):
+    shutil.rmtree(new)
+  os.makedirs(new)
+
+  for name in arrays:
+    with open(os.path.join(new, name + '.npy'), 'wb') as f:
+      np.save(f, arrays[name])
+      f.flush()
+      os.fsync(f.fileno())
+  state = dict(state, arrays=sorted(arrays))
+  with open(os.path.join(new, 'state.pkl'), 'wb') as f:
+    pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    f.flush()
+    os.fsync(f.fileno())
+
+  # The rename is atomic, so one complete checkpoint always exists
+  if os.path.isdir(old):
+    shutil.rmtree(old)
+  if os.path.isdir(final):
+    os.rename(final, old)
+  os.rename(new, final)
+  shutil.rmtree(old, ignore_errors=True)
+
+# Read the checkpoint in outdir, returning a dictionary of read-only
+# memory-mapped arrays along with the dictionary state
+# If we were interrupted while replacing the checkpoint, use the old one
+def load_checkpoint(outdir):
+  path = os.path.join(outdir, 'checkpoint')
+  if not os.path.isdir(path):
+    path += '.old'
+  if not os.path.isfile(os.path.join(path, 'state.pkl')):
+    print "ERROR: No checkpoint found in", outdir, "... aborting"
+    sys.exit(1)
+
+  with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+    state = pickle.load(f)
+  arrays = {}
+  for name in state['arrays']:
+    arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+  return arrays, state
+
+# Writable copies of the arrays from load_checkpoint, to continue from
+def copy_arrays(arrays):
+  return dict((name, np.array(arrays[name])) for name in arrays)
+
+# Make sure we are resuming a run with the same lattice and couplings,
+# recorded as the tuple setup
+def check_resume(state, setup):
+  if not tuple(state['setup']) == tuple(setup):
+    print "ERROR: Checkpoint is for", tuple(state['setup']),
+    print "rather than", tuple(setup), "... aborting"
+    sys.exit(1)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Open an output file, starting it with the given header line
+# When resuming, sizes holds the size of each file at the checkpoint
+# Then we truncate the file to that size, discarding anything written
+# after the checkpoint, and append to it
+def open_output(filename, header, sizes=None):
+  if sizes is None:
+    f = open(filename, 'w')
+    print >> f, header
+    return f
+
+  name = os.path.basename(filename)
+  if not os.path.isfile(filename) or not name in sizes:
+    print "ERROR: Can't resume", filename, "... aborting"
+    sys.exit(1)
+  f = open(filename, 'r+')
+  f.truncate(sizes[name])
+  f.seek(0, os.SEEK_END)
+  return f
+
+# Flush the given output files to disk, returning their sizes
+# for the checkpoint
+def output_sizes(files):
+  sizes = {}
+  for f in files:
+    f.flush()
+    os.fsync(f.fileno())
+    sizes[os.path.basename(f.name)] = f.tell()
+  return sizes
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# On SIGTERM (e.g. from a batch queue) finish the current sweep,
+# save a checkpoint and stop, rather than losing all progress
+# The drivers check terminated() at the end of each sweep
+received = {'SIGTERM': False}
+
+def handle_sigterm(signum, frame):
+  received['SIGTERM'] = True
+
+def catch_sigterm():
+  signal.signal(signal.SIGTERM, handle_sigterm)
+
+def terminated():
+  return received['SIGTERM']
+# ------------------------------------------------------------------
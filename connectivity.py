@@ -0,0 +1,397 @@
+#!/usr/bin/python
+import random
+import numpy as np
+# Fully dynamic connectivity for the bonds of the triality cluster algorithm
+# Follows Holm, de Lichtenberg and Thorup (HDT), J. ACM 48 (2001) 723,
+# answering whether removing a bond splits its cluster
+# in polylogarithmic amortized time, without traversing the cluster
+#
+# Each bond present in the lattice has a level between 0 and Lmax = log2(vol)
+# For each level i we keep a spanning forest F_i of the bonds with level >= i,
+# so that F_0 spans all clusters, and each tree of F_i has <= vol / 2^i sites
+# Bonds in these forests are 'tree' bonds, the rest are 'non-tree' bonds
+# Each tree is stored as an Euler tour, held in a treap ordered by position
+# The tour contains one node for each site and two for each tree bond,
+# one for each direction in which the bond is crossed
+#
+# Bonds are labelled by the integer edge = site * Ndim + direction
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Treap node for Euler tours
+# site is -1 for the two nodes of each tree bond
+# Each node also sums the following over its subtree:
+#   nsite counts sites (giving cluster sizes at the root)
+#   nq counts quarks (only used in F_0)
+#   ntree counts sites with tree bonds at exactly this level
+#   nnon counts sites with non-tree bonds at exactly this level
+class Node(object):
+  __slots__ = ('left', 'right', 'parent', 'prio', 'site', 'q',
+               'tflag', 'nflag', 'nsite', 'nq', 'ntree', 'nnon')
+
+  def __init__(self, site, prio):
+    self.left = None
+    self.right = None
+    self.parent = None
+    self.prio = prio
+    self.site = site
+    self.q = 0
+    self.tflag = 0
+    self.nflag = 0
+    self.nsite = 1 if site >= 0 else 0
+    self.nq = 0
+    self.ntree = 0
+    self.nnon = 0
+
+# Recompute sums for the subtree of the given node from its children
+def update(n):
+  nsite = 1 if n.site >= 0 else 0
+  nq = n.q
+  ntree = n.tflag
+  nnon = n.nflag
+  for child in (n.left, n.right):
+    if child is not None:
+      nsite += child.nsite
+      nq += child.nq
+      ntree += child.ntree
+      nnon += child.nnon
+  n.nsite = nsite
+  n.nq = nq
+  n.ntree = ntree
+  n.nnon = nnon
+
+# Recompute sums after changing a node, all the way up to its root
+def refresh(n):
+  while n is not None:
+    update(n)
+    n = n.parent
+
+def find_root(n):
+  while n.parent is not None:
+    n = n.parent
+  return n
+
+# Concatenate the tours held in the treaps with roots a and b
+def merge(a, b):
+  if a is None:
+    return b
+  if b is None:
+    return a
+  if a.prio > b.prio:
+    a.right = merge(a.right, b)
+    a.right.parent = a
+    update(a)
+    return a
+  else:
+    b.left = merge(a, b.left)
+    b.left.parent = b
+    update(b)
+    return b
+
+# Split the tour containing n into the part before n and the part from n on
+# Work up from n to the root, collecting the left and right parts
+def split_before(n):
+  L = n.left
+  if L is not None:
+    L.parent = None
+  n.left = None
+  R = n
+  x = n
+  p = n.parent
+  n.parent = None
+  update(n)
+  while p is not None:
+    gp = p.parent
+    p.parent = None
+    if p.right is x:      # p and its left subtree come before n
+      p.right = L
+      if L is not None:
+        L.parent = p
+      update(p)
+      L = p
+    else:                 # p and its right subtree come after n
+      p.left = R
+      R.parent = p
+      update(p)
+      R = p
+    x = p
+    p = gp
+  return L, R
+
+# Split the tour containing n into the part up to n and the part after n
+def split_after(n):
+  R = n.right
+  if R is not None:
+    R.parent = None
+  n.right = None
+  L = n
+  x = n
+  p = n.parent
+  n.parent = None
+  update(n)
+  while p is not None:
+    gp = p.parent
+    p.parent = None
+    if p.left is x:       # p and its right subtree come after n
+      p.left = R
+      if R is not None:
+        R.parent = p
+      update(p)
+      R = p
+    else:                 # p and its left subtree come before n
+      p.right = L
+      L.parent = p
+      update(p)
+      L = p
+    x = p
+    p = gp
+  return L, R
+
+# Remove the single node n from its tour, returning the two remaining parts
+def remove(n):
+  L, R = split_before(n)
+  n, R = split_after(n)
+  return L, R
+
+# Find some site node in the subtree of n whose flag is set,
+# where flag is 'tflag' for tree bonds or 'nflag' for non-tree bonds
+# and total is the corresponding subtree sum 'ntree' or 'nnon'
+def find_flagged(n, flag, total):
+  while not getattr(n, flag):
+    if n.left is not None and getattr(n.left, total) > 0:
+      n = n.left
+    else:
+      n = n.right
+  return n
+
+# List all sites in the tour with root n
+def tour_sites(n):
+  sites = []
+  stack = [n]
+  while len(stack) > 0:
+    n = stack.pop()
+    if n.site >= 0:
+      sites.append(n.site)
+    if n.left is not None:
+      stack.append(n.left)
+    if n.right is not None:
+      stack.append(n.right)
+  return sites
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+class DynamicConnectivity(object):
+  # Start from vol single-site clusters with no bonds,
+  # and the given occupation numbers for the sites
+  def __init__(self, neighbor, Ndim, occupation):
+    self.neighbor = neighbor
+    self.Ndim = Ndim
+    self.vol = len(neighbor)
+    self.Lmax = max(self.vol.bit_length() - 1, 0)
+
+    # Treap priorities only affect performance, not results
+    self.prio = random.Random(0)
+
+    # Level of each bond present in the lattice
+    self.level = {}
+
+    # For each level i:
+    #   vnodes[i][site] is the tour node of the site in F_i
+    #     (created when first needed, otherwise it's a single-site tree)
+    #   enodes[i][edge] are the two tour nodes of each tree bond in F_i
+    #   treeadj[i][site] is the set of tree bonds with level exactly i
+    #   nontree[i][site] is the set of non-tree bonds with level exactly i
+    levels = range(self.Lmax + 1)
+    self.vnodes = [dict() for i in levels]
+    self.enodes = [dict() for i in levels]
+    self.treeadj = [dict() for i in levels]
+    self.nontree = [dict() for i in levels]
+
+    # Quarks are only counted in F_0
+    for site in range(self.vol):
+      n = self.vnode(0, site)
+      n.q = int(occupation[site])
+      update(n)
+
+  # ----------------------------------------------------------------
+  # Sites at either end of the given bond
+  def ends(self, edge):
+    site = edge // self.Ndim
+    return site, int(self.neighbor[site][edge % self.Ndim])
+
+  def vnode(self, i, site):
+    n = self.vnodes[i].get(site)
+    if n is None:
+      n = Node(site, self.prio.random())
+      self.vnodes[i][site] = n
+    return n
+
+  # Update the tree and non-tree flags of the given site at level i
+  def set_flags(self, i, site):
+    n = self.vnode(i, site)
+    tflag = 1 if self.treeadj[i].get(site) else 0
+    nflag = 1 if self.nontree[i].get(site) else 0
+    if not (tflag == n.tflag and nflag == n.nflag):
+      n.tflag = tflag
+      n.nflag = nflag
+      refresh(n)
+
+  # Add or remove a bond in the given adjacency table (treeadj or nontree)
+  # for both of its end sites at level i
+  def add_adj(self, table, i, edge, u, v):
+    for site in (u, v):
+      table[i].setdefault(site, set()).add(edge)
+      self.set_flags(i, site)
+
+  def remove_adj(self, table, i, edge, u, v):
+    for site in (u, v):
+      table[i][site].discard(edge)
+      self.set_flags(i, site)
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Euler tour operations on the forest F_i
+  # Rotate the tour containing n so that it starts from n
+  def reroot(self, n):
+    L, R = split_before(n)
+    return merge(R, L)
+
+  # Join the trees of u and v by the tree bond edge
+  def link(self, i, edge, u, v):
+    tu = self.reroot(self.vnode(i, u))
+    tv = self.reroot(self.vnode(i, v))
+    a = Node(-1, self.prio.random())
+    b = Node(-1, self.prio.random())
+    self.enodes[i][edge] = (a, b)
+    merge(merge(tu, a), merge(tv, b))
+
+  # Remove the tree bond edge, splitting its tree in two
+  # The tour between the two bond nodes becomes one tree,
+  # while the parts before and after are joined into the other
+  def cut(self, i, edge):
+    a, b = self.enodes[i].pop(edge)
+    L, R = remove(a)
+    if R is not None and find_root(b) is R:
+      M, R = remove(b)
+    else:
+      L, M = remove(b)
+    merge(L, R)
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Check whether sites u and v are in the same cluster
+  def connected(self, u, v):
+    if u == v:
+      return True
+    tu = find_root(self.vnodes[0][u])
+    return tu is find_root(self.vnodes[0][v])
+
+  # Number of sites and number of quarks in the cluster containing site
+  def cluster_size(self, site):
+    return find_root(self.vnodes[0][site]).nsite
+
+  def quarks(self, site):
+    return find_root(self.vnodes[0][site]).nq
+
+  # Keep quark counts current when the occupation of site changes by dq
+  def add_quarks(self, site, dq):
+    n = self.vnodes[0][site]
+    n.q += int(dq)
+    refresh(n)
+
+  # List all sites in the cluster containing site
+  def cluster_sites(self, site):
+    return tour_sites(find_root(self.vnodes[0][site]))
+
+  # Root, size and quark arrays in the form used by utils.count_clusters,
+  # pointing each site directly to one site of its cluster
+  def roots(self):
+    root = np.empty(self.vol, dtype=np.int32)
+    size = np.zeros(self.vol, dtype=np.int32)
+    quarks = np.zeros(self.vol, dtype=np.int32)
+    done = np.zeros(self.vol, dtype=bool)
+    for site in range(self.vol):
+      if not done[site]:
+        cluster = self.cluster_sites(site)
+        root[cluster] = site
+        size[site] = len(cluster)
+        quarks[site] = self.quarks(site)
+        done[cluster] = True
+    return root, size, quarks
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Add a new bond, at level 0
+  # It becomes a tree bond if it joins two different clusters
+  def insert(self, edge):
+    u, v = self.ends(edge)
+    self.level[edge] = 0
+    if self.connected(u, v):
+      self.add_adj(self.nontree, 0, edge, u, v)
+    else:
+      self.add_adj(self.treeadj, 0, edge, u, v)
+      self.link(0, edge, u, v)
+
+  # Remove a bond, looking for a replacement if it was a tree bond
+  # Returning +1 means the cluster remains connected
+  # Returning -1 means the cluster has been split in two
+  def delete(self, edge):
+    u, v = self.ends(edge)
+    lev = self.level.pop(edge)
+    if not edge in self.enodes[lev]:
+      self.remove_adj(self.nontree, lev, edge, u, v)
+      return 1
+
+    self.remove_adj(self.treeadj, lev, edge, u, v)
+    for i in range(lev + 1):
+      self.cut(i, edge)
+
+    # Look for a replacement bond, starting from the highest level
+    for i in range(lev, -1, -1):
+      small = find_root(self.vnode(i, u))
+      other = find_root(self.vnode(i, v))
+      if small.nsite > other.nsite:
+        small = other
+
+      # Move all tree bonds of the smaller tree up a level
+      # This keeps each tree in F_(i+1) at most half as big as in F_i
+      while small.ntree > 0:
+        x = find_flagged(small, 'tflag', 'ntree').site
+        for f in list(self.treeadj[i][x]):
+          fu, fv = self.ends(f)
+          self.remove_adj(self.treeadj, i, f, fu, fv)
+          self.add_adj(self.treeadj, i + 1, f, fu, fv)
+          self.level[f] = i + 1
+          self.link(i + 1, f, fu, fv)
+
+      # Check the non-tree bonds of the smaller tree
+      # Either they reconnect the two trees, or they move up a level
+      while small.nnon > 0:
+        x = find_flagged(small, 'nflag', 'nnon').site
+        for f in list(self.nontree[i][x]):
+          fu, fv = self.ends(f)
+          self.remove_adj(self.nontree, i, f, fu, fv)
+          y = fv if fu == x else fu
+          if find_root(self.vnode(i, y)) is small:
+            self.add_adj(self.nontree, i + 1, f, fu, fv)
+            self.level[f] = i + 1
+          else:               # Found a replacement tree bond
+            self.add_adj(self.treeadj, i, f, fu, fv)
+            self.level[f] = i
+            for j in range(i + 1):
+              self.link(j, f, fu, fv)
+            return 1
+
+    # No replacement found
+    return -1
+# ------------------------------------------------------------------
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+import os
+from utils import validate_sweep
+from checkpoint import *
+from series import open_series
+from analysis import OnlineAnalysis
+# The loop over sweeps shared by the drivers (PottsCluster.py, PottsMRT.py,
+# batch.py, ensemble.py and tempering.py), with the output of the
+# observables, their online analysis, validation, checkpoints and SIGTERM
+#
+# Driver takes a simulation from potts.py, or anything else with
+#   sweep(), validate(), measure(), get_state() and nsweep
+# along with the lists outputs and tracked (see potts.py)
+# The observables from measure() are written to out_dir, or, if dirs
+# lists several subdirectories of out_dir, measure() returns a list
+# of dictionaries of observables to be written to each of them
+# (as for PottsMRTBatch, or one gamma of ReplicaExchange in tempering.py)
+#
+# The checkpoint records the sizes of the output files and the state
+# of the analysis, for a single output directory directly,
+# or else in dictionaries indexed by the subdirectory
+# (with '.' for other files in out_dir itself)
+# Checkpoints from batch.py before it used Driver hold lists instead,
+# in the order of the subdirectories, which are still read
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# options are those of the driver, with 'output', 'flush_every',
+# 'validate_every' and 'checkpoint_every' as for PottsMRT.py,
+# and optionally 'validate', 'therm' and 'target_error'
+# (with which each checkpoint records whether it was reached)
+# setup identifies the run, as for check_resume
+# When resuming, state is the state from the checkpoint,
+# already restored in sim
+# Without analyze the observables are not analyzed
+# Messages go to PARAMS, and also to stdout if verbose
+class Driver(object):
+  def __init__(self, sim, outdir, options, setup, PARAMS, state=None,
+               dirs=None, analyze=True, verbose=True):
+    self.sim = sim
+    self.outdir = outdir
+    self.options = options
+    self.setup = setup
+    self.PARAMS = PARAMS
+    self.resume = state is not None
+    self.single = dirs is None
+    self.verbose = verbose
+    self.after = None
+    self.converged = False
+    self.extra = []
+    if self.single:
+      dirs = ['.']
+    self.dirs = dirs
+    self.sizes = None
+    saved_analysis = None
+    if self.resume:
+      self.sizes = state['outputs']
+      saved_analysis = state.get('analysis')
+      if self.single:
+        self.sizes = {'.': self.sizes}
+        if saved_analysis is not None:
+          saved_analysis = {'.': saved_analysis}
+      if isinstance(self.sizes, list):
+        self.sizes = dict(zip(dirs, self.sizes))
+      if isinstance(saved_analysis, list):
+        saved_analysis = dict(zip(dirs, saved_analysis))
+
+    # Open files for output, with one column for each observable,
+    # in csv files and/or observables.npy
+    self.series = []
+    self.files = {'.': []}
+    for name in dirs:
+      path = os.path.join(outdir, name)
+      if not os.path.isdir(path):
+        os.makedirs(path)
+      series = open_series(path, sim.outputs, options['output'],
+                           options['flush_every'], self.dir_sizes(name))
+      self.series.append(series)
+      self.files.setdefault(name, [])
+      for out in series:
+        self.files[name] += out.files
+
+    # Analyze the tracked observables as we go,
+    # continuing from the checkpoint when resuming
+    # (or starting over, if the checkpoint doesn't include the analysis)
+    self.analysis = []
+    if analyze:
+      for name in dirs:
+        analysis = OnlineAnalysis(sim.tracked, options.get('therm', 0))
+        if saved_analysis is not None:
+          analysis.set_state(saved_analysis[name])
+        self.analysis.append(analysis)
+
+  # Sizes of the files in the given subdirectory at the checkpoint
+  def dir_sizes(self, name):
+    if self.sizes is None:
+      return None
+    return self.sizes.get(name)
+
+  # Open another output file in out_dir, with the given header,
+  # whose size is also recorded in the checkpoint
+  # If resuming a run that didn't write it, start it from scratch
+  def open_output(self, filename, header):
+    sizes = self.dir_sizes('.')
+    if sizes is None or not filename in sizes:
+      f = open_output(os.path.join(self.outdir, filename), header)
+    else:
+      f = open_output(os.path.join(self.outdir, filename), "", sizes)
+    self.files['.'].append(f)
+    self.extra.append(f)
+    return f
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Record the observables after the given sweep
+  # (with no acceptance before the first sweep),
+  # then call after(sweep) if set, for any other output
+  def record(self, sweep):
+    results = self.sim.measure()
+    if self.single:
+      results = [results]
+    for k, obs in enumerate(results):
+      if sweep == 0:
+        for name in obs.keys():
+          if name.startswith('accept'):
+            del obs[name]
+      for out in self.series[k]:
+        out.record(sweep, obs)
+      if len(self.analysis) > 0:
+        self.analysis[k].record(sweep, obs)
+    if self.after is not None:
+      self.after(sweep)
+
+  # Save the full state of the simulation along with the sizes
+  # of the output files and the analysis, and write summary.csv
+  def checkpoint(self, sweep):
+    arrays, state = self.sim.get_state()
+    sizes = dict((name, output_sizes(self.files[name]))
+                 for name in self.files)
+    analysis = dict((name, a.get_state())
+                    for name, a in zip(self.dirs, self.analysis))
+    if self.single:
+      sizes = sizes['.']
+      analysis = analysis.get('.')
+    state.update({'setup': self.setup, 'sweep': sweep, 'outputs': sizes})
+    if len(self.analysis) > 0:
+      state['analysis'] = analysis
+    if 'target_error' in self.options:
+      state['converged'] = self.converged
+    save_checkpoint(self.outdir, arrays, state)
+    self.write_summaries()
+
+  def write_summaries(self):
+    for name, analysis in zip(self.dirs, self.analysis):
+      analysis.write(os.path.join(self.outdir, name, 'summary.csv'))
+
+  # The message in params.txt defaults to the one printed
+  def message(self, text, params=None):
+    if self.verbose:
+      print text
+    if params is None:
+      params = text
+    print >> self.PARAMS, params
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Run up to sweep Nsweep, validating the stored information
+  # as often as requested (options['validate'], by default every
+  # options['validate_every'] sweeps) and recording the observables
+  # after each sweep, starting with sweep 0 unless resuming
+  # The full state is saved every options['checkpoint_every'] sweeps,
+  # after the last sweep, and before stopping on SIGTERM
+  # or on reaching options['target_error'], along with summary.csv
+  # Afterwards converged records whether the target error was reached
+  def run(self, Nsweep):
+    level = self.options.get('validate', 'sampled')
+    validate = self.options['validate_every']
+    if validate_sweep(level, validate, 0):
+      self.sim.validate()
+    if not self.resume:
+      self.record(0)
+
+    target = self.options.get('target_error', 0.0)
+    every = self.options['checkpoint_every']
+    for sweep in range(self.sim.nsweep + 1, Nsweep + 1):
+      self.sim.sweep()
+      if validate_sweep(level, validate, sweep):
+        self.sim.validate()
+      self.record(sweep)
+
+      # Check whether we have reached the target error
+      self.converged = target > 0 and len(self.analysis) > 0 \
+                       and all(a.converged(target) for a in self.analysis)
+
+      if (every > 0 and sweep % every == 0) or sweep == Nsweep \
+                                             or terminated() \
+                                             or self.converged:
+        self.checkpoint(sweep)
+      if self.converged:
+        self.message("Reached target error after sweep %d" % sweep)
+        break
+      if terminated():
+        self.message("Stopping after sweep %d on SIGTERM" % sweep,
+                     "Stopped after sweep %d on SIGTERM" % sweep)
+        break
+
+  def close(self):
+    for series in self.series:
+      for out in series:
+        out.close()
+    for f in self.extra:
+      f.close()
+    self.write_summaries()
+# ------------------------------------------------------------------
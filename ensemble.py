@@ -0,0 +1,251 @@
+#!/usr/bin/python
+import os
+import sys
+import csv
+import time
+import itertools
+import multiprocessing
+from utils import parse_options, validation_levels
+from lattice import Lattice
+from potts import PottsClusterSim
+from rng import RNG, generators, spawn_seeds
+from checkpoint import *
+from series import output_formats
+from driver import Driver
+# ------------------------------------------------------------------
+# Run an ensemble of triality cluster simulations of the Potts model,
+# as in PottsCluster.py, over a grid of baryon numbers and couplings
+# with several independent replicas for each, using a pool of processes
+
+# Parse arguments: 3d lattice volume,
+# comma-separated lists of baryon numbers and Potts couplings gamma,
+# number of replicas for each (baryons, gamma), number of sweeps to do,
+# RNG seed and directory for output data
+# Each point of the grid runs in its own subdirectory of out_dir,
+# with the same output files as PottsCluster.py
+# Each point gets an independent stream of random numbers spawned from
+# random_seed (see spawn_seeds in rng.py), numbered in the order
+# baryons, then gamma, then replica
+# Optionally '--workers N' sets the number of processes (by default
+# one for each core), each of which runs one point at a time
+# Points that have already been completed are skipped, so running
+# the same command again continues an interrupted ensemble
+# Points are checkpointed every '--checkpoint-every N' sweeps,
+# at the end and on SIGTERM, and continue from their last checkpoint
+# Points that reach the '--target-error X' (see PottsCluster.py)
+# stop there, and count as completed
+# The other options are the same as for PottsCluster.py
+args, options = parse_options(sys.argv, {'workers': 0,
+                                         'connect': 'search',
+                                         'validate': 'strict',
+                                         'validate_every': 10,
+                                         'rng': 'legacy',
+                                         'output': 'csv',
+                                         'flush_every': 1000,
+                                         'therm': 0,
+                                         'target_error': 0.0,
+                                         'checkpoint_every': 0})
+if len(args) < 10 or not options['connect'] in ['search', 'dynamic'] \
+                  or not options['validate'] in validation_levels \
+                  or not options['rng'] in generators \
+                  or not options['output'] in output_formats:
+  print "Usage:", str(args[0]), "<nx> <ny> <nz> <baryons,...> <gamma,...>"
+  print "                   <replicas> <sweeps> <random_seed> <out_dir>"
+  print "                   [--workers N] [--connect search|dynamic]"
+  print "                   [--validate off|sampled|strict]"
+  print "                   [--validate-every N]"
+  print "                   [--rng legacy|pcg64|philox]"
+  print "                   [--output csv|binary|both] [--flush-every N]"
+  print "                   [--therm N] [--target-error X]"
+  print "                   [--checkpoint-every N]"
+  sys.exit(1)
+dims = (int(args[1]), int(args[2]), int(args[3]))
+baryons = [int(s) for s in args[4].split(',')]
+gammas = [float(s) for s in args[5].split(',')]
+Nrep = int(args[6])
+Nsweep = int(args[7])
+seed = int(args[8])
+outdir = args[9]
+workers = options['workers']
+if workers < 1:
+  workers = multiprocessing.cpu_count()
+
+# Quick sanity check: Make sure all NB baryons can fit on the lattice
+vol = dims[0] * dims[1] * dims[2]
+if max(baryons) > 2 * vol:
+  print "ERROR: Cannot fit", max(baryons), "baryons in",
+  print " x ".join(str(n) for n in dims), "lattice...",
+  print "aborting"
+  sys.exit(1)
+
+# Create output directory if it doesn't exist already
+if not os.path.isdir(outdir):
+  print "Creating directory", outdir, "for output"
+  os.makedirs(outdir)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Each process sets up the lattice once, for all the points it runs
+lattices = {}
+
+def get_lattice(dims):
+  if not dims in lattices:
+    lattices[dims] = Lattice(dims)
+  return lattices[dims]
+
+# The setup recorded in the checkpoint of each point includes
+# the ensemble seed and the index of the point,
+# which identify its stream of random numbers
+def point_setup(point):
+  return dims + (point['baryons'], point['gamma'], seed, point['point'],
+                 generator)
+
+def has_checkpoint(pointdir):
+  return os.path.isdir(os.path.join(pointdir, 'checkpoint')) \
+         or os.path.isdir(os.path.join(pointdir, 'checkpoint.old'))
+
+# Workers finish the current sweep and save a checkpoint on SIGTERM
+def start_worker():
+  catch_sigterm()
+
+# Run one point, as PottsCluster.py would, continuing from its checkpoint
+# if there is one, and return a dictionary summarizing it for the index
+# point holds the index of the point and its parameters,
+# along with its seed from spawn_seeds
+def run_point(point):
+  pointdir = os.path.join(outdir, point['dir'])
+  summary = dict((key, point[key]) for key in ['point', 'dir', 'baryons',
+                                               'gamma', 'replica'])
+  if terminated():                  # Don't start any more points
+    summary['status'] = 'pending'
+    return summary
+  if not os.path.isdir(pointdir):
+    os.makedirs(pointdir)
+  runtime = -time.time()
+
+  # Set up the simulation, replacing it by the checkpoint if there is one
+  prng = RNG(point['seed'], options['rng'])
+  lattice = get_lattice(dims)
+  sim = PottsClusterSim(lattice, point['baryons'], point['gamma'], prng,
+                        options['connect'])
+  state = None
+  setup = point_setup(point)
+  resume = has_checkpoint(pointdir)
+  if resume:
+    saved, state = load_checkpoint(pointdir)
+    check_resume(state, setup)
+    if state['sweep'] >= Nsweep or state.get('converged', False):
+      summary.update({'status': 'done', 'sweeps': state['sweep']})
+      return summary
+    sim.set_state(saved, state)
+
+  # Save run parameters for posterity
+  # (appending to them if we are resuming an earlier run)
+  if resume:
+    PARAMS = open(pointdir + '/params.txt', 'a')
+    print >> PARAMS, "Resuming after sweep", sim.nsweep
+  else:
+    PARAMS = open(pointdir + '/params.txt', 'w')
+    print >> PARAMS, "python", ' '.join(sys.argv)
+    print >> PARAMS, "Point", point['point'], "with", point['baryons'],
+    print >> PARAMS, "baryons, gamma", point['gamma'],
+    print >> PARAMS, "and replica", point['replica']
+    print >> PARAMS, "Random number generator:", prng.generator
+
+  # Run as in PottsCluster.py (see driver.py), leaving messages to
+  # params.txt, since the workers share stdout
+  driver = Driver(sim, pointdir, options, setup, PARAMS, state,
+                  verbose=False)
+  driver.run(Nsweep)
+  driver.close()
+  runtime += time.time()
+  print >> PARAMS, "Runtime: %0.1f seconds" % runtime
+  PARAMS.close()
+
+  if sim.nsweep >= Nsweep or driver.converged:
+    status = 'done'
+  else:
+    status = 'stopped'
+  summary.update({'status': status, 'sweeps': sim.nsweep,
+                  'runtime': "%.1f" % runtime})
+  return summary
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Set up all the points of the grid, each with its own seed
+# The directory names give gamma in full (repr), so that distinct gammas
+# never share a directory
+points = []
+for NB in baryons:
+  for gamma in gammas:
+    for rep in range(Nrep):
+      points.append({'point': len(points), 'baryons': NB, 'gamma': gamma,
+                     'replica': rep,
+                     'dir': "NB%d_g%r_r%d" % (NB, gamma, rep)})
+if not len(set(point['dir'] for point in points)) == len(points):
+  print "ERROR: Repeated baryon number or gamma... aborting"
+  sys.exit(1)
+seeds = spawn_seeds(seed, options['rng'], len(points))
+for point, child in zip(points, seeds):
+  point['seed'] = child
+
+# Make sure any existing checkpoints come from the same ensemble
+# before starting the workers, which would otherwise abort one by one
+generator = RNG(seed, options['rng']).generator
+for point in points:
+  pointdir = os.path.join(outdir, point['dir'])
+  if has_checkpoint(pointdir):
+    saved, state = load_checkpoint(pointdir)
+    check_resume(state, point_setup(point))
+
+# Summary index with one line for each point, rewritten as each finishes
+# Points not yet run keep the runtime from an earlier index, if any
+columns = ['point', 'dir', 'baryons', 'gamma', 'replica', 'status',
+           'sweeps', 'runtime']
+index = {}
+if os.path.isfile(outdir + '/index.csv'):
+  with open(outdir + '/index.csv') as f:
+    for row in csv.DictReader(f):
+      index[row['dir']] = row
+
+def write_index(summaries):
+  with open(outdir + '/index.csv', 'w') as f:
+    writer = csv.DictWriter(f, columns, restval='', lineterminator='\n')
+    writer.writeheader()
+    for point in points:
+      row = summaries.get(point['dir'])
+      if row is None:
+        row = dict((key, point[key]) for key in columns if key in point)
+        row['status'] = 'pending'
+      writer.writerow(row)
+
+# Run all points, with points already completed skipped by run_point
+# The parent process also waits for the workers to stop on SIGTERM
+runtime = -time.time()
+catch_sigterm()
+summaries = {}
+if workers == 1:
+  results = itertools.imap(run_point, points)
+else:
+  pool = multiprocessing.Pool(workers, start_worker)
+  results = pool.imap_unordered(run_point, points)
+for summary in results:
+  if summary['status'] == 'done' and not 'runtime' in summary \
+                                 and summary['dir'] in index:
+    summary['runtime'] = index[summary['dir']]['runtime']
+  summaries[summary['dir']] = summary
+  write_index(summaries)
+  print "Point", summary['point'], summary['dir'], summary['status']
+if workers > 1:
+  pool.close()
+  pool.join()
+
+done = len([s for s in summaries.values() if s['status'] == 'done'])
+runtime += time.time()
+print done, "of", len(points), "points done"
+print "Runtime: %0.1f seconds" % runtime
+# ------------------------------------------------------------------
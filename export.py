@@ -0,0 +1,44 @@
+#!/usr/bin/python
+import os
+import sys
+import numpy as np
+from potts import PottsClusterSim, PottsMRTSim
+from series import BinaryOutput, export_csv
+# ------------------------------------------------------------------
+# Write the csv files for the observables that PottsCluster.py
+# or PottsMRT.py saved in observables.npy with '--output binary',
+# exactly as they would have been written with '--output csv'
+
+# Parse arguments: directory holding observables.npy
+# and optionally a different directory for the csv files
+if len(sys.argv) < 2:
+  print "Usage:", str(sys.argv[0]), "<out_dir> [csv_dir]"
+  sys.exit(1)
+outdir = sys.argv[1]
+if len(sys.argv) > 2:
+  csvdir = sys.argv[2]
+else:
+  csvdir = outdir
+
+filename = outdir + '/' + BinaryOutput.filename
+if not os.path.isfile(filename):
+  print "ERROR:", filename, "not found... aborting"
+  sys.exit(1)
+data = np.load(filename, mmap_mode='r')
+
+# Figure out which driver wrote the file from its observables
+outputs = None
+for sim in [PottsClusterSim, PottsMRTSim]:
+  columns = sum([cols for name, cols, form in sim.outputs], [])
+  if list(data.dtype.names) == ['sweep'] + columns:
+    outputs = sim.outputs
+if outputs is None:
+  print "ERROR: Unrecognized observables", data.dtype.names, "... aborting"
+  sys.exit(1)
+
+if not os.path.isdir(csvdir):
+  print "Creating directory", csvdir, "for output"
+  os.makedirs(csvdir)
+export_csv(data, outputs, csvdir)
+print "Wrote", len(outputs), "files with", len(data), "sweeps to", csvdir
+# ------------------------------------------------------------------
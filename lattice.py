@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import numpy as np
+from utils import neighbor_table, site_coords
+# Lattice geometry shared by the simulations in potts.py
+#
+# A Lattice holds everything that depends only on the lattice extents:
+# the volume, the (int32) neighbor table and the scratch space
+# used by the cluster traversals in utils.py
+# It can be set up once and reused by any number of simulations
+# in the same process, as long as they don't run at the same time
+# (the traversals share the visited array and its generation counter)
+#
+# Lattice objects can also be indexed like the 'lattice' dictionaries
+# passed to the routines in utils.py, e.g. lattice['neighbor']
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+class Lattice(object):
+  __slots__ = ('dims', 'Ndim', 'Ndir', 'vol', 'neighbor',
+               'visited', 'generation')
+
+  # dims = (nx, ny, nz, ...) in any number of dimensions
+  def __init__(self, dims):
+    self.dims = tuple(int(n) for n in dims)
+    self.Ndim = len(self.dims)                # Number of dimensions
+    self.Ndir = 2 * self.Ndim                 # Forward and backward
+    self.vol = int(np.prod(self.dims))
+
+    # Tabulate the neighbors of each site in all Ndir directions
+    self.neighbor = neighbor_table(self.dims)
+
+    # Scratch space for cluster traversals in utils.py,
+    # marking visited sites by generation rather than clearing between calls
+    self.visited = np.zeros(self.vol, dtype=np.uint32)
+    self.generation = 0
+
+  # Access attributes as lattice['neighbor'] for the routines in utils.py
+  # (using the built-in attribute access directly, since these are called
+  #  several times for each update)
+  __getitem__ = object.__getattribute__
+  __setitem__ = object.__setattr__
+
+  # Individual extents, used by utils.site_index
+  @property
+  def nx(self):
+    return self.dims[0]
+
+  @property
+  def ny(self):
+    return self.dims[1]
+
+  @property
+  def nz(self):
+    return self.dims[2]
+
+  @property
+  def nt(self):
+    return self.dims[3]
+
+  # Arrays [x, y, z, ...] with the coordinates of each site,
+  # computed when needed rather than stored
+  def coords(self):
+    return site_coords(self.dims)
+
+  # Lists of the sites on the even and odd sublattices,
+  # for which all neighbors are on the other sublattice
+  # This requires even extents in all directions
+  def sublattices(self):
+    for n in self.dims:
+      if not n % 2 == 0:
+        raise ValueError("Sublattices need even extents, not %s"
+                         % str(self.dims))
+    parity = sum(self.coords()) % 2
+    return [np.nonzero(parity == 0)[0], np.nonzero(parity == 1)[0]]
+# ------------------------------------------------------------------
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+import atexit
+import signal
+import multiprocessing
+import numpy as np
+from utils import check_potts
+from potts import PottsMRTSim
+from rng import RNG, spawn_seeds
+# Checkerboard sweeps of the zero-density Potts model (PottsMRT.py)
+# shared between several worker processes
+#
+# The configuration lives in shared memory (a multiprocessing RawArray,
+# viewed as a NumPy array), and the lattice is split into slabs
+# of consecutive z, with one worker process for each slab
+# Each sweep updates the two checkerboard sublattices in turn:
+# every worker updates the sites of the current sublattice in its slab,
+# and waits for the others to finish before the next sublattice
+# Since no two neighbors are on the same sublattice, the workers
+# never change a site that another one is reading
+# The parent process sends each phase to all workers through pipes
+# and waits for all of their replies, which serves as the barrier
+#
+# Each worker has its own stream of random numbers spawned from the seed
+# (see spawn_seeds in rng.py), drawing them for the sites of its slab,
+# so results are reproducible for a given seed and number of workers
+# (but differ from those of a single process)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Each worker updates the sites lo <= i < hi, with sublattice the list of
+# the sites on each sublattice in this slab
+# It starts by assigning random states to these sites, then waits for
+#   ('phase', p)            Update sublattice p, returning the number of
+#                           changes accepted
+#   ('count', None)         Return the number of sites in each state and
+#                           the number of aligned pairs (with forward
+#                           neighbors), once no worker is updating
+#   ('get_rng', None)       Return the state of the RNG
+#   ('set_rng', state)      Restore it
+# The parent handles SIGTERM and SIGINT, so the workers ignore them,
+# finishing instead when the parent closes its end of the pipe
+# The parent's ends of the pipes to this and earlier workers are inherited
+# and closed here, so that they don't keep those workers running
+def slab_worker(conn, inherited, shared, neighbor, Ndim, lo, hi, sublattice,
+                gamma, seed, generator, Nstate):
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  for other in inherited:
+    other.close()
+  config = np.frombuffer(shared, dtype=np.uint8)
+  prng = RNG(seed, generator)
+  neigh = [neighbor[sites] for sites in sublattice]
+  forward = neighbor[lo:hi, :Ndim]
+  config[lo:hi] = prng.integers(0, Nstate, size=hi - lo)
+  conn.send(None)
+
+  while True:
+    try:
+      command, arg = conn.recv()
+    except EOFError:
+      return
+    if command == 'phase':
+      p = arg
+      sites = sublattice[p]
+      cur = config[sites]
+      new = prng.integers(0, Nstate, size=len(sites)).astype(np.uint8)
+      near = config[neigh[p]]
+
+      # As in PottsMRTSim.checkerboard_sweep
+      diff = gamma * (np.sum(near == new[:, None], axis=1)
+                      - np.sum(near == cur[:, None], axis=1))
+      ok = prng.uniform(size=len(sites)) < np.exp(np.minimum(diff, 0))
+      config[sites[ok]] = new[ok]
+      conn.send(np.count_nonzero(ok))
+    elif command == 'count':
+      slab = config[lo:hi]
+      conn.send((np.bincount(slab, minlength=Nstate),
+                 np.count_nonzero(slab[:, None] == config[forward])))
+    elif command == 'get_rng':
+      conn.send(prng.get_state())
+    elif command == 'set_rng':
+      prng.set_state(arg)
+      conn.send(None)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Checkerboard simulation with the same methods and observables
+# as PottsMRTSim, with the given number of workers
+# This needs even extents, and no more workers than the extent in z
+# The workers run until close()
+class SlabMRTSim(object):
+  Nstate = PottsMRTSim.Nstate
+  outputs = PottsMRTSim.outputs
+  tracked = PottsMRTSim.tracked
+
+  def __init__(self, lattice, gamma, seed, generator='legacy', workers=2):
+    nz = lattice.dims[-1]
+    if workers < 1 or workers > nz:
+      raise ValueError("Can't split %d slabs into %d workers"
+                       % (nz, workers))
+    sublattice = lattice.sublattices()
+    self.lattice = lattice
+    self.gamma = float(gamma)
+    self.workers = workers
+
+    # The sites of each slab are consecutive, with z the slowest index
+    self.shared = multiprocessing.RawArray('B', lattice.vol)
+    self.config = np.frombuffer(self.shared, dtype=np.uint8)
+    area = lattice.vol / nz
+    slabs = np.array_split(np.arange(nz), workers)
+    seeds = spawn_seeds(seed, generator, workers)
+    self.conns = []
+    self.procs = []
+    for slab, child in zip(slabs, seeds):
+      lo = slab[0] * area
+      hi = (slab[-1] + 1) * area
+      sites = [s[(s >= lo) & (s < hi)] for s in sublattice]
+      conn, worker_conn = multiprocessing.Pipe()
+      proc = multiprocessing.Process(target=slab_worker,
+                                     args=(worker_conn, self.conns + [conn],
+                                           self.shared, lattice.neighbor,
+                                           lattice.Ndim, lo, hi, sites,
+                                           self.gamma, child, generator,
+                                           self.Nstate))
+      proc.daemon = True
+      proc.start()
+      worker_conn.close()
+      self.conns.append(conn)
+      self.procs.append(proc)
+    for conn in self.conns:
+      conn.recv()
+    atexit.register(self.close)
+
+    self.nsweep = 0
+    self.accept = 0.0
+    self.count()
+
+  # Send the same command to every worker and wait for all the replies
+  def command(self, command, args=None):
+    if args is None:
+      args = [None] * self.workers
+    for conn, arg in zip(self.conns, args):
+      conn.send((command, arg))
+    return [conn.recv() for conn in self.conns]
+
+  # Each worker counts the observables in its slab
+  def count(self):
+    replies = self.command('count')
+    self.magnet = np.sum([r[0] for r in replies], axis=0).tolist()
+    self.aligned = int(sum(r[1] for r in replies))
+
+  # Closing the pipes stops the workers
+  # This is also done on exit (before multiprocessing tries to terminate
+  # the workers, which ignore SIGTERM), in particular after an error
+  def close(self):
+    for conn in self.conns:
+      conn.close()
+    for proc in self.procs:
+      proc.join()
+    self.conns = []
+    self.procs = []
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Each sublattice is followed by a barrier, and so is the count
+  # (since aligned pairs cross into the neighboring slabs)
+  def sweep(self):
+    accept = 0
+    for p in range(2):
+      accept += sum(self.command('phase', [p] * self.workers))
+    self.count()
+    self.nsweep += 1
+    self.accept = accept / float(self.lattice.vol)
+    return self.accept
+
+  def measure(self):
+    vol = float(self.lattice.vol)
+    tot_act = -self.gamma * self.aligned
+    return {'accept': self.accept,
+            'state1': float(self.magnet[0]) / vol,
+            'state2': float(self.magnet[1]) / vol,
+            'state3': float(self.magnet[2]) / vol,
+            'action_tot': tot_act,
+            'action_rel': tot_act / vol}
+
+  def run(self, n):
+    results = []
+    for i in range(n):
+      self.sweep()
+      results.append(self.measure())
+    return results
+
+  def validate(self):
+    check_potts(self.config, self.lattice.dims, self.Nstate,
+                self.magnet, self.aligned)
+
+  # The configuration is saved in the same form as by PottsMRTSim,
+  # along with the RNG state of each worker
+  def get_state(self):
+    return {'config': self.config.astype(np.uint)}, \
+           {'sweep': self.nsweep, 'rng': self.command('get_rng')}
+
+  def set_state(self, arrays, state):
+    self.config[:] = arrays['config']
+    self.nsweep = state['sweep']
+    self.command('set_rng', state['rng'])
+    self.count()
+# ------------------------------------------------------------------
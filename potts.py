@@ -0,0 +1,998 @@
+#!/usr/bin/python
+import timeit
+import numpy as np
+from utils import *
+from connectivity import DynamicConnectivity
+from checkpoint import copy_arrays
+# Simulations of the three-state Potts model as importable objects,
+# used by PottsCluster.py and PottsMRT.py but also usable on their own
+#
+# PottsClusterSim runs the triality cluster algorithm
+# for canonical heavy-dense QCD, as described in the README
+# PottsMRTSim runs the local MRT or cluster updates at zero density,
+# while PottsMRTBatch runs many independent chains of these at once
+# Each takes a Lattice from lattice.py, which can be shared between
+# simulations, along with an RNG from rng.py, and provides
+#   sweep()       Do one sweep, returning the acceptance
+#   measure()     Return a dictionary of observables for the current state,
+#                 named like the columns of the output files
+#   run(n)        Do n sweeps, returning a list of measure() after each
+#   validate()    Check all stored information against a recount,
+#                 aborting if it disagrees
+#   get_state()   Return the arrays and other state for checkpoint.py
+#   set_state()   Restore the state returned by get_state()
+#   set_gamma()   Change the coupling, e.g. for replica exchange
+# along with the list outputs of the files the drivers write,
+# in the form used by series.py, and the list tracked of the observables
+# they analyze during the run (see analysis.py)
+# The number of sweeps done so far is nsweep
+# For replica exchange (see tempering.py), the weight of each configuration
+# depends on gamma only through exp[coupling(gamma) * swap_stat()]
+# PottsClusterSim can also time each kind of update (see StepTimer below)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Optional instrumentation of the triality cluster updates,
+# counting and timing each kind of update during the last sweep:
+#   mvB     Step 1, baryon moves
+#   mvQ     Step 2, quark moves
+#   cycle   Step 3, removing a bond that doesn't split its cluster
+#   split   Step 3, removing a bond that would split its cluster
+#   add     Step 3, adding a bond within a cluster
+#   merge   Step 3, adding a bond between two clusters
+# whether or not the update is accepted
+# With '--connect search' it also records the number of sites visited
+# by each check_connect_both, along with the number of sites relabelled
+# by accepted splits and merges
+# This costs a few timer calls per update, and nothing when not used
+branches = ['mvB', 'mvQ', 'cycle', 'split', 'add', 'merge']
+MVB, MVQ, CYCLE, SPLIT, ADD, MERGE = range(len(branches))
+
+class StepTimer(object):
+  clock = staticmethod(timeit.default_timer)
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.count = [0] * len(branches)
+    self.time = [0.0] * len(branches)
+    self.visits = []
+    self.relabel_split = 0
+    self.relabel_merge = 0
+
+  # Start timing an update, then record each step as it finishes
+  def start(self):
+    self.last = self.clock()
+
+  def tick(self, branch):
+    now = self.clock()
+    self.count[branch] += 1
+    self.time[branch] += now - self.last
+    self.last = now
+
+  # Column names and values for the output file timing.csv,
+  # summarizing the distribution of traversal sizes
+  # by its mean, median, 90th percentile and maximum
+  @staticmethod
+  def header():
+    names = ['n_' + b for b in branches] + ['t_' + b for b in branches]
+    names += ['visit_n', 'visit_mean', 'visit_p50', 'visit_p90',
+              'visit_max', 'relabel_split', 'relabel_merge']
+    return ','.join(names)
+
+  def row(self):
+    values = ["%d" % n for n in self.count]
+    values += ["%.4g" % t for t in self.time]
+    if len(self.visits) > 0:
+      visits = np.array(self.visits)
+      values += ["%d" % len(visits), "%.4g" % np.mean(visits),
+                 "%.4g" % np.percentile(visits, 50),
+                 "%.4g" % np.percentile(visits, 90), "%d" % np.max(visits)]
+    else:
+      values += ["0", "0", "0", "0", "0"]
+    values += ["%d" % self.relabel_split, "%d" % self.relabel_merge]
+    return ','.join(values)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+class PottsClusterSim(object):
+  # Updates per block of random numbers drawn at once
+  Nblock = 65536
+
+  # Output files, with the observables from measure() in each
+  outputs = [('accept.csv', ['accept_mvB', 'accept_mvQ', 'accept_bond'],
+              "%d,%.4g,%.4g,%.4g"),
+             ('maxcluster.csv', ['max_tot', 'max_rel'], "%d,%d,%.8g"),
+             ('avecluster.csv', ['ave_tot', 'ave_rel'], "%d,%.8g,%.8g"),
+             ('numbonds.csv', ['nb_tot', 'nb_rel'], "%d,%d,%.8g"),
+             ('action.csv', ['action_tot', 'action_rel'], "%d,%.8g,%.8g")]
+  tracked = ['action_rel', 'nb_rel', 'max_rel', 'ave_rel']
+
+  # Set up NB baryons at random on the given lattice with no bonds,
+  # so that each site is its own cluster
+  # connect is 'search' or 'dynamic', as for '--connect' in PottsCluster.py
+  # With timing=True, each sweep is instrumented by a StepTimer
+  def __init__(self, lattice, NB, gamma, prng, connect='search',
+               timing=False):
+    if not connect in ['search', 'dynamic']:
+      raise ValueError("Unknown connectivity method %s" % connect)
+    vol = lattice.vol
+    if NB > 2 * vol:
+      raise ValueError("Cannot fit %d baryons in %d sites" % (NB, vol))
+    self.lattice = lattice
+    self.NB = int(NB)                 # Number of baryons
+    self.Nq = 3 * self.NB             # Number of quarks
+    self.prng = prng
+    self.connect = connect
+    self.set_gamma(gamma)
+
+    # Now for each site we need the following:
+    #   An occupation number (counting quarks, not baryons) in a uint8
+    #   Ndim bits in a uint8 to tell whether or not bonds are present,
+    #     accessed through has_bond, add_bond and remove_bond in utils.py
+    #   The label of its cluster, used by the routines in utils.py
+    #   The parent of each label, whose root labels the cluster
+    #   The number of sites in its cluster (only used at roots)
+    #   The number of quarks in its cluster (only used at roots)
+    # Along with the int32 neighbor table, this needs 42 bytes per site
+    # in 3d (50 in 4d), plus 8 more for the traversal scratch space
+    # and the cluster size histogram
+    # Each site has two slots that can each hold one baryon,
+    # so we choose NB of the 2vol slots at random, all at once,
+    # and count the baryons at each site
+    self.occupation = place_baryons(self.NB, vol, prng)
+    check_Nq(self.occupation, self.Nq)
+    self.bond = np.zeros(vol, dtype=np.uint8)           # No bonds
+    self.root = np.arange(vol, dtype=np.int32)          # root[i] = i
+    self.parent = np.arange(vol, dtype=np.int32)        # All roots
+    self.free = []                                      # Unused root labels
+    self.size = np.ones(vol, dtype=np.int32)            # Sites per cluster
+    self.quarks = np.array(self.occupation, dtype=np.int32)
+    self.hist = np.zeros(vol + 1, dtype=np.int32)       # Histogram of sizes
+    self.hist[1] = vol
+
+    # Some gross features of configuration: Size of largest cluster,
+    # total numbers of clusters and bonds
+    self.maxCluster = 1
+    self.numBond = 0
+    self.numCluster = vol
+
+    self.nsweep = 0
+    self.accept = [0.0, 0.0, 0.0]
+    self.timer = StepTimer() if timing else None
+    self.start_connectivity()
+
+  # Compute and save these constant floats for the given coupling
+  def set_gamma(self, gamma):
+    self.gamma = float(gamma)
+    self.exp_mga = np.exp(-self.gamma)      # Also bond removal probability
+    self.add_prob = 1.0 - self.exp_mga
+    self.split_prob = 3.0 * self.exp_mga / (1.0 + 2.0 * self.exp_mga)
+    self.merge_prob = self.add_prob / (1.0 + 2.0 * self.exp_mga)
+    if not self.gamma == 0:
+      self.act_frac = -1.0 * self.gamma / self.add_prob   # For the action
+    else:
+      self.act_frac = 0.0
+
+  # Each bond has weight 1 - exp(-gamma) and each missing bond exp(-gamma),
+  # so the weight of a configuration is exp[-Ndim vol gamma] times
+  # (exp(gamma) - 1)^numBond and factors that don't depend on gamma
+  # The action act_frac * numBond is an estimator of the Potts action,
+  # rather than the logarithm of this weight
+  # This needs gamma > 0
+  @staticmethod
+  def coupling(gamma):
+    return np.log(np.expm1(gamma))
+
+  def swap_stat(self):
+    return self.numBond
+
+  # With connect = 'dynamic' the clusters are tracked by connectivity.py,
+  # which replaces root and size, along with the searches in update step 3
+  # (any bonds in the configuration are inserted with the same labels)
+  def start_connectivity(self):
+    self.conn = None
+    if self.connect == 'dynamic':
+      Ndim = self.lattice.Ndim
+      self.conn = DynamicConnectivity(self.lattice.neighbor, Ndim,
+                                      self.occupation)
+      for edge in np.flatnonzero(unpack_bonds(self.bond, Ndim)):
+        self.conn.insert(int(edge))
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Each sweep does vol updates, each with the three steps described
+  # in the README, returning the acceptance for each step
+  def sweep(self):
+    lattice = self.lattice
+    vol = lattice.vol
+    Ndim = lattice.Ndim
+    Ndir = lattice.Ndir
+    neighbor = lattice.neighbor
+    prng = self.prng
+    conn = self.conn
+    Nblock = self.Nblock
+    exp_mga = self.exp_mga
+    add_prob = self.add_prob
+    split_prob = self.split_prob
+    merge_prob = self.merge_prob
+    occupation = self.occupation
+    bond = self.bond
+    root = self.root
+    parent = self.parent
+    free = self.free
+    size = self.size
+    quarks = self.quarks
+    hist = self.hist
+    maxCluster = self.maxCluster
+    numBond = self.numBond
+    numCluster = self.numCluster
+    timer = self.timer
+    visits = None
+    if timer is not None:
+      timer.reset()
+      visits = timer.visits
+
+    # Each sweep loops (randomly) over the lattice volume
+    accept = [0.0, 0.0, 0.0]        # Initialize acceptance rate
+    for i in range(vol):
+      # Draw all the random numbers for the next Nblock updates at once:
+      # Each update uses three random sites and two random directions
+      # for steps 1 and 2, a random bond direction for step 3,
+      # and at most one uniform random number for step 3
+      # (Drawing them in blocks rather than for the whole sweep
+      #  keeps these Python lists small on large lattices)
+      j = i % Nblock
+      if j == 0:
+        n = min(Nblock, vol - i)
+        ran_sites = prng.integers(0, vol, size=(n, 3)).tolist()
+        ran_dirs = prng.integers(0, Ndir, size=(n, 2)).tolist()
+        ran_bonds = prng.integers(0, Ndim, size=n).tolist()
+        ran_unif = prng.uniform(size=n).tolist()
+      if timer is not None:
+        timer.start()
+
+      # ------------------------------------------------------------
+      # Update step 1: Try to move full baryon to neighboring site
+      # Check that we have a baryon to move
+      ran = ran_sites[j][0]
+      if occupation[ran] > 2:
+        # Choose random neighbor and see if it can accept the baryon
+        new = neighbor[ran][ran_dirs[j][0]]
+        if occupation[new] < 4:
+          occupation[ran] -= 3
+          occupation[new] += 3
+          if conn is None:
+            quarks[get_root(root, parent, ran)] -= 3
+            quarks[get_root(root, parent, new)] += 3
+          else:
+            conn.add_quarks(ran, -3)
+            conn.add_quarks(new, 3)
+          accept[0] += 1.0
+      if timer is not None:
+        timer.tick(MVB)
+      # ------------------------------------------------------------
+
+
+
+      # ------------------------------------------------------------
+      # Update step 2: Try to move quark within cluster
+      # Check that we have a quark to move
+      ran = ran_sites[j][1]
+      if occupation[ran] > 0:
+        # Choose random neighbor and see if it can accept the quark
+        new = neighbor[ran][ran_dirs[j][1]]
+        if occupation[new] < 6:
+          # See whether or not both sites are in the same cluster
+          if conn is None:
+            same = (get_root(root, parent, ran)
+                    == get_root(root, parent, new))
+          else:
+            same = conn.connected(ran, new)
+          if same:
+            occupation[ran] -= 1
+            occupation[new] += 1
+            if conn is not None:
+              conn.add_quarks(ran, -1)
+              conn.add_quarks(new, 1)
+            accept[1] += 1.0
+      if timer is not None:
+        timer.tick(MVQ)
+      # ------------------------------------------------------------
+
+
+
+      # ------------------------------------------------------------
+      # Update step 3: Try to change bond
+      ran = ran_sites[j][2]
+      ran_dir = ran_bonds[j]
+
+      # Figure out the site on the other side of the bond
+      # and the label of the bond used by connectivity.py
+      neigh = neighbor[ran][ran_dir]
+      edge = ran * Ndim + ran_dir
+
+      # If the bond is present, try to remove it
+      if has_bond(bond, ran, ran_dir):
+        remove_bond(bond, ran, ran_dir)   # Consequences to be checked...
+
+        # Build clusters from both ran and neigh, see if they meet
+        # (or let connectivity.py remove the bond and check)
+        # If no change in clusters, accept with probability exp_mga
+        small_cluster = []
+        if conn is None:
+          connect = check_connect_both(bond, ran, neigh, small_cluster,
+                                       lattice, visits)
+        else:
+          connect = conn.delete(edge)
+        if connect > 0:         # No change in clusters
+          branch = CYCLE
+          if ran_unif[j] < exp_mga:
+            numBond -= 1
+            accept[2] += 1.0
+          else:
+            add_bond(bond, ran, ran_dir)    # Reject!
+            if conn is not None:
+              conn.insert(edge)
+
+        # If the cluster will be split we need to check the occupation
+        # numbers -- connect<0 means that check_connect_both built
+        # the complete small_cluster, containing small_cluster[0]
+        # (either ran or neigh), while connectivity.py directly counts
+        # the quarks in each cluster
+        else:     # Cluster will be split
+          branch = SPLIT
+          if conn is None:
+            small_Nq = check_occupation(occupation, small_cluster)
+          else:
+            small_Nq = conn.quarks(ran)
+          if not np.mod(small_Nq, 3) == 0:
+            add_bond(bond, ran, ran_dir)    # Reject!
+            if conn is not None:
+              conn.insert(edge)
+
+          else:   # Accept with probability 3 * exp_mga / (1 + 2 * exp_mga)
+                  # (We already know that the other occupation is fine)
+            if ran_unif[j] < split_prob:
+              accept[2] += 1.0
+              numBond -= 1
+              numCluster += 1
+
+              # Relabel the smaller fragment as a new cluster,
+              # leaving the root of the larger one unchanged
+              # (connectivity.py has already taken care of this)
+              if conn is None:
+                old_size = size[get_root(root, parent, ran)]
+                split_cluster(root, parent, size, quarks, free,
+                              small_cluster, small_Nq)
+                small_size = len(small_cluster)
+                if timer is not None:
+                  timer.relabel_split += small_size
+              else:
+                small_size = conn.cluster_size(ran)
+                old_size = small_size + conn.cluster_size(neigh)
+              change_histogram(hist, [old_size],
+                               [small_size, old_size - small_size])
+
+            else:   # The final reject!
+              add_bond(bond, ran, ran_dir)    # Reject!
+              if conn is not None:
+                conn.insert(edge)
+
+      # If the bond is not present, try to add it
+      else:
+        if conn is None:
+          ran_root = get_root(root, parent, ran)
+          neigh_root = get_root(root, parent, neigh)
+          same = ran_root == neigh_root
+        else:
+          same = conn.connected(ran, neigh)
+        # If both sites are already in the same cluster,
+        # then add bond with probability (1 - exp_mga)
+        if same:
+          branch = ADD
+          if ran_unif[j] < add_prob:
+            add_bond(bond, ran, ran_dir)
+            numBond += 1
+            if conn is not None:
+              conn.insert(edge)
+            accept[2] += 1.0
+
+        # Otherwise the addition decreases the number of clusters by one,
+        # and so occurs with probability (1 - exp_mga) / (1 + 2 * exp_mga)
+        else:
+          branch = MERGE
+          if ran_unif[j] < merge_prob:
+            # Attach the smaller cluster to the larger one
+            if conn is None:
+              size1 = size[ran_root]
+              size2 = size[neigh_root]
+              merge_clusters(root, parent, size, quarks, free, ran, neigh,
+                             ran_root, neigh_root)
+              if timer is not None and min(size1, size2) == 1:
+                timer.relabel_merge += 1
+            else:
+              size1 = conn.cluster_size(ran)
+              size2 = conn.cluster_size(neigh)
+              conn.insert(edge)
+            add_bond(bond, ran, ran_dir)
+            numBond += 1
+            numCluster -= 1
+            change_histogram(hist, [size1, size2], [size1 + size2])
+            maxCluster = max(maxCluster, size1 + size2)
+            accept[2] += 1.0
+      if timer is not None:
+        timer.tick(branch)
+      # ------------------------------------------------------------
+
+    # Save the counters, finding the current largest cluster
+    self.maxCluster = largest_cluster(hist, maxCluster)
+    self.numBond = numBond
+    self.numCluster = numCluster
+    self.nsweep += 1
+    self.accept = [a / float(vol) for a in accept]
+    return self.accept
+
+  # Acceptances for the last sweep, along with
+  #   The size of the largest cluster
+  #   The average cluster size
+  #   The number of bonds
+  #   The action S = -gamma * numBond / (1 - exp[-gamma])
+  #   (Derived in Eq. 3.28 of Philippe Widmer's thesis)
+  # each both absolute and as fraction of the total volume
+  # (or the maximum Ndim * vol number of bonds)
+  def measure(self):
+    vol = float(self.lattice.vol)
+    action = float(self.numBond) * self.act_frac
+    if self.numBond == 0:
+      action = 0.0                  # Rather than -0.0
+    return {'accept_mvB': self.accept[0],
+            'accept_mvQ': self.accept[1],
+            'accept_bond': self.accept[2],
+            'max_tot': self.maxCluster,
+            'max_rel': float(self.maxCluster) / vol,
+            'ave_tot': vol / float(self.numCluster),
+            'ave_rel': 1.0 / float(self.numCluster),
+            'nb_tot': self.numBond,
+            'nb_rel': float(self.numBond) / (vol * self.lattice.Ndim),
+            'action_tot': action,
+            'action_rel': action / vol}
+
+  def run(self, n):
+    results = []
+    for i in range(n):
+      self.sweep()
+      results.append(self.measure())
+    return results
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # With connectivity.py, extract the cluster information,
+  # pointing each site directly to its root
+  def extract_clusters(self):
+    self.root, self.size, self.quarks = self.conn.roots()
+    self.parent = np.arange(self.lattice.vol, dtype=np.int32)
+
+  # Make sure our total occupation number, count of bonds
+  # and stored cluster information are correct
+  # (first extracting the clusters from connectivity.py if necessary)
+  def validate(self):
+    check_Nq(self.occupation, self.Nq)
+    count_bonds(self.bond, self.numBond)
+    if self.conn is not None:
+      self.extract_clusters()
+    count_clusters(flat_roots(self.root, self.parent), self.size,
+                   self.quarks, self.hist, self.occupation, self.numCluster)
+
+  # With connectivity.py, extract the cluster information,
+  # in which case the unused labels are all the other sites
+  def get_state(self):
+    if self.conn is not None:
+      self.extract_clusters()
+      vol = self.lattice.vol
+      self.free = np.setdiff1d(np.arange(vol), self.root).tolist()
+    arrays = {'occupation': self.occupation, 'bond': self.bond,
+              'root': self.root, 'parent': self.parent, 'size': self.size,
+              'quarks': self.quarks, 'hist': self.hist}
+    state = {'sweep': self.nsweep, 'free': self.free,
+             'numBond': self.numBond, 'numCluster': self.numCluster,
+             'maxCluster': self.maxCluster, 'rng': self.prng.get_state()}
+    return arrays, state
+
+  def set_state(self, arrays, state):
+    arrays = copy_arrays(arrays)
+    self.occupation = arrays['occupation']
+    self.bond = arrays['bond']
+    self.root = arrays['root']
+    # Older checkpoints point each site directly to its root
+    if 'parent' in arrays:
+      self.parent = arrays['parent']
+    else:
+      self.parent = np.arange(self.lattice.vol, dtype=np.int32)
+    self.size = arrays['size']
+    self.quarks = arrays['quarks']
+    self.hist = arrays['hist']
+    self.free = list(state['free'])
+    self.numBond = int(state['numBond'])
+    self.numCluster = int(state['numCluster'])
+    self.maxCluster = int(state['maxCluster'])
+    self.nsweep = state['sweep']
+    self.prng.set_state(state['rng'])
+    check_Nq(self.occupation, self.Nq)
+    self.start_connectivity()
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# With weight exp[-S] = exp[gamma sum_<ij> \delta_{s_i, s_j}]
+#   the acceptance probability is exp[gamma * (new# - cur#)]
+# method chooses how to sweep, as for '--sweep' in PottsMRT.py
+methods = ['random', 'checkerboard', 'sw', 'wolff']
+
+class PottsMRTSim(object):
+  Nstate = 3                    # Hard-code three-state Potts model
+
+  # Output files, with the observables from measure() in each
+  outputs = [('accept.csv', ['accept'], "%d,%.4g"),
+             ('magnet.csv', ['state1', 'state2', 'state3'],
+              "%d,%.8g,%.8g,%.8g"),
+             ('action.csv', ['action_tot', 'action_rel'], "%d,%.8g,%.8g")]
+  tracked = ['action_rel', 'state1', 'state2', 'state3']
+
+  # Start with randomly assigned states
+  # wolff_flips sets the number of Wolff cluster updates per sweep
+  def __init__(self, lattice, gamma, prng, method='random', wolff_flips=10):
+    if not method in methods:
+      raise ValueError("Unknown sweep method %s" % method)
+    self.lattice = lattice
+    self.prng = prng
+    self.method = method
+    self.wolff_flips = wolff_flips
+    self.set_gamma(gamma)
+
+    # Checkerboard sweeps need each site's neighbors
+    # to be on the other sublattice
+    if method == 'checkerboard':
+      self.sublattice = lattice.sublattices()
+
+    self.config = prng.integers(0, self.Nstate, size=lattice.vol)
+    self.config = self.config.astype(np.uint)
+    self.nsweep = 0
+    self.accept = 0.0
+    self.count()
+
+  # Cluster updates add bonds between neighbors in the same state
+  # with probability 1 - exp(-gamma), which needs gamma >= 0
+  def set_gamma(self, gamma):
+    if self.method in ['sw', 'wolff'] and gamma < 0:
+      raise ValueError("Cluster updates need non-negative gamma")
+    self.gamma = float(gamma)
+    self.add_prob = 1.0 - np.exp(-self.gamma)
+
+  # The weight of a configuration is exp[gamma * aligned],
+  # with the action -gamma * aligned
+  @staticmethod
+  def coupling(gamma):
+    return gamma
+
+  def swap_stat(self):
+    return self.aligned
+
+  # Count how many sites have each value, and how many pairs
+  # of nearest neighbors are aligned (in the same state)
+  # These are then kept as running totals in the default random sweeps
+  def count(self):
+    self.magnet, self.aligned = potts_counts(self.config, self.lattice.dims,
+                                             self.Nstate)
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Do one sweep, returning the acceptance
+  # For the cluster updates every proposal is accepted,
+  # so this is the fraction of sites whose state changed instead
+  def sweep(self):
+    if self.method == 'checkerboard':
+      accept = self.checkerboard_sweep()
+    elif self.method == 'sw':
+      accept = self.sw_sweep()
+    elif self.method == 'wolff':
+      accept = self.wolff_sweep()
+    else:
+      accept = self.random_sweep()
+
+    # The array-based sweeps recount the observables all at once,
+    # while random sweeps have kept running totals
+    if not self.method == 'random':
+      self.count()
+    self.nsweep += 1
+    self.accept = accept / float(self.lattice.vol)
+    return self.accept
+
+  # Each sweep loops (randomly) over the lattice volume
+  # Draw a random site, new state and uniform number for each update
+  def random_sweep(self):
+    vol = self.lattice.vol
+    Ndir = self.lattice.Ndir
+    neighbor = self.lattice.neighbor
+    gamma = self.gamma
+    config = self.config
+    magnet = self.magnet
+    aligned = self.aligned
+
+    accept = 0.0
+    ran_sites = self.prng.integers(0, vol, size=vol).tolist()
+    ran_states = self.prng.integers(0, self.Nstate, size=vol).tolist()
+    ran_unif = self.prng.uniform(size=vol).tolist()
+    for i in range(vol):
+      # Update: Try to change the state at the current site
+      # The new state is allowed to be the current state
+      ran = ran_sites[i]
+      cur = config[ran]
+      new = ran_states[i]             # Proposed new state at site ran
+
+      # Compute change in energy, if non-zero
+      # With weight exp[-S] = exp[gamma sum_<ij> delta_{s_i, s_j}]
+      #   accept with probability exp[diff] = exp[oldE - newE]
+      # The change in the number of aligned neighbors, dn,
+      # also updates the running totals if the change is accepted
+      if new == cur:
+        accept += 1.0
+      else:         # We know new != cur
+        dn = 0
+        for mu in range(Ndir):
+          neigh = config[neighbor[ran][mu]]
+          if new == neigh:
+            dn += 1
+          elif cur == neigh:
+            dn -= 1
+
+        diff = gamma * dn
+        if diff > 0 or ran_unif[i] < np.exp(diff):
+          config[ran] = new
+          magnet[cur] -= 1
+          magnet[new] += 1
+          aligned += dn
+          accept += 1.0
+    self.aligned = aligned
+    return accept
+
+  # Update each sublattice in turn, with all of its sites at once
+  # Since no two neighbors are on the same sublattice,
+  # this satisfies detailed balance just like single-site updates
+  def checkerboard_sweep(self):
+    config = self.config
+    neighbor = self.lattice.neighbor
+    accept = 0
+    for sites in self.sublattice:
+      cur = config[sites]
+      new = self.prng.integers(0, self.Nstate, size=len(sites))
+      new = new.astype(config.dtype)
+      neigh = config[neighbor[sites]]
+
+      # Change in energy from the number of neighbors with each state
+      # With weight exp[-S] = exp[gamma sum_<ij> delta_{s_i, s_j}]
+      #   accept with probability exp[diff] = exp[oldE - newE]
+      # This always accepts new == cur, for which diff = 0
+      diff = self.gamma * (np.sum(neigh == new[:, None], axis=1)
+                           - np.sum(neigh == cur[:, None], axis=1))
+      ok = self.prng.uniform(size=len(sites)) < np.exp(np.minimum(diff, 0))
+      config[sites[ok]] = new[ok]
+      accept += np.count_nonzero(ok)
+    return accept
+
+  # Swendsen--Wang: Add bonds between all neighbors in the same state
+  # with probability add_prob, then give each cluster a random state
+  def sw_sweep(self):
+    vol = self.lattice.vol
+    Ndim = self.lattice.Ndim
+    neighbor = self.lattice.neighbor
+    config = self.config
+    old = config.copy()
+    bond = np.empty((vol, Ndim), dtype=bool)
+    for mu in range(Ndim):
+      bond[:, mu] = config == config[neighbor[:, mu]]
+    bond &= self.prng.uniform(size=(vol, Ndim)) < self.add_prob
+    label = label_clusters(bond, neighbor)
+    new = self.prng.integers(0, self.Nstate, size=vol).astype(config.dtype)
+    config[:] = new[label]
+    return np.count_nonzero(config != old)
+
+  # Wolff: Grow a single cluster from a random site,
+  # adding bonds to neighbors in the same state with probability add_prob,
+  # then change the whole cluster to a different random state
+  # Each sweep repeats this a fixed number of times, wolff_flips
+  # (Stopping once enough sites have changed would bias the measurements
+  #  towards configurations just after large clusters have changed)
+  def wolff_sweep(self):
+    lattice = self.lattice
+    neighbor = lattice.neighbor
+    visited = lattice.visited
+    config = self.config
+    prng = self.prng
+    Nstate = config.dtype.type(self.Nstate)
+    old = config.copy()
+    for flip in range(self.wolff_flips):
+      ran = prng.integers(0, lattice.vol)
+      cur = config[ran]
+      gen = new_generation(lattice)
+      visited[ran] = gen
+      frontier = np.array([ran], dtype=neighbor.dtype)
+      cluster = [frontier]
+      while len(frontier) > 0:
+        neigh = neighbor[frontier].ravel()
+        neigh = neigh[(config[neigh] == cur) & (visited[neigh] != gen)]
+        neigh = neigh[prng.uniform(size=len(neigh)) < self.add_prob]
+        frontier = np.unique(neigh)
+        visited[frontier] = gen
+        cluster.append(frontier)
+
+      cluster = np.concatenate(cluster)
+      # The new state in the same dtype as the configuration,
+      # whatever type of integer the generator returns
+      shift = config.dtype.type(prng.integers(1, self.Nstate))
+      config[cluster] = (cur + shift) % Nstate
+    return np.count_nonzero(config != old)
+
+  # Acceptance for the last sweep, along with the fraction of sites
+  # in each state and the action S = -gamma sum_<ij> delta_{s_i, s_j}
+  # (total and average over the lattice volume)
+  # Note S = -gamma sum_<ij> delta_{s_i, s_j}    # TODO: Check sign...
+  def measure(self):
+    vol = float(self.lattice.vol)
+    tot_act = -self.gamma * self.aligned
+    return {'accept': self.accept,
+            'state1': float(self.magnet[0]) / vol,
+            'state2': float(self.magnet[1]) / vol,
+            'state3': float(self.magnet[2]) / vol,
+            'action_tot': tot_act,
+            'action_rel': tot_act / vol}
+
+  def run(self, n):
+    results = []
+    for i in range(n):
+      self.sweep()
+      results.append(self.measure())
+    return results
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Recount the observables from scratch, to check the running totals
+  def validate(self):
+    check_potts(self.config, self.lattice.dims, self.Nstate,
+                self.magnet, self.aligned)
+
+  def get_state(self):
+    return {'config': self.config}, {'sweep': self.nsweep,
+                                     'rng': self.prng.get_state()}
+
+  def set_state(self, arrays, state):
+    self.config = copy_arrays(arrays)['config']
+    self.nsweep = state['sweep']
+    self.prng.set_state(state['rng'])
+    self.count()
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# K independent chains of PottsMRTSim on the same (small) lattice,
+# with their configurations stacked in a (K, vol) array
+# and all of them updated together by each array operation,
+# so that the interpreter overhead is shared between the chains
+# Each chain has its own RNG in the list prngs, from which it draws
+# exactly the random numbers that PottsMRTSim would,
+# so each chain reproduces a PottsMRTSim run with the same RNG
+# The methods are the same as for PottsMRTSim, with the observables
+# from measure() returned as a list with a dictionary for each chain
+# Wolff updates grow a different cluster in each chain,
+# so they are not included in batch_methods
+batch_methods = ['random', 'checkerboard', 'sw']
+
+class PottsMRTBatch(object):
+  Nstate = PottsMRTSim.Nstate
+  outputs = PottsMRTSim.outputs
+  tracked = PottsMRTSim.tracked
+
+  def __init__(self, lattice, gamma, prngs, method='random'):
+    if not method in batch_methods:
+      raise ValueError("Unknown batch sweep method %s" % method)
+    if method == 'sw' and gamma < 0:
+      raise ValueError("Cluster updates need non-negative gamma")
+    self.lattice = lattice
+    self.gamma = float(gamma)
+    self.add_prob = 1.0 - np.exp(-self.gamma)
+    self.prngs = list(prngs)
+    self.method = method
+    self.K = len(self.prngs)
+    self.offset = lattice.vol * np.arange(self.K, dtype=np.intp)
+
+    if method == 'checkerboard':
+      self.sublattice = lattice.sublattices()
+
+    # Neighbor table for the K lattices as one graph of K vol sites,
+    # with each chain's sites offset by vol times its index,
+    # so that the clusters of all chains can be labelled at once
+    if method == 'sw':
+      Ndim = lattice.Ndim
+      self.neighbor = (lattice.neighbor[None, :, :Ndim]
+                       + self.offset[:, None, None].astype(np.int32))
+      self.neighbor = self.neighbor.reshape(-1, Ndim)
+
+    self.config = np.array([prng.integers(0, self.Nstate, size=lattice.vol)
+                            for prng in self.prngs]).astype(np.uint)
+    self.nsweep = 0
+    self.accept = np.zeros(self.K)
+    self.count()
+
+  # Count the sites in each state and the aligned pairs for every chain
+  # at once, as potts_counts does for one
+  def count(self):
+    K = self.K
+    config = self.config.astype(np.intp)
+    index = config + self.Nstate * np.arange(K)[:, None]
+    self.magnet = np.bincount(index.ravel(), minlength=K * self.Nstate)
+    self.magnet = self.magnet.reshape(K, self.Nstate)
+    lat = config.reshape((K,) + tuple(self.lattice.dims)[::-1])
+    self.aligned = np.zeros(K, dtype=np.int64)
+    for axis in range(1, lat.ndim):
+      same = lat == np.roll(lat, -1, axis=axis)
+      self.aligned += np.count_nonzero(same.reshape(K, -1), axis=1)
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Do one sweep of every chain, returning the array of acceptances
+  # The observables are recounted after every sweep
+  def sweep(self):
+    if self.method == 'checkerboard':
+      accept = self.checkerboard_sweep()
+    elif self.method == 'sw':
+      accept = self.sw_sweep()
+    else:
+      accept = self.random_sweep()
+    self.count()
+    self.nsweep += 1
+    self.accept = accept / float(self.lattice.vol)
+    return self.accept
+
+  # Each update changes one random site in every chain,
+  # as in PottsMRTSim.random_sweep
+  def random_sweep(self):
+    vol = self.lattice.vol
+    neighbor = self.lattice.neighbor
+    gamma = self.gamma
+    config = self.config.ravel()        # A view, with chain k at k vol
+    offset = self.offset
+
+    # Random numbers for each update in every chain, transposed
+    # so that each update reads a contiguous row
+    ran_sites = np.empty((vol, self.K), dtype=np.intp)
+    ran_states = np.empty((vol, self.K), dtype=np.uint)
+    ran_unif = np.empty((vol, self.K))
+    for k, prng in enumerate(self.prngs):
+      ran_sites[:, k] = prng.integers(0, vol, size=vol)
+      ran_states[:, k] = prng.integers(0, self.Nstate, size=vol)
+      ran_unif[:, k] = prng.uniform(size=vol)
+
+    # Indices of each site to update and its neighbors in config
+    index = ran_sites + offset
+    neighbors = neighbor[ran_sites] + offset[:, None]
+
+    accept = np.zeros(self.K)
+    for i in range(vol):
+      cur = config[index[i]]
+      new = ran_states[i]
+      neigh = config[neighbors[i]]
+
+      # Change in the number of aligned neighbors, which vanishes
+      # (and is always accepted) for new == cur
+      dn = (neigh == new[:, None]).sum(axis=1) \
+           - (neigh == cur[:, None]).sum(axis=1)
+      diff = gamma * dn
+      ok = (diff > 0) | (ran_unif[i] < np.exp(diff))
+      config[index[i][ok]] = new[ok]
+      accept += ok
+    return accept
+
+  # Update each sublattice of every chain at once,
+  # as in PottsMRTSim.checkerboard_sweep
+  def checkerboard_sweep(self):
+    config = self.config
+    neighbor = self.lattice.neighbor
+    accept = np.zeros(self.K)
+    for sites in self.sublattice:
+      new = np.empty((self.K, len(sites)), dtype=np.uint)
+      ran_unif = np.empty((self.K, len(sites)))
+      for k, prng in enumerate(self.prngs):
+        new[k] = prng.integers(0, self.Nstate, size=len(sites))
+        ran_unif[k] = prng.uniform(size=len(sites))
+      cur = config[:, sites]
+      neigh = config[:, neighbor[sites]]
+      diff = self.gamma * (np.sum(neigh == new[:, :, None], axis=2)
+                           - np.sum(neigh == cur[:, :, None], axis=2))
+      ok = ran_unif < np.exp(np.minimum(diff, 0))
+      config[:, sites] = np.where(ok, new, cur)
+      accept += np.count_nonzero(ok, axis=1)
+    return accept
+
+  # Swendsen--Wang for all chains at once, as in PottsMRTSim.sw_sweep,
+  # labelling the clusters of all chains together
+  # Each label is the smallest site in its cluster, so the clusters
+  # of chain k have labels from k vol to (k + 1) vol - 1
+  def sw_sweep(self):
+    vol = self.lattice.vol
+    Ndim = self.lattice.Ndim
+    K = self.K
+    config = self.config.ravel()
+    old = config.copy()
+    bond = np.empty((K * vol, Ndim), dtype=bool)
+    for mu in range(Ndim):
+      bond[:, mu] = config == config[self.neighbor[:, mu]]
+    ran_unif = np.array([prng.uniform(size=(vol, Ndim))
+                         for prng in self.prngs])
+    bond &= ran_unif.reshape(K * vol, Ndim) < self.add_prob
+    label = label_clusters(bond, self.neighbor)
+    states = np.array([prng.integers(0, self.Nstate, size=vol)
+                       for prng in self.prngs])
+    config[:] = states.ravel()[label]
+    changed = (config != old).reshape(K, vol)
+    return np.count_nonzero(changed, axis=1)
+
+  # Observables for each chain, as in PottsMRTSim.measure
+  def measure(self):
+    vol = float(self.lattice.vol)
+    results = []
+    for k in range(self.K):
+      tot_act = -self.gamma * int(self.aligned[k])
+      results.append({'accept': self.accept[k],
+                      'state1': float(self.magnet[k, 0]) / vol,
+                      'state2': float(self.magnet[k, 1]) / vol,
+                      'state3': float(self.magnet[k, 2]) / vol,
+                      'action_tot': tot_act,
+                      'action_rel': tot_act / vol})
+    return results
+
+  def run(self, n):
+    results = []
+    for i in range(n):
+      self.sweep()
+      results.append(self.measure())
+    return results
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Recount the observables of each chain one by one with potts_counts
+  def validate(self):
+    for k in range(self.K):
+      check_potts(self.config[k], self.lattice.dims, self.Nstate,
+                  self.magnet[k], self.aligned[k])
+
+  def get_state(self):
+    return {'config': self.config}, \
+           {'sweep': self.nsweep,
+            'rng': [prng.get_state() for prng in self.prngs]}
+
+  def set_state(self, arrays, state):
+    self.config = copy_arrays(arrays)['config']
+    self.nsweep = state['sweep']
+    for prng, saved in zip(self.prngs, state['rng']):
+      prng.set_state(saved)
+    self.count()
+# ------------------------------------------------------------------
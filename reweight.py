@@ -0,0 +1,296 @@
+#!/usr/bin/python
+import os
+import sys
+import csv
+import numpy as np
+from utils import parse_options
+from potts import PottsClusterSim, PottsMRTSim
+from checkpoint import load_checkpoint
+from series import read_series
+# ------------------------------------------------------------------
+# Multi-histogram (Ferrenberg--Swendsen) reweighting of the time series
+# from several runs of PottsCluster.py, ensemble.py or tempering.py
+# (all with the same lattice and number of baryons), or of PottsMRT.py,
+# to interpolate the observables to any gamma in the covered range
+#
+# The weight of each configuration depends on gamma only through
+# exp[c(gamma) * s], with coupling c(gamma) and statistic s as for
+# replica exchange (see potts.py): the number of bonds for the cluster
+# simulations, or the number of aligned neighbors for the MRT simulations
+# The density of states g(s) is then estimated by combining the
+# histograms of s from all runs k with N_k samples at couplings c_k,
+#   g(s) = n(s) / sum_k N_k exp[c_k s - f_k]
+# where n(s) counts the samples from all runs and the free energies
+#   f_k = log sum_s g(s) exp[c_k s]
+# are found by iterating these equations, in logarithms to avoid overflow
+# Since s is an integer, everything is done with the distinct values of s
+# rather than with the individual samples
+#
+# Errors come from jackknife resampling, dropping one of several blocks
+# of consecutive sweeps from every run in turn
+# Correlations between the samples are not accounted for in the weights,
+# which only makes the estimates less efficient
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# log(sum(exp(a))) along the given axis, ignoring terms that are -inf
+def logsumexp(a, axis=None):
+  top = np.max(a, axis=axis, keepdims=True)
+  top[~np.isfinite(top)] = 0.0
+  tot = np.log(np.sum(np.exp(a - top), axis=axis, keepdims=True)) + top
+  return np.squeeze(tot, axis=axis)
+
+# Solve the multi-histogram equations for the distinct values s
+# with total counts n over all runs, given N samples at each coupling c
+# Start from the free energies f if given, and stop when no f_k changes
+# by more than tol, fixing f_0 = 0
+# Return f, log of the denominator of g(s) and the number of iterations
+def wham(s, n, N, c, f=None, tol=1e-10, max_iter=100000):
+  cs = np.outer(c, s)
+  logN = np.log(N)[:, None]
+  logn = np.full(len(n), -np.inf)
+  logn[n > 0] = np.log(n[n > 0])
+  if f is None:
+    f = np.zeros(len(c))
+  for it in range(1, max_iter + 1):
+    logD = logsumexp(logN + cs - f[:, None], axis=0)
+    new = logsumexp(logn[None, :] + cs - logD[None, :], axis=1)
+    new -= new[0]
+    change = np.max(np.abs(new - f))
+    f = new
+    if change < tol:
+      break
+  logD = logsumexp(logN + cs - f[:, None], axis=0)
+  return f, logD, it
+
+# Reweighted averages at coupling c of the observables whose sums over
+# the samples at each distinct value s are the rows of sums,
+# given the counts n and the log denominator logD from wham
+def reweight(c, s, n, logD, sums):
+  logw = c * s - logD
+  logw[n == 0] = -np.inf
+  w = np.exp(logw - np.max(logw))
+  return np.dot(sums, w) / np.dot(n, w)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# The model of each run is recognized from its files, with the statistic s
+# for reweighting and the observables per sample to be averaged
+# The observables don't include the actions, which are found at each gamma
+# from s instead (see potts.py)
+models = {'cluster': PottsClusterSim, 'mrt': PottsMRTSim}
+
+def run_model(dirname):
+  if os.path.isfile(dirname + '/numbonds.csv'):
+    return 'cluster'
+  if os.path.isfile(dirname + '/magnet.csv'):
+    return 'mrt'
+  data = dirname + '/observables.npy'
+  if os.path.isfile(data):
+    names = np.load(data, mmap_mode='r').dtype.names
+    if 'nb_tot' in names:
+      return 'cluster'
+    return 'mrt'
+  print "ERROR: No time series found in", dirname, "... aborting"
+  sys.exit(1)
+
+# The gamma of each run is given as dir:gamma, or else taken from
+# ladder.csv for the temp<k> directories of tempering.py,
+# or else from the setup saved in the checkpoint
+def run_gamma(name, model):
+  if ':' in name:
+    dirname, gamma = name.rsplit(':', 1)
+    return dirname, float(gamma)
+  dirname = name.rstrip('/')
+  parent, base = os.path.split(dirname)
+  ladder = os.path.join(parent, 'ladder.csv')
+  if base.startswith('temp') and os.path.isfile(ladder):
+    with open(ladder) as f:
+      for row in csv.DictReader(f):
+        if 'temp' + row['index'] == base:
+          return dirname, float(row['gamma'])
+  saved, state = load_checkpoint(dirname)
+  if model == 'cluster':
+    return dirname, float(state['setup'][4])  # After dims and baryons
+  return dirname, float(state['setup'][3])
+
+# Return the statistic s, the lattice volume and a dictionary
+# of the observables per sample, after the first therm sweeps
+def run_series(dirname, model, gamma, therm):
+  data = read_series(dirname, models[model].outputs)
+  data = data[data['sweep'] > therm]
+  if len(data) == 0:
+    print "ERROR: No sweeps after", therm, "in", dirname, "... aborting"
+    sys.exit(1)
+  if model == 'cluster':
+    s = np.array(data['nb_tot'], dtype=np.float64)
+    vol = float(data['ave_tot'][0] / data['ave_rel'][0])
+    names = ['nb_rel', 'max_rel', 'ave_rel']
+  else:
+    # The action -gamma * aligned needs gamma != 0 to recover aligned
+    if gamma == 0:
+      print "ERROR: Can't reweight MRT run", dirname, "at gamma = 0",
+      print "... aborting"
+      sys.exit(1)
+    s = np.round(-np.array(data['action_tot']) / gamma)
+    ok = ~(data['action_rel'] == 0)
+    vol = np.median(data['action_tot'][ok] / data['action_rel'][ok])
+    names = ['state1', 'state2', 'state3']
+  obs = dict((name, np.array(data[name], dtype=np.float64))
+             for name in names)
+  return s, np.round(vol), obs
+
+# The action per site at each gamma is a(gamma) * <s> / vol,
+# with act_frac from PottsClusterSim.set_gamma for the cluster simulations
+def action_frac(model, gamma):
+  if model == 'mrt':
+    return -gamma
+  if gamma == 0:
+    return 0.0
+  return -gamma / (1.0 - np.exp(-gamma))
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Parse arguments: file for the results, followed by the output
+# directories of the runs, each optionally given as dir:gamma
+# Optionally '--gammas' sets the comma-separated couplings to reweight to,
+# by default '--points N' evenly spaced between the smallest
+# and largest gamma of the runs
+# Optionally '--therm N' discards the first N sweeps of each run
+# and '--blocks N' sets the number of jackknife blocks
+# Optionally '--tolerance' sets the convergence criterion for the
+# free energies, with at most '--max-iter N' iterations
+if __name__ == '__main__':
+  args, options = parse_options(sys.argv, {'gammas': '',
+                                           'points': 50,
+                                           'therm': 0,
+                                           'blocks': 10,
+                                           'tolerance': 1e-10,
+                                           'max_iter': 100000})
+  if len(args) < 3 or options['blocks'] < 2 or options['points'] < 1:
+    print "Usage:", str(args[0]), "<results.csv> <dir>[:gamma] ..."
+    print "                    [--gammas g1,g2,...] [--points N]"
+    print "                    [--therm N] [--blocks N]"
+    print "                    [--tolerance X] [--max-iter N]"
+    sys.exit(1)
+  results = args[1]
+  blocks = options['blocks']
+
+  # Read all runs, checking they are from the same model and lattice
+  runs = []
+  for name in args[2:]:
+    model = run_model(name.rsplit(':', 1)[0])
+    dirname, gamma = run_gamma(name, model)
+    s, vol, obs = run_series(dirname, model, gamma, options['therm'])
+    if len(s) < blocks:
+      print "ERROR: Fewer sweeps than jackknife blocks in", dirname,
+      print "... aborting"
+      sys.exit(1)
+    runs.append({'dir': dirname, 'model': model, 'gamma': gamma,
+                 's': s, 'vol': vol, 'obs': obs})
+  model = runs[0]['model']
+  vol = runs[0]['vol']
+  for run in runs:
+    if not (run['model'] == model and run['vol'] == vol):
+      print "ERROR: Runs", runs[0]['dir'], "and", run['dir'],
+      print "can't be combined... aborting"
+      sys.exit(1)
+  Sim = models[model]
+  if model == 'cluster' and min(run['gamma'] for run in runs) <= 0:
+    print "ERROR: Cluster reweighting needs gamma > 0... aborting"
+    sys.exit(1)
+  c = np.array([Sim.coupling(run['gamma']) for run in runs])
+
+  if options['gammas'] == '':
+    gammas = np.linspace(min(run['gamma'] for run in runs),
+                         max(run['gamma'] for run in runs),
+                         options['points']).tolist()
+  else:
+    gammas = [float(g) for g in options['gammas'].split(',')]
+  lo = min(run['gamma'] for run in runs)
+  hi = max(run['gamma'] for run in runs)
+  for gamma in gammas:
+    if gamma < lo or gamma > hi:
+      print "WARNING: gamma", gamma, "outside range", lo, "to", hi,
+      print "covered by the runs"
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Histogram each block of each run over the distinct values of s,
+  # along with the sums of the observables (and s and s^2)
+  # counts[b, u] and sums[b, i, u] sum over all runs for block b,
+  # while N[b, k] counts the samples of run k in block b
+  names = sorted(runs[0]['obs'])
+  s = np.unique(np.concatenate([run['s'] for run in runs]))
+  counts = np.zeros((blocks, len(s)))
+  sums = np.zeros((blocks, len(names) + 2, len(s)))
+  N = np.zeros((blocks, len(runs)))
+  for k, run in enumerate(runs):
+    index = np.searchsorted(s, run['s'])
+    for b, part in enumerate(np.array_split(np.arange(len(index)),
+                                            blocks)):
+      N[b, k] = len(part)
+      counts[b] += np.bincount(index[part], minlength=len(s))
+      for i, name in enumerate(names):
+        sums[b, i] += np.bincount(index[part],
+                                  weights=run['obs'][name][part],
+                                  minlength=len(s))
+  sums[:, len(names)] = counts * s
+  sums[:, len(names) + 1] = counts * s**2
+
+  # Reweighted observables at each gamma, along with the action
+  # and the fluctuations of s (like the specific heat) per site
+  def estimate(n, tot, N, f=None):
+    f, logD, it = wham(s, n, N, c, f, options['tolerance'],
+                       options['max_iter'])
+    if it == options['max_iter']:
+      print "WARNING: Free energies not converged after", it, "iterations"
+    values = []
+    for gamma in gammas:
+      ave = reweight(Sim.coupling(gamma), s, n, logD, tot)
+      stat, stat2 = ave[-2:]
+      values.append(list(ave[:-2])
+                    + [action_frac(model, gamma) * stat / vol,
+                       (stat2 - stat**2) / vol])
+    return f, np.array(values), it
+
+  f, values, it = estimate(counts.sum(axis=0), sums.sum(axis=0),
+                           N.sum(axis=0))
+  print "Free energies converged in", it, "iterations:"
+  for run, fk in zip(runs, f):
+    print "  %-40s gamma %-10.6g N %-8d f %.8g" \
+          % (run['dir'], run['gamma'], len(run['s']), fk)
+
+  # Jackknife, starting from the full free energies each time
+  jack = []
+  for b in range(blocks):
+    jack.append(estimate(counts.sum(axis=0) - counts[b],
+                         sums.sum(axis=0) - sums[b],
+                         N.sum(axis=0) - N[b], f)[1])
+  jack = np.array(jack)
+  errors = np.sqrt((blocks - 1.0) / blocks
+                   * np.sum((jack - jack.mean(axis=0))**2, axis=0))
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # One line for each gamma, with each observable followed by its error
+  columns = names + ['action_rel', 'stat_susc']
+  with open(results, 'w') as RESULTS:
+    print >> RESULTS, ','.join(['gamma'] + sum([[name, name + '_err']
+                                                for name in columns], []))
+    for gamma, value, error in zip(gammas, values, errors):
+      print >> RESULTS, "%.8g," % gamma \
+                        + ','.join("%.8g,%.4g" % (v, e)
+                                   for v, e in zip(value, error))
+  print "Wrote", len(gammas), "couplings to", results
+# ------------------------------------------------------------------
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+import hashlib
+import numpy as np
+# Pseudorandom numbers for all applications
+#
+# The drivers draw all the random numbers needed for each sweep at once
+# (or for each block of updates on large lattices),
+# in blocks of fixed size that do not depend on the configuration
+# or on which updates are accepted, then hand them out one by one
+# This gives the following reproducibility contract:
+# * The same random_seed, generator, lattice, input parameters and options
+#   give bit-identical output with the same version of NumPy
+# * Sweep n always uses the n-th block of random numbers,
+#   so different ways of computing the same update
+#   (e.g. '--connect search' or '--connect dynamic') agree exactly
+# * Independent streams (e.g. for several chains) come from spawn()
+#   (see spawn_seeds below), and the i-th is always the same
+#
+# The drivers run under Python 2, whose last NumPy (1.16) predates
+# the Generator API, so the contract covers the legacy RandomState
+# (Mersenne Twister) stream only, which is the default
+# NumPy also guarantees to keep that stream unchanged across versions
+# The Generator API ('pcg64' and 'philox', seeded through SeedSequence)
+# is only used with NumPy 1.17 or later, and is untested here
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Available generators, with 'legacy' meaning NumPy's original RandomState
+# (Mersenne Twister), which is the only option before NumPy 1.17
+generators = ['legacy', 'pcg64', 'philox']
+
+def have_generator():
+  return hasattr(np.random, 'Generator')
+
+# Without the Generator API the others fall back to 'legacy',
+# with a warning printed only once per process
+warned = []
+
+def warn_fallback(generator):
+  if len(warned) == 0:
+    print "WARNING: NumPy", np.__version__, "has no Generator,",
+    print "using legacy RandomState instead of", generator
+    warned.append(generator)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+class RNG(object):
+  # seed may be an integer or a SeedSequence (from spawn)
+  def __init__(self, seed, generator='legacy'):
+    if not generator in generators:
+      raise ValueError("Unknown generator %s" % generator)
+    if not generator == 'legacy' and not have_generator():
+      warn_fallback(generator)
+      generator = 'legacy'
+    self.seed = seed
+    self.generator = generator
+
+    if generator == 'legacy':
+      self.gen = np.random.RandomState(seed)
+    else:
+      if isinstance(seed, np.random.SeedSequence):
+        sequence = seed
+      else:
+        sequence = np.random.SeedSequence(seed)
+      if generator == 'pcg64':
+        self.gen = np.random.Generator(np.random.PCG64(sequence))
+      else:
+        self.gen = np.random.Generator(np.random.Philox(sequence))
+
+  # Random integers in [low, high), like RandomState.randint
+  def integers(self, low, high, size=None):
+    if self.generator == 'legacy':
+      return self.gen.randint(low, high, size=size)
+    return self.gen.integers(low, high, size=size)
+
+  # Uniform random numbers in [0, 1)
+  def uniform(self, size=None):
+    if self.generator == 'legacy':
+      return self.gen.random_sample(size)
+    return self.gen.random(size)
+
+  # k distinct random integers in [0, n)
+  def sample(self, n, k):
+    return self.gen.choice(n, k, replace=False)
+
+  # Complete state of the generator, for checkpoints (see checkpoint.py)
+  def get_state(self):
+    if self.generator == 'legacy':
+      return self.gen.get_state()
+    return self.gen.bit_generator.state
+
+  def set_state(self, state):
+    if self.generator == 'legacy':
+      self.gen.set_state(state)
+    else:
+      self.gen.bit_generator.state = state
+
+  # Return n independent generators of the same type
+  def spawn(self, n):
+    return [RNG(child, self.generator)
+            for child in spawn_seeds(self.seed, self.generator, n)]
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Return n seeds for independent generators of the given type,
+# which can be passed to other processes to set up each RNG there
+# The i-th seed is always the same, however many are spawned
+# and however often
+#
+# For RandomState (including the fallback from the others),
+# the i-th seed is the SHA-256 digest of the text "seed,i",
+# with seed written as a comma-separated list if it is itself spawned,
+# read as eight little-endian 32-bit words, which RandomState takes
+# as the key for its array seeding of the Mersenne Twister
+# Every bit of seed and i then affects the whole initial state,
+# so neighboring seeds or indices give unrelated streams
+# Like any seeding of the Mersenne Twister this doesn't rule out
+# overlapping streams, but with period 2^19937 - 1 they are very unlikely
+#
+# For the Generator API these are instead SeedSequence children of seed
+# (from a fresh SeedSequence, since SeedSequence.spawn itself counts
+# the children spawned so far, and continues from there)
+# The RandomState seed (a list of eight 32-bit words) for the given text
+def legacy_seed(text):
+  digest = hashlib.sha256(text).digest()
+  return np.frombuffer(digest, dtype='<u4').tolist()
+
+def spawn_seeds(seed, generator, n):
+  if generator == 'legacy' or not have_generator():
+    seed = ','.join(str(int(s)) for s in np.atleast_1d(seed))
+    return [legacy_seed("%s,%d" % (seed, i)) for i in range(n)]
+  if isinstance(seed, np.random.SeedSequence):
+    sequence = np.random.SeedSequence(entropy=seed.entropy,
+                                      spawn_key=seed.spawn_key,
+                                      pool_size=seed.pool_size)
+  else:
+    sequence = np.random.SeedSequence(seed)
+  return sequence.spawn(n)
+# ------------------------------------------------------------------
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+import os
+import sys
+import struct
+import numpy as np
+from checkpoint import open_output
+# Output of the observables measured after each sweep
+#
+# Each simulation class in potts.py lists its output files as
+# (filename, [column names], format), e.g.
+#   ('action.csv', ['action_tot', 'action_rel'], "%d,%.8g,%.8g")
+# with the sweep number as the first column of every file
+# CSVOutput writes these files directly, one formatted line per sweep,
+# while BinaryOutput collects all the columns in a structured NumPy array
+# and appends it in chunks to the single file observables.npy
+# export.py turns observables.npy back into exactly the same csv files
+#
+# Both have record(sweep, obs) for the dictionary obs from measure()
+# and a list of files for checkpoint.output_sizes
+# Observables missing from obs (e.g. acceptances before the first sweep)
+# are skipped in the csv files and recorded as NaN in observables.npy
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+class CSVOutput(object):
+  # When resuming, sizes holds the size of each file at the checkpoint
+  def __init__(self, outdir, outputs, sizes=None):
+    self.outputs = outputs
+    self.files = []
+    for name, columns, form in outputs:
+      self.files.append(open_output(outdir + '/' + name,
+                                    ','.join(['sweep'] + columns), sizes))
+
+  def record(self, sweep, obs):
+    for (name, columns, form), f in zip(self.outputs, self.files):
+      if all(c in obs for c in columns):
+        print >> f, form % tuple([sweep] + [obs[c] for c in columns])
+
+  def close(self):
+    for f in self.files:
+      f.close()
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Structured dtype with one field for each column of the output files,
+# int64 for those printed with '%d' and float64 for the rest
+def series_dtype(outputs):
+  fields = [('sweep', np.int64)]
+  for name, columns, form in outputs:
+    for column, spec in zip(columns, form.split(',')[1:]):
+      if spec == '%d':
+        fields.append((column, np.int64))
+      else:
+        fields.append((column, np.float64))
+  return np.dtype(fields)
+
+# Append-only .npy file of records with the given dtype
+# Records are collected in a preallocated buffer of chunk rows,
+# which is appended to the file when it is full or flushed
+# The .npy header is padded to a fixed length, so that it can be
+# rewritten in place with the new number of records after each append
+# Like a file object, this has name, flush(), fileno() and tell()
+# for checkpoint.output_sizes
+class SeriesWriter(object):
+  magic = '\x93NUMPY\x01\x00'
+
+  # When resuming, sizes holds the size of each file at the checkpoint
+  def __init__(self, filename, dtype, chunk=1000, sizes=None):
+    self.name = filename
+    self.dtype = np.dtype(dtype)
+    self.buffer = np.zeros(max(int(chunk), 1), dtype=self.dtype)
+    self.nbuf = 0
+
+    # Leave room for any number of records, and align the data
+    self.descr = np.lib.format.dtype_to_descr(self.dtype)
+    length = len(self.magic) + 2 + len(self.header_dict(2**63)) + 1
+    self.offset = 64 * ((length + 63) // 64)
+
+    if sizes is None:
+      self.f = open(filename, 'w+b')
+      self.count = 0
+    else:
+      name = os.path.basename(filename)
+      if not os.path.isfile(filename) or not name in sizes:
+        print "ERROR: Can't resume", filename, "... aborting"
+        sys.exit(1)
+      self.f = open(filename, 'r+b')
+      self.f.truncate(sizes[name])
+      self.count = (sizes[name] - self.offset) // self.dtype.itemsize
+    self.write_header()
+
+  def header_dict(self, count):
+    return "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" \
+           % (self.descr, count)
+
+  def write_header(self):
+    header = self.header_dict(self.count)
+    hlen = self.offset - len(self.magic) - 2
+    self.f.seek(0)
+    self.f.write(self.magic + struct.pack('<H', hlen))
+    self.f.write(header.ljust(hlen - 1) + '\n')
+    self.f.seek(0, os.SEEK_END)
+
+  # values may be a tuple in the order of the fields, or a dictionary
+  def append(self, values):
+    if isinstance(values, dict):
+      values = tuple(values[name] for name in self.dtype.names)
+    self.buffer[self.nbuf] = values
+    self.nbuf += 1
+    if self.nbuf == len(self.buffer):
+      self.flush()
+
+  # Write the records before the header that counts them,
+  # so the file is never shorter than its header claims
+  def flush(self):
+    if self.nbuf > 0:
+      self.f.seek(0, os.SEEK_END)
+      self.f.write(self.buffer[:self.nbuf].tobytes())
+      self.count += self.nbuf
+      self.nbuf = 0
+      self.write_header()
+    self.f.flush()
+
+  def fileno(self):
+    return self.f.fileno()
+
+  def tell(self):
+    return self.offset + self.count * self.dtype.itemsize
+
+  def close(self):
+    self.flush()
+    self.f.close()
+
+class BinaryOutput(object):
+  filename = 'observables.npy'
+
+  # Append the buffered records to the file every chunk sweeps
+  def __init__(self, outdir, outputs, chunk=1000, sizes=None):
+    self.writer = SeriesWriter(outdir + '/' + self.filename,
+                               series_dtype(outputs), chunk, sizes)
+    self.files = [self.writer]
+
+  def record(self, sweep, obs):
+    names = self.writer.dtype.names
+    self.writer.append((sweep,) + tuple(obs.get(name, np.nan)
+                                        for name in names[1:]))
+
+  def close(self):
+    self.writer.close()
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# The drivers write csv files, observables.npy or both ('--output'),
+# returning the list of outputs to record each sweep
+output_formats = ['csv', 'binary', 'both']
+
+def open_series(outdir, outputs, form, chunk, sizes=None):
+  series = []
+  if form in ['csv', 'both']:
+    series.append(CSVOutput(outdir, outputs, sizes))
+  if form in ['binary', 'both']:
+    series.append(BinaryOutput(outdir, outputs, chunk, sizes))
+  return series
+
+# Write the csv files listed in outputs from the records in data,
+# skipping the lines for which any observables are NaN
+def export_csv(data, outputs, outdir):
+  for name, columns, form in outputs:
+    ok = np.ones(len(data), dtype=bool)
+    for c in columns:
+      if data.dtype[c].kind == 'f':
+        ok &= ~np.isnan(data[c])
+    rows = data[ok][['sweep'] + columns].tolist()
+    with open(outdir + '/' + name, 'w') as f:
+      print >> f, ','.join(['sweep'] + columns)
+      for row in rows:
+        print >> f, form % row
+
+# Read the observables listed in outputs back from outdir,
+# from observables.npy if it is there and otherwise from the csv files,
+# returning them as records with one row for each sweep
+# (NaN for floats missing from the csv files on some sweeps)
+def read_series(outdir, outputs):
+  filename = outdir + '/' + BinaryOutput.filename
+  dtype = series_dtype(outputs)
+  if os.path.isfile(filename):
+    data = np.load(filename, mmap_mode='r')
+    if not data.dtype.names == dtype.names:
+      print "ERROR: Unrecognized observables in", filename, "... aborting"
+      sys.exit(1)
+    return data
+
+  tables = []
+  for name, columns, form in outputs:
+    filename = outdir + '/' + name
+    if not os.path.isfile(filename):
+      print "ERROR:", filename, "not found... aborting"
+      sys.exit(1)
+    tables.append(np.loadtxt(filename, delimiter=',', skiprows=1,
+                             ndmin=2))
+  sweeps = np.unique(np.concatenate([t[:, 0] for t in tables]))
+  data = np.zeros(len(sweeps), dtype=dtype)
+  data['sweep'] = sweeps
+  for (name, columns, form), table in zip(outputs, tables):
+    index = np.searchsorted(sweeps, table[:, 0])
+    for i, c in enumerate(columns):
+      if data.dtype[c].kind == 'f':
+        data[c] = np.nan
+      data[c][index] = table[:, i + 1]
+  return data
+# ------------------------------------------------------------------
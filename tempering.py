@@ -0,0 +1,404 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import numpy as np
+from utils import parse_options, validation_levels
+from lattice import Lattice
+from potts import PottsClusterSim, PottsMRTSim, methods
+from rng import RNG, generators, spawn_seeds
+from checkpoint import *
+from series import output_formats
+from driver import Driver
+# ------------------------------------------------------------------
+# Parallel tempering (replica exchange) over a ladder of Potts couplings
+# gamma, for either the triality cluster simulations of PottsCluster.py
+# or the zero-density simulations of PottsMRT.py
+#
+# M replicas, each a simulation at one gamma of the ladder, run in turn
+# in this process, sharing the lattice
+# Every few sweeps we propose to exchange the couplings of replicas at
+# neighboring gammas, alternating between the even and odd pairs
+# Since the weight of each configuration depends on gamma only through
+# exp[coupling(gamma) * swap_stat()] (see potts.py),
+# the exchange of gamma_k and gamma_(k+1) between replicas with
+# statistics s_k and s_(k+1) is accepted with probability
+#   min{1, exp[(coupling(gamma_k) - coupling(gamma_(k+1)))
+#              * (s_(k+1) - s_k)]}
+# Replicas stuck in one phase can then escape by moving through the ladder
+#
+# ReplicaExchange runs in driver.py like any other simulation,
+# measuring the replica at each gamma in the ladder
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+class ReplicaExchange(object):
+  # sims is a list of simulations (all of the same class),
+  # one for each gamma in the ladder, in the same order
+  # prng draws the random numbers for the exchanges
+  def __init__(self, sims, gammas, prng, swap_every=1):
+    self.sims = sims
+    self.gammas = [float(g) for g in gammas]
+    self.prng = prng
+    self.swap_every = swap_every
+    self.M = len(sims)
+    self.rep = range(self.M)          # Replica at each gamma
+    self.nswap = 0                    # Number of rounds of exchanges
+    self.nsweep = 0                   # Not counting any tuning
+    self.outputs = sims[0].outputs
+    self.tracked = sims[0].tracked
+    self.reset_swaps()
+
+  def reset_swaps(self):
+    self.attempts = [0] * (self.M - 1)
+    self.accepts = [0] * (self.M - 1)
+
+  # Index in the ladder for each replica
+  def temperature(self):
+    temp = [0] * self.M
+    for k, r in enumerate(self.rep):
+      temp[r] = k
+    return temp
+
+  # Move the replicas to the given ladder of gammas,
+  # keeping the order of the replicas in the ladder
+  def set_ladder(self, gammas):
+    self.gammas = [float(g) for g in gammas]
+    for k, r in enumerate(self.rep):
+      self.sims[r].set_gamma(self.gammas[k])
+
+  # Do one sweep of every replica
+  def sweep(self):
+    for sim in self.sims:
+      sim.sweep()
+    self.nsweep += 1
+
+  # The observables of the replica at each gamma in the ladder
+  def measure(self):
+    return [self.sims[r].measure() for r in self.rep]
+
+  def validate(self):
+    for sim in self.sims:
+      sim.validate()
+
+  # One round of exchanges between neighboring gammas,
+  # for the even pairs (0, 1), (2, 3), ... or the odd pairs (1, 2), ...
+  # The same M - 1 uniform random numbers are drawn in every round
+  # Return the list of pairs k for which (k, k + 1) was attempted,
+  # with 1 for each accepted exchange and 0 otherwise
+  def swap(self):
+    ran_unif = self.prng.uniform(size=self.M - 1).tolist()
+    coupling = self.sims[0].coupling
+    result = [None] * (self.M - 1)
+    for k in range(self.nswap % 2, self.M - 1, 2):
+      i = self.rep[k]
+      j = self.rep[k + 1]
+      diff = (coupling(self.gammas[k]) - coupling(self.gammas[k + 1])) \
+             * (self.sims[j].swap_stat() - self.sims[i].swap_stat())
+      self.attempts[k] += 1
+      if diff >= 0 or ran_unif[k] < np.exp(diff):
+        self.rep[k] = j
+        self.rep[k + 1] = i
+        self.sims[j].set_gamma(self.gammas[k])
+        self.sims[i].set_gamma(self.gammas[k + 1])
+        self.accepts[k] += 1
+        result[k] = 1
+      else:
+        result[k] = 0
+    self.nswap += 1
+    return result
+
+  # Acceptance of the exchanges between each pair of neighboring gammas
+  def swap_acceptance(self):
+    return [float(a) / max(n, 1) for a, n in zip(self.accepts,
+                                                  self.attempts)]
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Tune the ladder from pilot runs, keeping the first and last gamma
+  # Each round runs nsweep sweeps with exchanges and measures
+  # the standard deviation sigma of swap_stat at each gamma
+  # (over the second half of the sweeps)
+  # The exchange acceptance between neighbors depends on the change
+  # in coupling times these fluctuations, so we place the new gammas
+  # at equal steps of the integral of sigma over the coupling,
+  # interpolated linearly between the current gammas
+  # Return the exchange acceptance for each pair in the last round
+  def tune(self, nsweep, rounds):
+    coupling = self.sims[0].coupling
+    for n in range(rounds):
+      self.reset_swaps()
+      stats = [[] for k in range(self.M)]
+      for sweep in range(1, nsweep + 1):
+        self.sweep()
+        if 2 * sweep > nsweep:
+          for k, r in enumerate(self.rep):
+            stats[k].append(self.sims[r].swap_stat())
+        if sweep % self.swap_every == 0:
+          self.swap()
+      accept = self.swap_acceptance()
+
+      c = np.array([coupling(g) for g in self.gammas])
+      sigma = np.array([np.std(s) for s in stats])
+      dist = np.concatenate([[0.0], np.cumsum(np.diff(c)
+                                              * (sigma[1:] + sigma[:-1])
+                                              / 2.0)])
+      if not np.all(np.diff(dist) > 0):
+        break                     # Not enough fluctuations to go on
+      target = np.linspace(0.0, dist[-1], self.M)
+      new = np.interp(target, dist, c)
+      gammas = [self.gamma_of(x) for x in new]
+      gammas[0] = self.gammas[0]
+      gammas[-1] = self.gammas[-1]
+      self.set_ladder(gammas)
+    self.reset_swaps()
+    self.nsweep = 0
+    return accept
+
+  # Invert the coupling of the simulations
+  def gamma_of(self, c):
+    if isinstance(self.sims[0], PottsClusterSim):
+      return np.log1p(np.exp(c))
+    return c
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # All the arrays of each replica, labelled by their index,
+  # along with their states and the exchange information
+  def get_state(self):
+    arrays = {}
+    states = []
+    for r, sim in enumerate(self.sims):
+      saved, state = sim.get_state()
+      for name in saved:
+        arrays['r%d_%s' % (r, name)] = saved[name]
+      states.append(state)
+    state = {'sweep': self.nsweep,
+             'replicas': states, 'gammas': self.gammas, 'rep': self.rep,
+             'nswap': self.nswap, 'attempts': self.attempts,
+             'accepts': self.accepts, 'rng': self.prng.get_state()}
+    return arrays, state
+
+  def set_state(self, arrays, state):
+    self.rep = list(state['rep'])
+    self.set_ladder(state['gammas'])
+    for r, sim in enumerate(self.sims):
+      prefix = 'r%d_' % r
+      saved = dict((name[len(prefix):], arrays[name]) for name in arrays
+                   if name.startswith(prefix))
+      sim.set_state(saved, state['replicas'][r])
+    self.nsweep = state['sweep']
+    self.nswap = state['nswap']
+    self.attempts = list(state['attempts'])
+    self.accepts = list(state['accepts'])
+    self.prng.set_state(state['rng'])
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Parse arguments: 3d lattice volume, number of baryons (zero for MRT),
+# smallest and largest gamma, number of replicas M, number of sweeps,
+# RNG seed and directory for output data
+# Optionally '--model mrt' runs PottsMRT.py simulations rather than
+# triality cluster simulations ('--model cluster'),
+# with '--sweep' and '--wolff-flips' as for PottsMRT.py
+# and '--connect' and '--validate' as for PottsCluster.py
+# By default the initial ladder is evenly spaced in the coupling
+# between the smallest and largest gamma, or '--ladder' gives all M gammas
+# Optionally '--tune-sweeps N' tunes the ladder in '--tune-rounds R'
+# pilot runs of N sweeps each, before the run itself
+# Exchanges are attempted every '--swap-every N' sweeps
+# The other options are the same as for PottsCluster.py
+if __name__ == '__main__':
+  args, options = parse_options(sys.argv, {'model': 'cluster',
+                                           'ladder': '',
+                                           'tune_sweeps': 0,
+                                           'tune_rounds': 3,
+                                           'swap_every': 1,
+                                           'sweep': 'random',
+                                           'wolff_flips': 10,
+                                           'connect': 'search',
+                                           'validate': 'strict',
+                                           'validate_every': 10,
+                                           'rng': 'legacy',
+                                           'output': 'csv',
+                                           'flush_every': 1000,
+                                           'checkpoint_every': 0,
+                                           'resume': False})
+  if len(args) < 11 or not options['model'] in ['cluster', 'mrt'] \
+                    or not options['sweep'] in methods \
+                    or not options['connect'] in ['search', 'dynamic'] \
+                    or not options['validate'] in validation_levels \
+                    or not options['rng'] in generators \
+                    or not options['output'] in output_formats \
+                    or options['swap_every'] < 1:
+    print "Usage:", str(args[0]), "<nx> <ny> <nz> <#baryons>"
+    print "                    <gamma_min> <gamma_max> <replicas>"
+    print "                    <sweeps> <random_seed> <out_dir>"
+    print "                    [--model cluster|mrt] [--ladder g1,g2,...]"
+    print "                    [--tune-sweeps N] [--tune-rounds R]"
+    print "                    [--swap-every N]"
+    print "                    [--sweep random|checkerboard|sw|wolff]"
+    print "                    [--wolff-flips N] [--connect search|dynamic]"
+    print "                    [--validate off|sampled|strict]"
+    print "                    [--validate-every N]"
+    print "                    [--rng legacy|pcg64|philox]"
+    print "                    [--output csv|binary|both] [--flush-every N]"
+    print "                    [--checkpoint-every N] [--resume]"
+    sys.exit(1)
+  dims = (int(args[1]), int(args[2]), int(args[3]))
+  NB = int(args[4])
+  gamma_min = float(args[5])
+  gamma_max = float(args[6])
+  M = int(args[7])
+  Nsweep = int(args[8])
+  seed = int(args[9])
+  outdir = args[10]
+  runtime = -time.time()
+  if options['model'] == 'cluster':
+    Sim = PottsClusterSim
+  else:
+    Sim = PottsMRTSim
+
+  # Set up the initial ladder, checking it makes sense
+  if not options['ladder'] == '':
+    gammas = [float(s) for s in options['ladder'].split(',')]
+  elif M > 1:
+    c = np.linspace(Sim.coupling(gamma_min), Sim.coupling(gamma_max), M)
+    if Sim is PottsClusterSim:
+      gammas = np.log1p(np.exp(c)).tolist()
+    else:
+      gammas = c.tolist()
+    gammas[0] = gamma_min             # Exactly
+    gammas[-1] = gamma_max
+  else:
+    gammas = [gamma_min]
+  if not len(gammas) == M or M < 2:
+    print "ERROR: Need a ladder of", M, "> 1 gammas... aborting"
+    sys.exit(1)
+  if Sim is PottsClusterSim and min(gammas) <= 0:
+    print "ERROR: Cluster replica exchange needs gamma > 0... aborting"
+    sys.exit(1)
+  if Sim is PottsMRTSim and not NB == 0:
+    print "ERROR: MRT simulations need zero baryons... aborting"
+    sys.exit(1)
+
+  # Create output directory if it doesn't exist already
+  if not os.path.isdir(outdir):
+    print "Creating directory", outdir, "for output"
+    os.makedirs(outdir)
+
+  # Save run parameters for posterity
+  # (appending to them if we are resuming an earlier run)
+  if options['resume']:
+    PARAMS = open(outdir + '/params.txt', 'a')
+  else:
+    PARAMS = open(outdir + '/params.txt', 'w')
+  print >> PARAMS, "python", ' '.join(sys.argv)
+
+  # Independent random numbers for each replica and for the exchanges
+  seeds = spawn_seeds(seed, options['rng'], M + 1)
+  prngs = [RNG(s, options['rng']) for s in seeds]
+  print >> PARAMS, "Random number generator:", prngs[0].generator
+  catch_sigterm()
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Set up the replicas, all on the same lattice
+  lattice = Lattice(dims)
+  sims = []
+  try:
+    for k in range(M):
+      if Sim is PottsClusterSim:
+        sims.append(PottsClusterSim(lattice, NB, gammas[k], prngs[k],
+                                    options['connect']))
+      else:
+        sims.append(PottsMRTSim(lattice, gammas[k], prngs[k],
+                                options['sweep'], options['wolff_flips']))
+  except ValueError as e:
+    print "ERROR:", e, "... aborting"
+    sys.exit(1)
+  pt = ReplicaExchange(sims, gammas, prngs[M], options['swap_every'])
+
+  # With '--resume', replace all of this by the checkpoint,
+  # including the ladder, or else tune the ladder if requested
+  state = None
+  setup = dims + (NB, gamma_min, gamma_max, M, seed, prngs[0].generator,
+                  options['model'])
+  if options['resume']:
+    saved, state = load_checkpoint(outdir)
+    check_resume(state, setup)
+    pt.set_state(saved, state)
+    print >> PARAMS, "Resuming after sweep", state['sweep']
+  else:
+    if options['tune_sweeps'] > 0:
+      accept = pt.tune(options['tune_sweeps'], options['tune_rounds'])
+      print >> PARAMS, "Pilot exchange acceptance:",
+      print >> PARAMS, ' '.join("%.3g" % a for a in accept)
+    print >> PARAMS, "Ladder:", ' '.join("%.8g" % g for g in pt.gammas)
+
+    # Record the ladder
+    LADDER = open(outdir + '/ladder.csv', 'w')
+    print >> LADDER, "index,gamma"
+    for k, g in enumerate(pt.gammas):
+      print >> LADDER, "%d,%.8g" % (k, g)
+    LADDER.close()
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Open files for output
+  # Each gamma in the ladder has its own directory temp<k>,
+  # with the usual output files for whichever replica is at that gamma
+  # replicas.csv records the index in the ladder of each replica,
+  # so that the time series of each replica can also be put together
+  # swaps.csv records each attempted exchange of each pair of neighbors
+  # Since the file names repeat, the checkpoint records the sizes
+  # of the files in each directory separately (see driver.py)
+  driver = Driver(pt, outdir, options, setup, PARAMS, state,
+                  ['temp%d' % k for k in range(M)], analyze=False)
+  header = ','.join(['sweep'] + ['r%d' % r for r in range(M)])
+  REPLICAS = driver.open_output('replicas.csv', header)
+  header = ','.join(['sweep'] + ['swap%d' % k for k in range(M - 1)])
+  SWAPS = driver.open_output('swaps.csv', header)
+
+  # After measuring at each gamma, record where each replica is,
+  # then attempt the exchanges every options['swap_every'] sweeps
+  def print_swaps(sweep):
+    print >> REPLICAS, "%d,%s" % (sweep, ','.join(str(k) for k in
+                                                  pt.temperature()))
+    if sweep > 0 and sweep % options['swap_every'] == 0:
+      result = pt.swap()
+      print >> SWAPS, "%d,%s" % (sweep, ','.join('' if a is None
+                                                 else str(a)
+                                                 for a in result))
+  driver.after = print_swaps
+
+  # Loop over sweeps, with sanity checks as often as requested
+  # by options['validate']
+  driver.run(Nsweep)
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Clean up and close down
+  driver.close()
+
+  print >> PARAMS, "Exchange acceptance:",
+  print >> PARAMS, ' '.join("%.3g" % a for a in pt.swap_acceptance())
+  runtime += time.time()
+  print "Runtime: %0.1f seconds" % runtime
+  print >> PARAMS, "Runtime: %0.1f seconds" % runtime
+  PARAMS.close()
+# ------------------------------------------------------------------
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+import random
+import unittest
+import numpy as np
+from utils import has_bond, add_bond, remove_bond, build_cluster
+from lattice import Lattice
+from connectivity import DynamicConnectivity, find_root
+# ------------------------------------------------------------------
+# Unit tests for connectivity.py, run with
+#   python -m unittest test_connectivity
+# Each answer of DynamicConnectivity is checked against the clusters
+# found by searching the lattice with utils.build_cluster,
+# along with the HDT invariant that each tree of F_i has <= vol / 2^i sites
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Set up the given lattice with the given occupation numbers and no bonds,
+# both for DynamicConnectivity and for the searches in utils.py
+def setup(dims, occupation):
+  lattice = Lattice(dims)
+  bond = np.zeros(lattice.vol, dtype=np.uint8)
+  conn = DynamicConnectivity(lattice.neighbor, lattice.Ndim, occupation)
+  return lattice, bond, conn
+
+# Add or remove the bond at the given site in direction mu
+# from both the bond array and the DynamicConnectivity
+# Return what DynamicConnectivity.delete returns when removing,
+# and None when adding
+def toggle(lattice, bond, conn, site, mu):
+  edge = site * lattice.Ndim + mu
+  if has_bond(bond, site, mu):
+    remove_bond(bond, site, mu)
+    return conn.delete(edge)
+  add_bond(bond, site, mu)
+  conn.insert(edge)
+  return None
+
+# Sorted list of the sites in the cluster containing site,
+# found by searching the lattice
+def search(lattice, bond, site):
+  cluster = []
+  build_cluster(bond, site, cluster, lattice)
+  return sorted(cluster)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+class TestDynamicConnectivity(unittest.TestCase):
+  # Check every cluster against the searches in utils.py
+  def check_clusters(self, lattice, bond, conn, occupation):
+    done = np.zeros(lattice.vol, dtype=bool)
+    for site in range(lattice.vol):
+      if done[site]:
+        continue
+      cluster = search(lattice, bond, site)
+      done[cluster] = True
+      self.assertEqual(sorted(conn.cluster_sites(site)), cluster)
+      self.assertEqual(conn.cluster_size(site), len(cluster))
+      self.assertEqual(conn.quarks(site), np.sum(occupation[cluster]))
+      for other in cluster:
+        self.assertTrue(conn.connected(site, other))
+    self.assertTrue(done.all())
+
+    # Check some pairs of sites in different clusters
+    for site in range(lattice.vol):
+      other = (site * 7 + 3) % lattice.vol
+      same = other in search(lattice, bond, site)
+      self.assertEqual(conn.connected(site, other), same)
+
+  # Each tree of the forest F_i has at most vol / 2^i sites,
+  # and no bond has a level above Lmax = log2(vol)
+  def check_levels(self, conn):
+    for i in range(conn.Lmax + 1):
+      for n in conn.vnodes[i].values():
+        self.assertTrue(find_root(n).nsite <= conn.vol >> i)
+    for edge, lev in conn.level.items():
+      self.assertTrue(0 <= lev <= conn.Lmax)
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Remove bonds from the square of sites 0, 1, 5, 4 in the xy-plane
+  # of a 4^3 lattice, with one quark at each of these sites
+  def square(self):
+    occupation = np.zeros(64, dtype=np.uint8)
+    occupation[[0, 1, 4, 5]] = 1
+    lattice, bond, conn = setup((4, 4, 4), occupation)
+    for site, mu in [(0, 0), (1, 1), (4, 0), (0, 1)]:
+      self.assertEqual(toggle(lattice, bond, conn, site, mu), None)
+    return lattice, bond, conn, occupation
+
+  def test_insert(self):
+    lattice, bond, conn, occupation = self.square()
+    self.assertTrue(conn.connected(0, 5))
+    self.assertEqual(conn.cluster_size(0), 4)
+    self.assertEqual(conn.quarks(5), 4)
+    self.assertFalse(conn.connected(0, 2))
+    self.assertEqual(conn.cluster_size(2), 1)
+    self.check_clusters(lattice, bond, conn, occupation)
+    self.check_levels(conn)
+
+  # Removing any bond of the square leaves the other three to connect it
+  # Whichever of them is a tree bond is replaced by the non-tree one
+  def test_delete_with_replacement(self):
+    for site, mu in [(0, 0), (1, 1), (4, 0), (0, 1)]:
+      lattice, bond, conn, occupation = self.square()
+      self.assertEqual(toggle(lattice, bond, conn, site, mu), 1)
+      self.assertEqual(conn.cluster_size(0), 4)
+      self.assertEqual(conn.quarks(0), 4)
+      self.check_clusters(lattice, bond, conn, occupation)
+      self.check_levels(conn)
+
+  # Removing two opposite bonds splits the square in two,
+  # first with and then without a replacement
+  def test_delete_without_replacement(self):
+    lattice, bond, conn, occupation = self.square()
+    self.assertEqual(toggle(lattice, bond, conn, 0, 0), 1)
+    self.assertEqual(toggle(lattice, bond, conn, 4, 0), -1)
+    self.assertTrue(conn.connected(0, 4))
+    self.assertTrue(conn.connected(1, 5))
+    self.assertFalse(conn.connected(0, 1))
+    self.assertEqual(conn.cluster_size(0), 2)
+    self.assertEqual(conn.cluster_size(5), 2)
+    self.assertEqual(conn.quarks(4), 2)
+    self.check_clusters(lattice, bond, conn, occupation)
+    self.check_levels(conn)
+
+    # Removing the last bond of each pair leaves only single sites
+    self.assertEqual(toggle(lattice, bond, conn, 0, 1), -1)
+    self.assertEqual(toggle(lattice, bond, conn, 1, 1), -1)
+    self.assertEqual(conn.roots()[1].tolist(), [1] * 64)
+    self.check_clusters(lattice, bond, conn, occupation)
+
+  # A bond that closes a loop is a non-tree bond,
+  # and removing it never splits the cluster
+  def test_delete_non_tree(self):
+    lattice, bond, conn, occupation = self.square()
+    edge = 0 * lattice.Ndim + 1
+    self.assertFalse(edge in conn.enodes[0])
+    self.assertEqual(toggle(lattice, bond, conn, 0, 1), 1)
+    self.check_clusters(lattice, bond, conn, occupation)
+  # ----------------------------------------------------------------
+
+
+
+  # ----------------------------------------------------------------
+  # Add and remove random bonds, also moving quarks around,
+  # and compare everything against the searches after each step
+  # The delete() result must agree with a search for the other end
+  def random_bonds(self, dims, steps, seed):
+    prng = random.Random(seed)
+    vol = int(np.prod(dims))
+    occupation = np.array([prng.randint(0, 6) for i in range(vol)])
+    lattice, bond, conn = setup(dims, occupation)
+    Ndim = lattice.Ndim
+    for step in range(steps):
+      site = prng.randrange(vol)
+      mu = prng.randrange(Ndim)
+      connect = toggle(lattice, bond, conn, site, mu)
+      if connect is not None:
+        neigh = lattice.neighbor[site][mu]
+        same = neigh in search(lattice, bond, site)
+        self.assertEqual(connect, 1 if same else -1)
+
+      # Occasionally move a quark to a random site
+      if step % 5 == 0:
+        ran = prng.randrange(vol)
+        new = prng.randrange(vol)
+        if occupation[ran] > 0:
+          occupation[ran] -= 1
+          occupation[new] += 1
+          conn.add_quarks(ran, -1)
+          conn.add_quarks(new, 1)
+
+      if step % 25 == 0 or step == steps - 1:
+        self.check_clusters(lattice, bond, conn, occupation)
+        self.check_levels(conn)
+
+  def test_random_3d(self):
+    self.random_bonds((4, 4, 4), 1500, 1)
+
+  # In 4d with nt = 2, both bonds in the t direction join the same sites
+  def test_random_4d(self):
+    self.random_bonds((3, 3, 2, 2), 1500, 2)
+
+  # Fill most of the lattice with bonds and then empty it again,
+  # which pushes bonds up through the levels
+  def test_fill_and_empty(self):
+    prng = random.Random(3)
+    dims = (4, 4, 4)
+    occupation = np.zeros(64, dtype=np.uint8)
+    lattice, bond, conn = setup(dims, occupation)
+    edges = [(site, mu) for site in range(64) for mu in range(3)]
+    prng.shuffle(edges)
+    for site, mu in edges:
+      toggle(lattice, bond, conn, site, mu)
+    self.check_clusters(lattice, bond, conn, occupation)
+    prng.shuffle(edges)
+    for n, (site, mu) in enumerate(edges):
+      neigh = lattice.neighbor[site][mu]
+      connect = toggle(lattice, bond, conn, site, mu)
+      same = neigh in search(lattice, bond, site)
+      self.assertEqual(connect, 1 if same else -1)
+      if n % 16 == 0:
+        self.check_levels(conn)
+    self.check_clusters(lattice, bond, conn, occupation)
+    self.assertEqual(conn.level, {})
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+if __name__ == '__main__':
+  unittest.main()
+# ------------------------------------------------------------------
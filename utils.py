@@ -6,6 +6,39 @@ import numpy as np
 
 
 
+# ------------------------------------------------------------------
+# Separate optional '--name value' arguments from the positional ones
+# The dictionary defaults lists the allowed options and their default values,
+# which also set the type of each option (boolean options take no value)
+# Return the list of positional arguments and a dictionary of all options
+def parse_options(argv, defaults):
+  args = []
+  options = dict(defaults)
+  i = 0
+  while i < len(argv):
+    if not argv[i].startswith('--'):
+      args.append(argv[i])
+      i += 1
+      continue
+
+    name = argv[i][2:].replace('-', '_')
+    if not name in defaults:
+      print "ERROR: Unknown option", argv[i], "... aborting"
+      sys.exit(1)
+    if isinstance(defaults[name], bool):
+      options[name] = True
+      i += 1
+    elif i + 1 < len(argv):
+      options[name] = type(defaults[name])(argv[i + 1])
+      i += 2
+    else:
+      print "ERROR: No value given for option", argv[i], "... aborting"
+      sys.exit(1)
+  return args, options
+# ------------------------------------------------------------------
+
+
+
 # ------------------------------------------------------------------
 # Simple helper utility to convert from (x, y, z) to single unsigned int
 # !!! Currently assuming that x<nx, etc.  Would be safer to check this
@@ -15,66 +48,90 @@ def site_index(x, y, z, lattice):
 
 
 
+# ------------------------------------------------------------------
+# Return list of arrays [x, y, z, ...] with the coordinates of each site,
+# for any number of dimensions with dims = (nx, ny, nz, ...)
+# and the x index running fastest, matching site_index above
+def site_coords(dims):
+  vol = int(np.prod(dims))
+  index = np.arange(vol, dtype=np.int32)
+  coords = np.unravel_index(index, tuple(dims)[::-1])
+  return [c.astype(np.int32) for c in coords[::-1]]
+
+# Build table of neighbors for each site, neighbor[site][direction]
+# The first Ndim directions are forward, the next Ndim are backward,
+# so direction Ndim + mu points opposite to direction mu
+# This works for any number of dimensions, with dims = (nx, ny, nz, ...)
+# and the x index running fastest, matching site_index above
+# Site indices are stored as 32-bit integers to save memory,
+# which limits the lattice volume to 2^31 sites
+def neighbor_table(dims):
+  Ndim = len(dims)
+  vol = int(np.prod(dims))
+  if vol >= 2**31:
+    print "ERROR: Lattice volume", vol, "too large for int32... aborting"
+    sys.exit(1)
+
+  # Reshape site indices into lattice with axes ordered (..., z, y, x)
+  index = np.arange(vol, dtype=np.int32).reshape(tuple(dims)[::-1])
+  neighbor = np.empty((vol, 2 * Ndim), dtype=np.int32)
+  for mu in range(Ndim):
+    axis = Ndim - 1 - mu
+    # Rolling by -1 moves the site at +1 in direction mu onto each site
+    neighbor[:, mu] = np.roll(index, -1, axis=axis).ravel()
+    neighbor[:, Ndim + mu] = np.roll(index, 1, axis=axis).ravel()
+  return neighbor
+# ------------------------------------------------------------------
+
+
+
 # ------------------------------------------------------------------
 # Randomly choose neighboring site in either direction
-# Use MILC ordering conventions for directions
 def get_neighbor(site, lattice):
-  new_x = lattice['x'][site]
-  new_y = lattice['y'][site]
-  new_z = lattice['z'][site]
-  ran_dir = lattice['prng'].randint(0, lattice['Ndir'])
-  if ran_dir == 0:
-    new_x += 1
-  elif ran_dir == 1:
-    new_y += 1
-  elif ran_dir == 2:
-    new_z += 1
-  elif ran_dir == 3:
-    new_z -= 1
-  elif ran_dir == 4:
-    new_y -= 1
-  elif ran_dir == 5:
-    new_x -= 1
-
-  # Keep new site within proper range of lattice volume
-  new_x = np.uint(np.mod(new_x, lattice['nx']))
-  new_y = np.uint(np.mod(new_y, lattice['ny']))
-  new_z = np.uint(np.mod(new_z, lattice['nz']))
-  return np.uint(site_index(new_x, new_y, new_z, lattice))
+  ran_dir = lattice['prng'].integers(0, lattice['Ndir'])
+  return lattice['neighbor'][site][ran_dir]
 
 # Figure out the site on the other side of the given bond
 def follow_bond(site, bond, lattice):
-  new_x = lattice['x'][site]
-  new_y = lattice['y'][site]
-  new_z = lattice['z'][site]
-  if bond == 0:
-    new_x += 1
-  elif bond == 1:
-    new_y += 1
-  elif bond == 2:
-    new_z += 1
-  elif bond == 3:
-    new_x -= 1
-  elif bond == 4:
-    new_y -= 1
-  elif bond == 5:
-    new_z -= 1
+  return lattice['neighbor'][site][bond]
+# ------------------------------------------------------------------
+
 
-  # Keep new site within proper range of lattice volume
-  new_x = np.uint(np.mod(new_x, lattice['nx']))
-  new_y = np.uint(np.mod(new_y, lattice['ny']))
-  new_z = np.uint(np.mod(new_z, lattice['nz']))
-  return np.uint(site_index(new_x, new_y, new_z, lattice))
+
+# ------------------------------------------------------------------
+# Bonds are bit-packed into one uint8 per site (so Ndim <= 8),
+# with bit mu of bond[site] set if the bond between site
+# and its neighbor in forward direction mu is present
+def has_bond(bond, site, mu):
+  return (int(bond[site]) >> mu) & 1
+
+def add_bond(bond, site, mu):
+  bond[site] |= 1 << mu
+
+def remove_bond(bond, site, mu):
+  bond[site] &= 0xFF ^ (1 << mu)
+
+# Unpack the bonds into a (vol, Ndim) boolean array,
+# whose flattened indices are the edge labels used by connectivity.py
+def unpack_bonds(bond, Ndim):
+  return ((bond[:, None] >> np.arange(Ndim, dtype=np.uint8)) & 1).astype(bool)
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
+# Place NB baryons at random on the lattice, with at most two per site,
+# returning the (uint8) occupation numbers {0, 3, 6} of all sites
+# Each site has two slots that can each hold one baryon,
+# and we choose NB distinct slots among the 2vol with a single call
+def place_baryons(NB, vol, prng):
+  slots = prng.sample(2 * int(vol), int(NB))
+  baryons = np.bincount(slots // 2, minlength=int(vol))
+  return (3 * baryons).astype(np.uint8)
+
 # Sanity check: Make sure sum of all occupation numbers equals Nq
 def check_Nq(occupation, Nq):
-  tot = np.uint(0)        # Set proper type
-  for i in range(len(occupation)):
-    tot += occupation[i]
+  tot = np.sum(occupation, dtype=np.uint)
 
   if not tot == Nq:
     print "ERROR: Counted", tot, "rather than", Nq, "quarks... aborting"
@@ -92,28 +149,132 @@ def check_occupation(occupation, cluster):
 
 
 # ------------------------------------------------------------------
+# Each site points to a label, and each label to its parent label,
+# forming union-find trees whose roots label the clusters
+# Merging two clusters only attaches one root to the other,
+# while splitting a cluster moves one fragment to a new label,
+# which is safe since sites only ever point to labels, not to other sites
+# Labels are in [0, vol), with those not currently in use
+# kept on the list free
+# size[r] and quarks[r] count the sites and quarks in cluster r,
+# and are only meaningful when r is a root
+
 # Simple helper utility to get root of given site
-def get_root(root, site):
-  # Follow pointers from each site to the root of its cluster
-  ptr = root[site]
-  while not root[ptr] == ptr:
-    new = root[ptr]     # Let's be cautious about overwriting ptr...
-    ptr = new
-  return ptr
+# Along the way, point every label on the path to its grandparent
+# ("path halving"), and the site directly to the root
+def get_root(root, parent, site):
+  r = root[site]
+  while not parent[r] == r:
+    parent[r] = parent[parent[r]]
+    r = parent[r]
+  root[site] = r
+  return r
+
+# Merge the clusters with the two given (distinct) roots,
+# attaching the smaller cluster to the larger one ("union by size")
+# A single site is instead relabelled, which frees its label right away
+# Return the root of the merged cluster
+def merge_clusters(root, parent, size, quarks, free, site1, site2,
+                   root1, root2):
+  if size[root1] < size[root2]:
+    root1, root2 = root2, root1
+    site2 = site1
+
+  if size[root2] == 1:
+    root[site2] = root1
+    free.append(root2)
+  else:
+    parent[root2] = root1
+  size[root1] += size[root2]
+  quarks[root1] += quarks[root2]
+  return root1
+
+# Root of the cluster of every site at once, without changing anything
+def flat_roots(root, parent):
+  flat = np.array(parent)
+  while True:
+    up = flat[flat]
+    if np.array_equal(up, flat):
+      break
+    flat = up
+  return flat[root]
+
+# Point every site directly to its root, so that the labels
+# that are no longer roots can go back on the list free
+def compact_labels(root, parent, free):
+  root[:] = flat_roots(root, parent)
+  parent[:] = np.arange(len(parent), dtype=parent.dtype)
+  used = np.zeros(len(parent), dtype=bool)
+  used[root] = True
+  free[:] = np.flatnonzero(~used).tolist()
+
+# Split the given (complete) cluster, with Nq quarks,
+# off from the rest of the cluster containing it,
+# relabelling only the sites in the given cluster
+# This should be the smaller of the two fragments
+# When no labels are free, first compact the labels,
+# freeing every label merged away since the last time
+# Return the root of the new cluster
+def split_cluster(root, parent, size, quarks, free, cluster, Nq):
+  if len(free) == 0:
+    compact_labels(root, parent, free)
+  old_root = get_root(root, parent, cluster[0])
+  new_root = free.pop()
+  parent[new_root] = new_root
+  root[np.array(cluster, dtype=root.dtype)] = new_root
+  size[new_root] = len(cluster)
+  size[old_root] -= len(cluster)
+  quarks[new_root] = Nq
+  quarks[old_root] -= Nq
+  return new_root
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
-# Determine sizes of all clusters, printing size of largest
-def count_clusters(root, numCluster, sweep, MAXCLUSTER):
-  # Can have up to len(root) clusters -- maybe more than we need
-  clusters = np.zeros(len(root), dtype=np.uint)
-  for i in range(len(root)):
-    ptr = get_root(root, i)
+# Keep histogram of cluster sizes, hist[s] = number of clusters with s sites
+# Record that clusters with the sizes listed in old
+# have been replaced by clusters with the sizes listed in new
+def change_histogram(hist, old, new):
+  for s in old:
+    hist[int(s)] -= 1
+  for s in new:
+    hist[int(s)] += 1
+
+# Size of largest cluster, given the previous largest size
+# which is an upper bound as long as there have been no merges since
+def largest_cluster(hist, previous):
+  largest = int(previous)
+  while hist[largest] == 0:
+    largest -= 1
+  return largest
+# ------------------------------------------------------------------
+
 
-    # Increment size of corresponding cluster
-    clusters[ptr] += 1
+
+# ------------------------------------------------------------------
+# How often the cluster drivers check their stored information:
+# never ('off'), every N sweeps ('sampled') or after every sweep ('strict')
+validation_levels = ['off', 'sampled', 'strict']
+
+def validate_sweep(level, every, sweep):
+  if level == 'strict':
+    return True
+  if level == 'sampled':
+    return every > 0 and sweep % every == 0
+  return False
+
+# Determine sizes of all clusters from the roots of all sites at once
+# This is only used to validate the stored cluster information:
+# the size and number of quarks for each root, histogram of sizes,
+# and the total number of clusters
+def count_clusters(root, size, quarks, hist, occupation, numCluster):
+  # Can have up to len(root) clusters -- maybe more than we need
+  # Count sites and quarks for each root
+  # (summing the quarks as floats, which is exact for any lattice we can fit)
+  clusters = np.bincount(root, minlength=len(root))
+  Nq = np.bincount(root, weights=occupation, minlength=len(root))
+  Nq = Nq.astype(np.int64)
 
   # Check that all sites are accounted for
   if not np.sum(clusters) == len(root):
@@ -121,33 +282,36 @@ def count_clusters(root, numCluster, sweep, MAXCLUSTER):
           % (np.sum(clusters), len(root))
     sys.exit(1)
 
-  # Count total number of clusters and check against numCluster
-  tot = 0
-  tot = np.uint(tot)        # Set proper type
-  for i in range(len(root)):
-    if clusters[i] > 0:
-      tot += np.uint(1)
+  # Check that the stored size and quark count of each cluster are correct
+  roots = np.nonzero(clusters)[0]
+  if not np.array_equal(clusters[roots], size[roots]):
+    print "ERROR: Stored cluster sizes don't match counted sizes... aborting"
+    sys.exit(1)
+  if not np.array_equal(Nq[roots], quarks[roots]):
+    print "ERROR: Stored quark counts don't match counted quarks... aborting"
+    sys.exit(1)
+  counted = np.bincount(clusters[roots], minlength=len(hist))
+  if not np.array_equal(counted, hist):
+    print "ERROR: Cluster size histogram doesn't match counted sizes...",
+    print "aborting"
+    sys.exit(1)
 
+  # Count total number of clusters and check against numCluster
+  tot = len(np.unique(root))
   if not tot == numCluster:
     print "ERROR: Counted", tot, "rather than", numCluster, "clusters...",
     print "aborting"
     sys.exit(1)
-
-  # Print largest cluster size, both absolute and as fraction of total volume
-  tot = np.amax(clusters)
-  rel = np.amax(clusters) / float(len(root))
-  print >> MAXCLUSTER, "%d,%d,%.8g" % (sweep, tot, rel)
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
-# Count total number of bonds
+# Count total number of bonds, one bit at a time
 def count_bonds(bond, numBonds):
-  tot = np.uint(0)        # Set proper type
-  for i, mu in np.ndindex(bond.shape):
-    if bond[i][mu]:
-      tot += 1
+  tot = 0
+  for mu in range(8):
+    tot += np.count_nonzero((bond >> mu) & 1)
 
   if not tot == numBonds:
     print "ERROR: Counted", tot, "rather than", numBonds, "bonds...",
@@ -158,63 +322,197 @@ def count_bonds(bond, numBonds):
 
 
 # ------------------------------------------------------------------
-# Build cluster by recursively following all bonds
-def build_cluster(bond, start, cluster, lattice):
-  # Add this site to the cluster
-  cluster.append(start)
+# Count the sites in each of the Nstate states of a Potts configuration,
+# and the number of aligned pairs of nearest neighbors (in the same state)
+# Each pair is counted once, comparing the lattice (with axes ordered
+# (..., z, y, x) as in neighbor_table) with its shift in each direction
+# Return the list of counts for each state and the number of aligned pairs
+def potts_counts(config, dims, Nstate):
+  magnet = np.bincount(config.astype(np.intp), minlength=Nstate)
+  lat = config.reshape(tuple(int(n) for n in dims)[::-1])
+  aligned = 0
+  for axis in range(len(dims)):
+    aligned += np.count_nonzero(lat == np.roll(lat, -1, axis=axis))
+  return magnet.tolist(), aligned
+
+# Check running totals of the state counts and aligned pairs
+def check_potts(config, dims, Nstate, magnet, aligned):
+  counted, tot = potts_counts(config, dims, Nstate)
+  if not list(magnet) == counted:
+    print "ERROR: Counted", counted, "sites in each state rather than",
+    print list(magnet), "... aborting"
+    sys.exit(1)
+  if not tot == aligned:
+    print "ERROR: Counted", tot, "rather than", aligned, "aligned pairs...",
+    print "aborting"
+    sys.exit(1)
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Return the neighbors of the given site that are connected to it by bonds
+def bonded_neighbors(bond, site, lattice):
+  Ndim = lattice['Ndim']
+  neighbor = lattice['neighbor'][site]
+  bonded = []
 
-  # Recursively check neighbors that are not yet in the cluster
   # Forward directions
-  for direction in range(lattice['Ndim']):
-    if bond[start][direction]:
-      tovisit = follow_bond(start, direction, lattice)
-      if not tovisit in cluster:
-        build_cluster(bond, tovisit, cluster, lattice)
+  site_bond = int(bond[site])
+  for direction in range(Ndim):
+    if (site_bond >> direction) & 1:
+      bonded.append(neighbor[direction])
 
   # Backward directions -- need to check bonds at neighboring sites
-  for direction in range(lattice['Ndim']):
-    tocheck = follow_bond(start, 3 + direction, lattice)
-    if bond[tocheck][direction]:
-      if not tocheck in cluster:
-        build_cluster(bond, tocheck, cluster, lattice)
+  for direction in range(Ndim):
+    tocheck = neighbor[Ndim + direction]
+    if (int(bond[tocheck]) >> direction) & 1:
+      bonded.append(tocheck)
+  return bonded
+
+# Start a new traversal of the lattice
+# Sites are marked as visited by setting lattice['visited'][site]
+# to the current generation, so nothing needs to be cleared between calls
+# Only when the generation would overflow the (uint32) visited array
+# do we clear it and start counting again
+def new_generation(lattice):
+  visited = lattice['visited']
+  if lattice['generation'] == np.iinfo(visited.dtype).max:
+    visited[:] = 0
+    lattice['generation'] = 0
+  lattice['generation'] += 1
+  return lattice['generation']
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Build cluster by following all bonds
+# The cluster list itself serves as the queue of sites still to check,
+# so there is no recursion and the cost is linear in the cluster size
+def build_cluster(bond, start, cluster, lattice):
+  visited = lattice['visited']
+  gen = new_generation(lattice)
+
+  # Add this site to the cluster
+  visited[start] = gen
+  cluster.append(start)
+
+  # Check neighbors of each site in the cluster that are not yet in it
+  ptr = len(cluster) - 1
+  while ptr < len(cluster):
+    for tovisit in bonded_neighbors(bond, cluster[ptr], lattice):
+      if not visited[tovisit] == gen:
+        visited[tovisit] = gen
+        cluster.append(tovisit)
+    ptr += 1
 # ------------------------------------------------------------------
 
 
 
 # ------------------------------------------------------------------
 # Check if target site is in the same cluster as start
-# Same recursive approach as build_cluster above
+# Same approach as build_cluster above
 # But now return as soon as target is found, to be more efficient
 # Returning +1 means the cluster remains connected
 # Returning -1 means the full cluster has been built without hitting target
 def check_connect(bond, start, cluster, lattice, target):
+  visited = lattice['visited']
+  gen = new_generation(lattice)
+
   # We would have returned if this site is our target
   # so we can safely add it to the cluster
+  visited[start] = gen
   cluster.append(start)
 
-  # Recursively check neighbors that are not yet in the cluster
-  # Forward directions
-  for direction in range(lattice['Ndim']):
-    if bond[start][direction]:
-      tovisit = follow_bond(start, direction, lattice)
+  ptr = len(cluster) - 1
+  while ptr < len(cluster):
+    for tovisit in bonded_neighbors(bond, cluster[ptr], lattice):
       if tovisit == target:
         return 1
-      if not tovisit in cluster:
-        test = check_connect(bond, tovisit, cluster, lattice, target)
-        if test > 0:      # Otherwise keep going
-          return test
-
-  # Backward directions -- need to check bonds at neighboring sites
-  for direction in range(lattice['Ndim']):
-    tocheck = follow_bond(start, 3 + direction, lattice)
-    if bond[tocheck][direction]:
-      if tocheck == target:
-        return 1
-      if not tocheck in cluster:
-        test = check_connect(bond, tocheck, cluster, lattice, target)
-        if test > 0:      # Otherwise keep going
-          return test
+      if not visited[tovisit] == gen:
+        visited[tovisit] = gen
+        cluster.append(tovisit)
+    ptr += 1
 
   # Finished adding to cluster without encountering target site
   return -1
 # ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Check if start and target are in the same cluster
+# by growing clusters from both sites in lockstep, one site at a time
+# Returning +1 means the two searches met, so the cluster remains connected
+# Returning -1 means one search finished without meeting the other,
+# in which case cluster holds that complete (smaller) fragment,
+# with cluster[0] the site (start or target) from which it was built
+# This costs the size of the smaller fragment rather than the larger one
+# If visits is a list, the number of sites visited is appended to it
+def check_connect_both(bond, start, target, cluster, lattice, visits=None):
+  # A bond from a site to itself can never split its cluster
+  if start == target:
+    if visits is not None:
+      visits.append(0)
+    return 1
+
+  visited = lattice['visited']
+  gens = [new_generation(lattice), new_generation(lattice)]
+  sides = [[start], [target]]
+  ptrs = [0, 0]
+  visited[start] = gens[0]
+  visited[target] = gens[1]
+
+  while True:
+    for side in range(2):
+      this = sides[side]
+      # Finished building this fragment without meeting the other one
+      if ptrs[side] == len(this):
+        cluster.extend(this)
+        if visits is not None:
+          visits.append(len(sides[0]) + len(sides[1]))
+        return -1
+
+      for tovisit in bonded_neighbors(bond, this[ptrs[side]], lattice):
+        if visited[tovisit] == gens[1 - side]:
+          if visits is not None:
+            visits.append(len(sides[0]) + len(sides[1]))
+          return 1
+        if not visited[tovisit] == gens[side]:
+          visited[tovisit] = gens[side]
+          this.append(tovisit)
+      ptrs[side] += 1
+# ------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------
+# Label all clusters formed by the given bonds at once with array operations
+# Repeatedly hook the label of one end of each bond to the smaller label
+# of the other end, then follow pointers until every label is a root
+# Return array with label[i] the smallest site index in the cluster of i
+def label_clusters(bond, neighbor):
+  site, mu = np.nonzero(bond)
+  u = site.astype(neighbor.dtype)
+  v = neighbor[site, mu]
+  label = np.arange(len(bond), dtype=neighbor.dtype)
+  while True:
+    lu = label[u]
+    lv = label[v]
+    todo = np.nonzero(lu != lv)[0]
+    if len(todo) == 0:
+      return label
+
+    # Bonds whose ends already share a label will keep doing so
+    u = u[todo]
+    v = v[todo]
+    lu = lu[todo]
+    lv = lv[todo]
+    np.minimum.at(label, np.maximum(lu, lv), np.minimum(lu, lv))
+    while True:
+      jump = label[label]
+      if np.array_equal(jump, label):
+        break
+      label = jump
+# ------------------------------------------------------------------